@@ -1,12 +1,15 @@
+import time
+paint_start = time.perf_counter()
+import importlib
+import logging
+import threading
 import streamlit as st
-import pandas as pd
-import numpy as np
-import math
-import plotly.express as px
-import plotly.graph_objects as go
-from plotly.subplots import make_subplots
 
+# Target time to draw the login form (seconds)
+login_paint_target = 0.5
 
+# Analytics stack, imported in the background while the login form is shown
+heavy_modules = ["numpy", "pandas", "plotly.graph_objects", "plotly.subplots", "qc_pipeline", "qc_season", "qc_report", "qc_agreement", "qc_validate", "qc_preview", "qc_profile", "qc_expr", "qc_score"]
 
 st.set_page_config(layout="wide", 
                    page_title='PMIS QC', 
@@ -15,44 +18,6 @@ st.set_page_config(layout="wide",
                        'About': "Developed and maintained by Hongbin Xu",
                    })
 
-# Pavement list code 
-pav_list = ["A - ASPHALTIC CONCRETE PAVEMENT (ACP)", "C - CONTINUOUSLY REINFORCED CONCRETE PAVEMENT (CRCP)", "J - JOINTED CONCRETE PAVEMENT (JCP)"]
-
-# List of distresses
-perf_indx_list = {  "IRI":['ROUGHNESS (IRI) - LEFT WHEELPATH','ROUGHNESS (IRI) - RIGHT WHEELPATH', 'ROUGHNESS (IRI) - AVERAGE','RIDE UTILITY VALUE'],
-                    
-                    # Rut
-                    "RUT": ['LEFT - WHEELPATH AVERAGE RUT DEPTH',
-                            'RIGHT - WHEELPATH AVERAGE RUT DEPTH', 
-                            'MAP21 Rutting AVG', 
-                            'ACP RUT AUTO SHALLOW AVG PCT', 'ACP RUT AUTO DEEP AVG PCT', 'ACP RUT AUTO SEVERE PCT', 'ACP RUT AUTO FAILURE PCT',
-                            'ACP RUT SHALLOW UTIL', 'ACP RUT DEEP UTIL',  'ACP RUT SEVERE UTIL']
-                }
-
-# Information list contains informaiton about location and measurement information
-inv_list = ['FISCAL YEAR', 'SIGNED HWY AND ROADBED ID', 'BEGINNING DFO', 'ENDING DFO',
-            'RESPONSIBLE DISTRICT', 'COUNTY','LANE NUMBER', 
-            'HEADER TYPE', 'START TIME', 'VEHICLE ID', 'VEHICLE VIN',
-            'CERTIFICATION DATE', 'TTI CERTIFICATION CODE', 'OPERATOR NAME',
-            'SOFTWARE VERSION', 'MAXIMUM SPEED', 'MINIMUM SPEED', 'AVERAGE SPEED',
-            'OPERATOR COMMENT', 'RATING CYCLE CODE', 'FILE NAME',
-            'RESPONSIBLE MAINTENANCE SECTION',
-            #'LATITUDE BEGIN', 'LONGITUDE BEGIN', 'ELEVATION BEGIN',
-            #'BEARING BEGIN', 'LATITUDE END', 'LONGITUDE END', 'ELEVATION END',
-            #'BEARING END', 
-            'BROAD PAVEMENT TYPE', 'MODIFIED BROAD PAVEMENT TYPE',
-            'BROAD PAVEMENT TYPE SHAPEFILE', 'RIDE COMMENT CODE',
-            "RIDE SCORE TRAFFIC LEVEL",
-            'ACP RUT AUTO COMMENT CODE', 'RATER NAME1', 'INTERFACE FLAG', 'RATER NAME2',
-            'DISTRESS COMMENT CODE', 'LANE WIDTH',
-            'DETAILED PVMNT TYPE ROAD LIFE',
-            'DETAILED PVMNT TYPE VISUAL CODE', 
-             'DIRECTION','LANE CODE','ATTACHMENT',
-            'USER UPDATE', 'DATE UPDATE', 
-            #'CALCULATED LATITUDE', 'CALCULATED LONGITUDE',
-            #'DFO FROM', 'DFO TO', 
-            'PMIS HIGHWAY SYSTEM', 'LAST YEAR LANE ERROR']
-
 def check_password():
     """Returns `True` if the user had a correct password."""
 
@@ -88,195 +53,174 @@ def check_password():
         # Password correct.
         return True
 
-# Data loading
-@ st.cache_data
-def data_load(data1_path, data2_path, item_list = None):
-
-    heading_cols = ['FISCAL YEAR', 'SIGNED HWY AND ROADBED ID', 'BEGINNING DFO', 'ENDING DFO', 'RESPONSIBLE DISTRICT', 'COUNTY'] + item_list
-
-    # File uploading
-    data1 = pd.read_csv(data1_path)
-    data1['START TIME'] = pd.to_datetime(data1['START TIME'], format='%Y%m%d%H%M%S')
-    data1["SECTION LENGTH"] = abs(data1["BEGINNING DFO"]-data1["ENDING DFO"])
-    data2 = pd.read_csv(data2_path)#
-    data2['START TIME'] = pd.to_datetime(data2['START TIME'], format='%Y%m%d%H%M%S')
-    data2["SECTION LENGTH"] = abs(data2["BEGINNING DFO"]-data2["ENDING DFO"])
-    data1 = data1[heading_cols+ [x for x in data1.columns if x not in heading_cols]]
-    data2 = data2[heading_cols+ [x for x in data2.columns if x not in heading_cols]]
-    return data1, data2
-
-# Function to merge data1 and data2 based on routename and DFO
-@st.cache_data
-def data_merge(data1 = None, data2 = None, qctype = None, item_list = None): 
-   
-    # Suffixes
-    if qctype == "Audit":
-        suffixes = ["_Pathway", "_Audit"]
-    if qctype == "Year by year": 
-        year1, year2 = data1["FISCAL YEAR"].unique()[0], data2["FISCAL YEAR"].unique()[0]
-        suffixes = ["_"+str(year1), "_"+str(year2)]
-
-    # filter based on pavement type code
-    data1_v1 = data1.copy()
-    data2_v1 = data2.copy()
-    
-    # merging data1 and data2
-    data1_v1 = data1_v1.loc[data1_v1["COUNTY"].isin(data2_v1["COUNTY"])].reset_index(drop = True)
-    data1_v1["idm"]= np.arange(data1_v1.shape[0])
-    data2_v1["idm"] = np.arange(data2_v1.shape[0])
-
-    id_match = data1_v1[["SIGNED HWY AND ROADBED ID", "COUNTY", "BEGINNING DFO", "ENDING DFO", "idm"]].merge(data2_v1[["SIGNED HWY AND ROADBED ID", "COUNTY", "BEGINNING DFO", "ENDING DFO", "idm"]],
-                                                                                                            how ="left", 
-                                                                                                            on = ["SIGNED HWY AND ROADBED ID", "COUNTY"],
-                                                                                                            suffixes= suffixes)
-    id_match = id_match.loc[(abs(id_match["BEGINNING DFO"+suffixes[0]]-id_match["BEGINNING DFO"+suffixes[1]])<0.05)&(abs(id_match["ENDING DFO"+suffixes[0]]-id_match["ENDING DFO"+suffixes[1]])<0.05)]
-
-    # id_2024, id_2023, id
-    data = id_match[["idm"+suffixes[0], "idm"+suffixes[1]]].merge(data1_v1, how = "left", left_on = "idm"+suffixes[0], right_on = "idm") # merge data
-    data = data.drop(columns = ["idm"+suffixes[0], "idm"]).merge(data2_v1, how = "left", left_on = "idm"+suffixes[1], right_on = "idm", suffixes = suffixes) # merge data
-
-    for item in  item_list:
-        data["diff_"+item] = data[item+suffixes[0]].values - data[item+suffixes[1]].values
-    return suffixes, data.drop(columns = ["idm"+suffixes[1], "idm"]).reset_index(drop = True)
-
-
-@st.cache_data
-def pav_filter(data = None, pavtype = None):
-    """
-    Filters the data based on the specified pavement type.
-
-    Parameters:
-    - data: Pandas DataFrame, optional. The input data to be filtered. If not provided, the function will return an empty DataFrame.
-    - pavtype: list, optional. A list of pavement type codes to filter the data. If not provided, the function will return the unfiltered data.
-
-    Returns:
-    - data_v1: Pandas DataFrame. The filtered data based on the specified pavement type. If no data meets the filter criteria, an empty DataFrame will be returned.
-    """
-    data_v1 = data.copy()
-    if pavtype:
-        data_v1 = data_v1.loc[data_v1[[x for x in data_v1.columns if "MODIFIED BROAD PAVEMENT TYPE" in x][0]].isin(pavtype)]
-    return data_v1
-
-# filter function
-@st.cache_data
-def thre_filter(data= None, thresholds = None, qctype = None):
-    """
-    Filters the data based on the specified thresholds and quality control type.
-
-    Parameters:
-    - data: Pandas DataFrame, optional. The input data to be filtered. If not provided, the function will return an empty DataFrame.
-    - thresholds: dict, optional. A dictionary containing the thresholds for each key. The keys are the column names in the data DataFrame and the values are tuples with the lower and upper thresholds. If not provided, the function will return the unfiltered data.
-    - qctype: str, optional. The quality control type. Possible values are "Audit" and "Year by year". If not provided, the function will return the unfiltered data.
-
-    Returns:
-    - data_v1: Pandas DataFrame. The filtered data based on the specified thresholds and quality control type. If no data meets the thresholds, an empty DataFrame will be returned.
-    """
-    data_v1 = data.copy()
-    data_v1["flag"] = 0
-    if qctype =="Audit":
-        for key in thresholds:
-            data_v1.loc[abs(data_v1["diff_"+key])>=thresholds[key][1], "flag"]=1
-    if qctype == "Year by year":
-        for key in thresholds:
-            data_v1.loc[(data_v1["diff_"+key]>=thresholds[key][1])|(data_v1["diff_"+key]<=thresholds[key][0]), "flag"]=1 
-
-    data_v1 = data_v1.loc[data_v1["flag"]==1].reset_index(drop = True)
-    return data_v1
-
-# Summary by district or county
-@st.cache_data
-def diff_summary(data= None, perf_indx= None, qctype = None, item_list = None):
-    """
-        A function that generates a summary of the data based on the provided parameters.
-
-        Parameters:
-        - data (pandas.DataFrame): The input data used for generating the summary.
-        - qctype (str): The type of quality control, which can be "Audit" or "Year by year".
-        - item_list (list): A list of items to include in the summary.
-
-        Returns:
-        - If qctype is "Year by year":
-        - dist_sum (pandas.DataFrame): The district-level summary of the data.
-        - county_sum (pandas.DataFrame): The county-level summary of the data.
-        - Otherwise:
-        - county_sum (pandas.DataFrame): The county-level summary of the data.
-    """
-    # prefix
-    if qctype == "Audit":
-        suffixes = ["_Pathway", "_Audit"]
-    if qctype == "Year by year": 
-        years = [x for x in data.columns if "FISCAL YEAR" in x]
-        suffixes = ["_"+str(years[0][-4:]), "_"+str(years[1][-4:])]
-    data1 = data.copy()
-    data1["sec_len1"] = data1["BEGINNING DFO"+suffixes[0]] - data1["ENDING DFO"+suffixes[0]]
-    data1["sec_len2"] = data1["BEGINNING DFO"+suffixes[1]] - data1["ENDING DFO"+suffixes[1]]
-
-    # county level summary (only matched data records)
-    county_sum1 = data1.pivot_table(values = [x+suffixes[0] for x in item_list], index= ["COUNTY"+suffixes[0]],
-                                    aggfunc = "mean").reset_index()
-    county_sum1["RATING CYCLE CODE"] = suffixes[0][1:]
-    county_sum1.rename(columns = dict(zip([x+suffixes[0] for x in item_list] +["COUNTY"+suffixes[0]], item_list+["COUNTY"])), inplace = True)
-    county_sum2 = data1.pivot_table(values = [x+suffixes[1] for x in item_list], index= ["COUNTY"+suffixes[1]],aggfunc = "mean").reset_index()
-    county_sum2["RATING CYCLE CODE"] = suffixes[1][1:]
-    county_sum2.rename(columns = dict(zip([x+suffixes[1] for x in item_list] +["COUNTY"+suffixes[1]], item_list+["COUNTY"])), inplace = True)
-    county_sum = pd.concat([county_sum1, county_sum2]).reset_index(drop=True)
-
-    # Additional grouping by ride traffic level for IRI only
-    if "IRI" in perf_indx:
-        county_sum10 = data1.pivot_table(values = "SECTION LENGTH"+suffixes[0], 
-                                        index= ["COUNTY"+suffixes[0],"RIDE SCORE TRAFFIC LEVEL"+suffixes[0]],
-                                        aggfunc = "sum").reset_index()
-        county_sum10["RATING CYCLE CODE"] = suffixes[0][1:]
-        county_sum10.rename(columns = dict(zip(["SECTION LENGTH"+suffixes[0], "COUNTY"+suffixes[0], "RIDE SCORE TRAFFIC LEVEL"+suffixes[0]], 
-                                            ["SECTION LENGTH","COUNTY", "RIDE SCORE TRAFFIC LEVEL"])),
-                            inplace = True)
-        county_sum10 = county_sum10.pivot(index=['COUNTY', "RATING CYCLE CODE"], 
-                                        columns='RIDE SCORE TRAFFIC LEVEL',
-                                        values="SECTION LENGTH").reset_index()
-        
+@st.cache_resource(show_spinner = False)
+def warm_up():
+    """Starts importing the heavy modules in a background thread, once per server process."""
+    def import_all():
+        for name in heavy_modules:
+            importlib.import_module(name)
+    thread = threading.Thread(target = import_all, name = "warm-up", daemon = True)
+    thread.start()
+    return thread
 
-        county_sum20 = data1.pivot_table(values = "SECTION LENGTH"+suffixes[1], 
-                                        index= ["COUNTY"+suffixes[1],"RIDE SCORE TRAFFIC LEVEL"+suffixes[1]],
-                                        aggfunc = "sum").reset_index()
-        county_sum20["RATING CYCLE CODE"] = suffixes[1][1:]
-        county_sum20.rename(columns = dict(zip(["SECTION LENGTH"+suffixes[1], "COUNTY"+suffixes[1], "RIDE SCORE TRAFFIC LEVEL"+suffixes[1]], 
-                                            ["SECTION LENGTH","COUNTY", "RIDE SCORE TRAFFIC LEVEL"])),
-                            inplace = True)
-        county_sum20 = county_sum20.pivot(index=['COUNTY', "RATING CYCLE CODE"], 
-                                        columns='RIDE SCORE TRAFFIC LEVEL',
-                                        values="SECTION LENGTH").reset_index()
-
-        county_sum0 = pd.concat([county_sum10, county_sum20]).reset_index(drop=True)
-        county_sum0 = county_sum0[["COUNTY", "RATING CYCLE CODE", "LOW", "MEDIUM", "HIGH"]].rename(columns = {"LOW":"LOW RIDE TRIFFIC MILES", 
-                                                                                                            "MEDIUM": "MEDIUM RIDE TRIFFIC MILES",
-                                                                                                            "HIGH": "HIGH RIDE TRIFFIC MILES"})
-        county_sum = county_sum.merge(county_sum0, on= ["COUNTY", "RATING CYCLE CODE"],
-                                      how = "left", left_index=False)
-    
-    count_sum = data1.groupby(by = ["COUNTY"+suffixes[0]]).size().reset_index(name = "count").rename(columns ={"COUNTY"+suffixes[0]: "COUNTY"}).sort_values(by = "COUNTY")
-    county_sum = county_sum.merge(count_sum, on = "COUNTY", how = "left")
-    county_sum = county_sum
-    county_sum= county_sum[["COUNTY", "RATING CYCLE CODE", "count"]+
-                           [x for x in county_sum.columns if x not in ["COUNTY", "RATING CYCLE CODE", "count"]]].rename(columns={"count": "Number of matching data"}).sort_values(by = ["COUNTY", "RATING CYCLE CODE"])
-
-    # District level, true when compare year by year
-    if qctype == "Year by year":
-        util_list = [x for x in item_list if "UTIL" in x]
-        dist_sum1 = data1.pivot_table(values = [x+suffixes[0] for x in util_list], index= ["FISCAL YEAR"+suffixes[0]],aggfunc = "mean").reset_index()
-        dist_sum1.rename(columns = dict(zip([x+suffixes[0] for x in util_list] +["FISCAL YEAR"+suffixes[0]], util_list+["RATING CYCLE CODE"])), inplace= True)
-        dist_sum2 = data1.pivot_table(values = [x+suffixes[1] for x in util_list], index= ["FISCAL YEAR"+suffixes[1]],aggfunc = "mean").reset_index()
-        dist_sum2.rename(columns = dict(zip([x+suffixes[1] for x in util_list] +["FISCAL YEAR"+suffixes[1]], util_list+["RATING CYCLE CODE"])), inplace= True)
-        dist_sum = pd.concat([dist_sum1, dist_sum2]).reset_index(drop=True)
-        dist_sum = dist_sum[["RATING CYCLE CODE"]+util_list].sort_values(by = ["RATING CYCLE CODE"])
-        return dist_sum, county_sum
-    else:
-        return county_sum
+warm_up()
 
 # Password checking
 st.session_state["allow"] = check_password()
 
+# Time to first paint of the login form, logged once per session
+if not st.session_state["allow"] and "login_paint" not in st.session_state:
+    st.session_state["login_paint"] = time.perf_counter() - paint_start
+    log = logging.getLogger("pmis_qc")
+    if st.session_state["login_paint"] > login_paint_target:
+        log.warning("Login form drawn in %.3f s (target %.1f s)", st.session_state["login_paint"], login_paint_target)
+    else:
+        log.info("Login form drawn in %.3f s", st.session_state["login_paint"])
+
 # Check authentication
 if st.session_state["allow"]: 
+    # Heavy modules, usually already imported by the warm-up thread
+    import io
+    import math
+    import os
+    import shutil
+    import tempfile
+    import zipfile
+    import numpy as np
+    import pandas as pd
+    import plotly.graph_objects as go
+    import qc_pipeline
+    from qc_pipeline import pav_list, perf_indx_list, scope_within, scope_filter, scope_mask, sweep_count, sweep_quantile, table_page, top_groups, PairedView
+    from qc_season import QCSeason
+    from qc_store import store, source_fingerprint
+    from qc_charts import distribution_spec, breakdown_spec, timeline_spec, profile_figure
+    from qc_report import district_reports
+    import qc_agreement
+    from qc_validate import validation_report
+    from qc_preview import QCPreview, preview_k
+    from qc_profile import RouteIndex, route_profile
+    from qc_expr import expression_filter
+    import qc_score
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Pipeline stages cached per session inputs
+    # Stages returning a PairedView (merge, scope_filter, thre_filter) are not cached: a cached view would be a copy of the loaded data.
+    # The threshold filter is cached as its flags (thre_flag).
+    # PairedView arguments are hashed by their key instead of their data.
+    # Loaded data, matches, summaries, flags and breakdown tables are also kept in the disk store (see qc_store.py), so they survive a restart.
+    view_hash = {PairedView: lambda view: view.key}
+    scope_options = st.cache_data(qc_pipeline.scope_options)
+    data_load = st.cache_data(qc_pipeline.data_load)
+    data_match = st.cache_data(qc_pipeline.data_match)
+    diff_summary = st.cache_data(store.memo("summary", qc_pipeline.diff_summary), hash_funcs = view_hash)
+    sweep_curve = st.cache_data(qc_pipeline.sweep_curve, hash_funcs = view_hash)
+    table_order = st.cache_data(qc_pipeline.table_order, hash_funcs = view_hash)
+    thre_flag = st.cache_data(store.memo("flag", qc_pipeline.thre_flag), hash_funcs = view_hash)
+    cached_breakdown = st.cache_data(store.memo("breakdown", qc_pipeline.breakdown), hash_funcs = view_hash)
+    outlier_timeline = st.cache_data(store.memo("timeline", qc_pipeline.outlier_timeline), hash_funcs = view_hash)
+    agreement = st.cache_data(store.memo("agreement", qc_agreement.agreement), hash_funcs = view_hash)
+    top_anomalies = st.cache_data(store.memo("anomalies", qc_score.top_anomalies), hash_funcs = view_hash)
+
+    def active_season():
+        """The appended season when it is the current data, otherwise None."""
+        season = st.session_state.get("season")
+        if season is not None and st.session_state.get("data") is season.view():
+            return season
+        return None
+
+    def breakdown(data = None, data_out = None, by = None, suffixes = None, paired = False, sort = True, freq = None):
+        # Outlier counts of an appended season are kept up to date while appending (for the variables in season_breakdowns)
+        season = active_season()
+        if season is not None and data is season.view() and data_out is season.outliers() and not freq:
+            df = season.breakdown(by, paired, sort)
+            if df is not None:
+                return df
+        return cached_breakdown(data = data, data_out = data_out, by = by, suffixes = suffixes, paired = paired, sort = sort, freq = freq)
+
+    def load_and_match(path1, path2, scope, qc_type, match_lanes, item_list, segment = None, projects = None, 
+                       load = qc_pipeline.data_load, match = qc_pipeline.data_match):
+        """Loads, validates, resegments (segment: length in miles, or "projects" with the project limits file) and matches the data 
+        through the disk store. Returns the session entries of the merged data."""
+        # Lineage of the loaded and matched data: file fingerprints, scope, segments, QC type, DFO tolerance and lane matching
+        load_lineage = store.lineage("load", source_fingerprint(path1), source_fingerprint(path2), scope)
+        data1, data2 = store.get_or_compute(load_lineage, lambda: load(data1_path= path1, data2_path= path2, scope = scope))
+        # Issues of the loaded files (missing columns, values out of range, duplicate and overlapping sections)
+        validation = store.get_or_compute(store.lineage("validate", load_lineage, item_list, match_lanes), lambda: validation_report(data1, data2, item_list, lanes = match_lanes))
+        if segment:
+            load_lineage = store.lineage("segment", load_lineage, segment, source_fingerprint(projects) if segment == "projects" else None, match_lanes)
+            limits = qc_pipeline.read_projects(projects) if segment == "projects" else None
+            length = None if segment == "projects" else segment
+            data1, data2 = store.get_or_compute(load_lineage, lambda: tuple(qc_pipeline.resegment(data, length, limits, match_lanes) for data in [data1, data2]))
+        match_lineage = store.lineage("match", load_lineage, qc_type, qc_pipeline.MatchIndex.tol, match_lanes)
+        suffixes, idx1, idx2 = store.get_or_compute(match_lineage, lambda: match(data1 = data1, data2 = data2, qctype = qc_type, lanes = match_lanes))
+        data_all = PairedView(data1, data2, idx1, idx2, suffixes, key = match_lineage)
+        # Sections sorted by route and DFO for the route profiles
+        return {"data1": data1, "data2": data2, "validation": validation, "suffixes": suffixes, "data_all": data_all, "routes": RouteIndex(data_all)}
+
+    def scope_validation(path1, path2, scope_loaded, scope, item_list, match_lanes):
+        """Validation of the loaded data narrowed to a scope, when the matched superset is reused (the loaded data is read from the store)."""
+        load_lineage = store.lineage("load", source_fingerprint(path1), source_fingerprint(path2), scope_loaded)
+        def compute():
+            data1, data2 = store.get_or_compute(load_lineage, lambda: data_load(data1_path= path1, data2_path= path2, scope = scope_loaded))
+            return validation_report(*[data[scope_mask(data, scope)] for data in [data1, data2]], item_list, lanes = match_lanes)
+        return store.get_or_compute(store.lineage("validate", load_lineage, scope, item_list, match_lanes), compute)
+
+    def route_index():
+        """Route index of the current data: the index built at merge time, built again for a narrowed scope or a season."""
+        routes = st.session_state.get("routes")
+        if routes is None or routes.key != st.session_state["data"].key:
+            routes = st.session_state["routes"] = RouteIndex(st.session_state["data"])
+        return routes
+
+    @st.cache_resource
+    def background():
+        """Worker threads of the exact merges that run behind a preview (shared by the sessions)."""
+        return ThreadPoolExecutor(max_workers = 2, thread_name_prefix = "exact-merge")
+
+    @st.cache_resource
+    def chart_pool():
+        """Worker threads that build the figure specs (numpy binning releases the GIL)."""
+        return ThreadPoolExecutor(max_workers = min(8, (os.cpu_count() or 1)+2), thread_name_prefix = "charts")
+
+    def upload_copy(upload):
+        """Own buffer of an uploaded file, so the background merge and the preview do not read the same file object."""
+        copy = io.BytesIO(upload.getvalue())
+        copy.name = upload.name
+        return copy
+
+    def quantile(item, q, absolute = False):
+        # Threshold defaults of an appended season are read from its quantile sketches
+        season = active_season()
+        if season is not None:
+            return season.quantiles(item, q, absolute)
+        return sweep_quantile(curves[item], q)
+
+    def threshold_input(item, curve, threvals, typed = False, upper_only = False):
+        """
+        Threshold widget of a measure over the range of its differences (curve: see sweep_curve): a slider, or number inputs when 
+        the values are typed. The slider step follows the range, so small ranges keep their precision.
+        Returns [lower, upper] (lower is 0 with upper_only), None when the measure can not be filtered (no differences or a single value,
+        which the thresholds would flag in every section).
+        """
+        values = curve["values"]
+        if values.size == 0 or values[0] == values[-1]:
+            st.caption("diff_"+item+": "+("no differences" if values.size == 0 else "all differences are "+str(round(float(values[0]), 4)))+", not filtered")
+            return None
+        vmin, vmax = float(values[0]), float(values[-1])
+        # Defaults outside the range (or missing) are moved to its bounds
+        lower, upper = [float(np.clip(x, vmin, vmax)) if np.isfinite(x) else bound for x, bound in zip(threvals, [vmin, vmax])]
+        step = 10.0**math.floor(math.log10((vmax - vmin)/1000))
+        fmt = "%."+str(max(0, -int(math.log10(step))))+"f"
+        if typed:
+            if upper_only:
+                return [0, st.number_input("diff_"+item, value = upper, step = step, format = fmt)]
+            col1, col2 = st.columns(2)
+            return [col1.number_input("diff_"+item+" lower", value = lower, step = step, format = fmt),
+                    col2.number_input("diff_"+item+" upper", value = upper, step = step, format = fmt)]
+        if upper_only:
+            return [0, st.slider(label = "diff_"+item, min_value = vmin, max_value = vmax, value = upper, step = step, format = fmt)]
+        return list(st.slider(label = "diff_"+item, min_value = vmin, max_value = vmax, value = (lower, upper), step = step, format = fmt))
+
     #try:     
     # Siderbar
     with st.sidebar:
@@ -287,10 +231,19 @@ if st.session_state["allow"]:
         with st.container():
             # QC type selector
             qc_type = st.selectbox(label = "QC type", options= ["Year by year", "Audit"], index = 1)
+            # Sections of different lanes (and directions) of a route are not paired
+            match_lanes = st.checkbox("Match direction and lane", key = "match_lanes")
+            # Sections can be rolled up to fixed-length segments or to project limits before matching
+            segment = st.selectbox("Segments", options = [None]+qc_pipeline.segment_lengths+["projects"], key = "segment",
+                                   format_func = lambda x: "Sections" if x is None else ("Project limits" if x == "projects" else str(x)+" mile"))
+            projects = None
+            if segment == "projects":
+                projects = st.file_uploader("Project limits (route, county, beginning and ending DFO)", type = ["csv"], key = "projects")
 
             #st.session_state.path1 = st.file_uploader("QC data") 
-            st.session_state.path1 = st.file_uploader("QC data", type ="csv") 
-            st.session_state.path2 = st.file_uploader("Data to compare", type ="csv")         
+            # Each side accepts several csv files and zip/gz archives (e.g. one file per district)
+            st.session_state.path1 = st.file_uploader("QC data", type =["csv", "zip", "gz"], accept_multiple_files= True) 
+            st.session_state.path2 = st.file_uploader("Data to compare", type =["csv", "zip", "gz"], accept_multiple_files= True)         
 
             # performance index Pavement type selector and generate list of items
             perf_indx = st.multiselect(label = "Select measures", options= perf_indx_list.keys())
@@ -304,22 +257,88 @@ if st.session_state["allow"]:
                 pav_type = st.multiselect(label = "Pavement type", options = pav_list, default = pav_list)
             else:
                 pav_type = st.multiselect(label = "Pavement type", options = ["A - ASPHALTIC CONCRETE PAVEMENT (ACP)"], default = "A - ASPHALTIC CONCRETE PAVEMENT (ACP)")
+
+            # District, county and route selectors (empty means all)
+            district_options, county_options = [], []
+            if st.session_state.path1:
+                try:
+                    district_options, county_options = scope_options(st.session_state.path1)
+                except:
+                    pass
+            districts = st.multiselect(label = "District", options = district_options)
+            counties = st.multiselect(label = "County", options = county_options)
+            route_prefix = st.text_input(label = "Route prefix (comma separated, e.g. IH, US)")
+            scope = {"MODIFIED BROAD PAVEMENT TYPE": pav_type, 
+                     "RESPONSIBLE DISTRICT": districts, 
+                     "COUNTY": counties,
+                     "ROUTE PREFIX": [x.strip() for x in route_prefix.split(",") if x.strip()]}
             
             # Data loading and merging
+            # The preview samples sections, it is not available for segments
+            preview_mode = st.checkbox("Preview from a sample while loading", key = "preview_mode", disabled = segment is not None)
             merge_button = st.button("Load and merge data")
-            if merge_button&(st.session_state.path1 is not None)&(st.session_state.path2 is not None):
-                try: 
-                    del st.session_state["data1"], st.session_state["data2"], st.session_state["data"], st.session_state["data_v1"], st.session_state["data_v2"]
-                except:
-                    pass
-                st.session_state["data1"], st.session_state["data2"] = data_load(data1_path= st.session_state.path1, data2_path= st.session_state.path2, item_list = item_list)
-                st.session_state["suffixes"], st.session_state["data"] = data_merge(data1 = st.session_state["data1"], data2 = st.session_state["data2"], qctype = qc_type,  item_list = item_list)
-                st.session_state["data"] = pav_filter(data= st.session_state["data"], pavtype= pav_type) # Pavement type filter
+            if merge_button and segment == "projects" and projects is None:
+                st.warning("Upload the project limits")
+            elif merge_button and st.session_state.path1 and st.session_state.path2:
+                for key in ["data", "data_v1", "data_v2", "season", "reports", "validation", "preview", "exact"]:
+                    st.session_state.pop(key, None)
+                
+                # Reuse the matched superset when only the scope was narrowed
+                load_key = [[getattr(x, "file_id", x.name) for x in st.session_state.path1], 
+                            [getattr(x, "file_id", x.name) for x in st.session_state.path2], 
+                            qc_type, match_lanes, segment, getattr(projects, "file_id", None)]
+                if ("data_all" in st.session_state)&(st.session_state.get("load_key") == load_key) and scope_within(scope, st.session_state["scope"]):
+                    st.session_state["data"] = scope_filter(data= st.session_state["data_all"], scope= scope, suffix= st.session_state["suffixes"][0])
+                    st.session_state["validation"] = scope_validation(st.session_state.path1, st.session_state.path2, st.session_state["scope"], scope, 
+                                                                      item_list, match_lanes)
+                elif preview_mode and segment is None:
+                    # The exact merge runs in the background (on copies of the uploads), the preview is read from a sample meanwhile
+                    copies = [[upload_copy(x) for x in path] for path in [st.session_state.path1, st.session_state.path2]]
+                    st.session_state["exact"] = (background().submit(load_and_match, copies[0], copies[1], scope, qc_type, match_lanes, item_list, 
+                                                                         segment, upload_copy(projects) if projects else None), 
+                                                 load_key, scope)
+                    try:
+                        st.session_state["preview"] = QCPreview.load(st.session_state.path1, st.session_state.path2, scope = scope, qctype = qc_type, 
+                                                                     lanes = match_lanes, item_list = item_list)
+                    except (ValueError, KeyError) as e:
+                        st.warning("No preview: "+str(e))
+                else:
+                    st.session_state.update(load_and_match(st.session_state.path1, st.session_state.path2, scope, qc_type, match_lanes, item_list, 
+                                                           segment, projects, load = data_load, match = data_match))
+                    st.session_state["data"] = st.session_state["data_all"]
+                    st.session_state["load_key"], st.session_state["scope"] = load_key, scope
             
-            # Download merged data
+            # Incremental season: daily deliveries are appended to a season folder, only their sections are matched
+            with st.expander("Season (append deliveries)"):
+                season_path = st.text_input("Season folder", key = "season_path")
+                delivery = st.file_uploader("Delivery to append", type =["csv", "zip", "gz"], accept_multiple_files= True, key = "delivery")
+                season_button = st.button("Open season and append delivery")
+                if season_button and season_path:
+                    try:
+                        season = st.session_state.get("season")
+                        if season is None or season.path != season_path:
+                            # The data to compare is only needed to start a new season
+                            season = QCSeason.open(season_path, data2_path = st.session_state.path2, qctype = qc_type, lanes = match_lanes)
+                        if delivery:
+                            appended = season.append(delivery)
+                            if "duplicate" in appended:
+                                st.warning("This delivery was already appended ("+appended["duplicate"]+"), it was skipped")
+                            else:
+                                st.caption(str(appended["rows"])+" rows appended, "+str(appended["matched"])+" matched")
+                        for key in ["data", "data_all", "data_v1", "data_v2", "load_key", "reports", "preview", "exact"]:
+                            st.session_state.pop(key, None)
+                        st.session_state["season"], st.session_state["suffixes"] = season, season.suffixes
+                        st.session_state["data1"], st.session_state["data2"] = season.view().data1, season.data2
+                        st.session_state["data"] = season.view()
+                        if season.outliers() is not None:
+                            st.session_state["data_v1"] = season.outliers()
+                    except ValueError as e:
+                        st.error(e)
+
+            # Download merged data (gathered when the button is clicked)
             if "data" in st.session_state.keys():
                 st.download_button("Download merged data",
-                                    data = st.session_state["data"].to_csv().encode('utf-8'),
+                                    data = lambda data = st.session_state["data"]: data.frame().to_csv().encode('utf-8'),
                                     file_name="merged.csv",
                                     mime="txt/csv")
         
@@ -330,55 +349,199 @@ if st.session_state["allow"]:
             filter_items = st.multiselect(label = "Select measures to filter",
                                           options= [x for x in item_list if "UTIL" not in x], 
                                           default = [x for x in item_list if "UTIL" not in x])
+            typed_thresholds = st.checkbox("Type threshold values", key = "typed_thresholds")
+            thresholds = dict()
             try:
-                thresholds = dict()
+                curves = dict()
                 # for year by year
                 # Based on differnce (not absolute value)
                 if qc_type == "Year by year":        
-                    if out_type == "percentile": # 2.5 and 97.5 percentiles
-                        for item in filter_items:
-                            threvals = np.nanpercentile(st.session_state["data"]["diff_"+item].values, [2.5, 97.5])
-                            threshold_temp = [st.number_input(label = "diff_"+item+"_lower", value = threvals[0]), st.number_input(label = "diff_"+item+"_upper", value = threvals[1])]
-                            thresholds[item] = threshold_temp
-
-                    if out_type == "box-style": # outliers like the ones in the boxplot
-                        for item in filter_items:
-                            threvals = np.nanpercentile(st.session_state["data"]["diff_"+item].values, [25, 75])
+                    for item in filter_items:
+                        curves[item] = sweep_curve(data = st.session_state["data"], item = item, suffix = st.session_state["suffixes"][0])
+                        if out_type == "percentile": # 2.5 and 97.5 percentiles
+                            threvals = quantile(item, [2.5, 97.5])
+                        if out_type == "box-style": # outliers like the ones in the boxplot
+                            threvals = quantile(item, [25, 75])
                             threvals = [threvals[0]-1.5*(threvals[1]-threvals[0]), threvals[1]+1.5*(threvals[1]-threvals[0])]
-                            threshold_temp = [st.number_input(label = "diff_"+item+"_lower", value = threvals[0]), st.number_input(label = "diff_"+item+"_upper", value = threvals[1])]
+                        threshold_temp = threshold_input(item, curves[item], threvals, typed_thresholds)
+                        if threshold_temp is not None:
                             thresholds[item] = threshold_temp
+
                 # for auditing
                 # based on absolute value
                 if qc_type =="Audit":
-                    if out_type == "percentile":# 2.5 and 97.5 percentiles
-                        for item in item_list:
-                            if "UTIL" not in item:
-                                threshold_temp = st.number_input(label = "diff_"+item, value = np.nanpercentile(abs(st.session_state["data"]["diff_"+item].values), 95))
-                                thresholds[item] = [0, threshold_temp]
-
-                    if out_type == "box-style": # outliers like the ones in the boxplot
-                        for item in item_list:
-                            if "UTIL" not in item:
-                                threvals = np.nanpercentile(abs(st.session_state["data"]["diff_"+item].values), [25, 75])
+                    for item in item_list:
+                        if "UTIL" not in item:
+                            curves[item] = sweep_curve(data = st.session_state["data"], item = item, suffix = st.session_state["suffixes"][0], absolute = True)
+                            if out_type == "percentile":# 2.5 and 97.5 percentiles
+                                threvals = [0, quantile(item, [95], absolute = True)[0]]
+                            if out_type == "box-style": # outliers like the ones in the boxplot
+                                threvals = quantile(item, [25, 75], absolute = True)
                                 threvals = [threvals[0]-1.5*(threvals[1]-threvals[0]), threvals[1]+1.5*(threvals[1]-threvals[0])]
-                                threshold_temp = st.number_input(label = "diff_"+item, value = threvals[1])
-                                thresholds[item] = [0, threshold_temp]          
-            except:
-                pass
+                            threshold_temp = threshold_input(item, curves[item], threvals, typed_thresholds, upper_only = True)
+                            if threshold_temp is not None:
+                                thresholds[item] = threshold_temp
+
+                # Sections that the thresholds would flag (read from the sweep curves), the lower threshold is not used in Audit
+                lower = {item: -np.inf if qc_type == "Audit" else thresholds[item][0] for item in thresholds}
+                for item in thresholds:
+                    count, miles = sweep_count(curves[item], lower = lower[item], upper = thresholds[item][1])
+                    st.caption("diff_"+item+": "+str(count)+" sections / "+str(round(miles, 1))+" miles would be flagged")
+                if thresholds:
+                    with st.expander("Flagged by county and district"):
+                        item = st.selectbox("Measure", options = list(thresholds.keys()))
+                        for group in ["RESPONSIBLE DISTRICT", "COUNTY"]:
+                            df = sweep_count(curves[item], lower = lower[item], upper = thresholds[item][1], group = group)
+                            df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
+                            st.dataframe(df.sort_values(by = "count_out", ascending = False), hide_index = True)
+            except KeyError as e:
+                # No merged data yet, or a measure missing in the data
+                if "data" in st.session_state:
+                    st.error("Column not found: "+str(e))
+
+            # Ad-hoc slices of the merged data (see qc_expr.py), alone or with the thresholds
+            filter_by = st.selectbox("Filter by", options = ["Thresholds", "Expression", "Thresholds and expression"], key = "filter_by")
+            expression = ""
+            if filter_by != "Thresholds":
+                expression = st.text_area("Filter expression", key = "filter_expression", 
+                                          placeholder = "AVERAGE SPEED_Pathway < 30 and RIDE COMMENT CODE differs",
+                                          help = "Comparisons, in (...), and, or, not, + - * /, abs, isna, notna and \"X differs\" (both sides). "+
+                                                 "Column names as in the table, a name without suffix is the QC data column.")
 
             # filter add function
             filter_button = st.button("Apply filter")
             if (filter_button)&("data" in st.session_state):
-                    st.session_state["data_v1"]= thre_filter(data= st.session_state["data"], thresholds = thresholds, qctype= qc_type)
+                try:
+                    if filter_by != "Expression" and active_season() is not None:
+                        st.session_state["data_v1"] = active_season().set_thresholds(thresholds)
+                    if filter_by != "Thresholds" or active_season() is None:
+                        if filter_by == "Expression":
+                            flag = expression_filter(st.session_state["data"], expression)
+                        else:
+                            flag = thre_flag(data= st.session_state["data"], thresholds = thresholds, qctype= qc_type)
+                        if filter_by == "Thresholds and expression":
+                            flag = flag & expression_filter(st.session_state["data"], expression)
+                        st.session_state["data_v1"]= st.session_state["data"].take(flag)
+                    st.session_state["thresholds"] = thresholds
+                except ValueError as e:
+                    st.error(e)
+
+        # District reports of the filtered data, rendered in worker processes
+        st.subheader("III: District reports")
+        with st.container():
+            report_districts = st.multiselect("Report districts (empty means all)", options = district_options, key = "report_districts")
+            report_fmt = st.radio("Report format", options = ["html", "pdf"], horizontal = True, key = "report_fmt")
+            report_button = st.button("Generate reports")
+            if report_button and ("data_v1" in st.session_state) and ("data" in st.session_state):
+                try:
+                    folder = tempfile.mkdtemp(prefix = "pmis_qc_reports_")
+                    paths = district_reports(data = st.session_state["data"], data_out = st.session_state["data_v1"], qctype = qc_type,
+                                             perf_indx = perf_indx, item_list = item_list, suffixes = st.session_state["suffixes"], folder = folder,
+                                             districts = report_districts, fmt = report_fmt, thresholds = st.session_state.get("thresholds"))
+                    reports = io.BytesIO()
+                    with zipfile.ZipFile(reports, "w", zipfile.ZIP_DEFLATED) as z:
+                        for path in paths:
+                            z.write(path, os.path.basename(path))
+                    shutil.rmtree(folder, ignore_errors = True)
+                    st.session_state["reports"] = reports.getvalue()
+                except ImportError as e:
+                    st.error(e)
+            elif report_button:
+                st.caption("Apply a filter first, the reports list the outliers")
+            if "reports" in st.session_state:
+                st.download_button("Download reports", data = st.session_state["reports"], file_name = "pmis_qc_reports.zip", mime = "application/zip")
+    # Preview from the sample until the exact merge is done
+    @st.fragment(run_every = 1)
+    def exact_poll():
+        future, load_key, scope_loaded = st.session_state["exact"]
+        if future.done():
+            st.session_state.pop("exact")
+            st.session_state.pop("preview", None)
+            try:
+                st.session_state.update(future.result())
+                st.session_state["data"] = st.session_state["data_all"]
+                st.session_state["load_key"], st.session_state["scope"] = load_key, scope_loaded
+            except (ValueError, KeyError, OSError) as e:
+                st.session_state["exact_error"] = str(e)
+            st.rerun()
+        else:
+            st.caption("Loading and merging all data...")
+
+    if "exact_error" in st.session_state:
+        st.error("Loading and merging failed: "+st.session_state.pop("exact_error"))
+    if "exact" in st.session_state:
+        exact_poll()
+    if "preview" in st.session_state and "data" not in st.session_state:
+        preview = st.session_state["preview"]
+        st.info("Preview from a sample of "+str(preview.sections)+" sections (up to "+str(preview_k)+" per county and pavement type). "+
+                "Estimates with 95% confidence intervals (±), the exact results replace the preview when loading and merging is done.")
+        with st.container():
+            st.subheader("County summary (preview)")
+            st.dataframe(preview.summary(item_list), hide_index = True)
+        with st.container():
+            st.subheader("Distribution Plots (preview)")
+            for p in perf_indx:
+                st.write(p + " (Pathway - Audit/previous year) " + "distribution, weighted sample")
+                spec = distribution_spec(p, {item: preview.diffs(item)[0] for item in perf_indx_list[p] if "UTIL" not in item}, weights = preview.pair_weights())
+                st.plotly_chart(spec, use_container_width= True)
+        with st.container():
+            st.subheader("Distribution of outliers (preview)")
+            preview_thresholds = preview.thresholds(item_list)
+            st.caption("Outliers by the default thresholds (percentile identifier) of the sample: "+
+                       ", ".join(item+" "+" / ".join(str(round(x, 2)) for x in (value[1:] if qc_type == "Audit" else value)) for item, value in preview_thresholds.items()))
+            # By county, district, the routes with the most estimated outliers and measure
+            for by, label in [("COUNTY", "COUNTY"), ("RESPONSIBLE DISTRICT", "DISTRICT"), ("SIGNED HWY AND ROADBED ID", "HIGHWAY ID"), ("Measure", "Measure")]:
+                if by == "Measure":
+                    df = preview.measure_outliers(preview_thresholds)
+                else:
+                    df = preview.outliers(preview_thresholds, by = by)
+                if by == "SIGNED HWY AND ROADBED ID":
+                    df = df.sort_values(by = "Estimated outliers", ascending = False).head(25)
+                    label = "HIGHWAY ID (25 routes with the most estimated outliers)"
+                st.markdown("- "+label)
+                fig = go.Figure(go.Bar(x = df[by].astype("str"), y = df["Percentage of all"], name = "Percentage of all",
+                                       error_y = dict(type = "data", array = df["Percentage of all ±"]),
+                                       customdata = df[["Estimated matches", "Estimated outliers"]],
+                                       hovertemplate ='<b>'+by+'</b>: %{x}'+'<br><b>Outlier PCT</b>: %{y:.1f}'+'<br><b>Estimated matches</b>:%{customdata[0]:.0f}'+
+                                                      '<br><b>Estimated outliers</b>:%{customdata[1]:.0f}'))
+                fig.update_xaxes(title_text = label)
+                fig.update_yaxes(title_text = "Percentage of all")
+                st.plotly_chart(fig, use_container_width= True)
+
+    # Validation of the loaded data
+    if "validation" in st.session_state and len(st.session_state["validation"]):
+        issues = st.session_state["validation"]
+        errors = issues[issues["Severity"] == "error"]
+        if len(errors):
+            st.error("The loaded data can not be fully compared: "+"; ".join(errors["Data"]+": "+errors["Column"]+" ("+errors["Issue"]+")"))
+        with st.expander("Data validation: "+str(len(issues))+" issues"):
+            st.dataframe(issues, hide_index = True, use_container_width = True)
+
     # Summary
     with st.container():
         # District level, true when compare year by year
         if "data" in st.session_state:
-            data_sum = diff_summary(data= st.session_state["data"], perf_indx= perf_indx, qctype = qc_type, item_list = item_list)
+            if active_season() is not None:
+                data_sum = active_season().summary(perf_indx= perf_indx, item_list = item_list)
+            else:
+                data_sum = diff_summary(data= st.session_state["data"], perf_indx= perf_indx, qctype = qc_type, item_list = item_list)
             if qc_type =="Audit":
                 st.subheader("County summary")
                 st.dataframe(data_sum)
 
+                # Agreement of Pathway and Audit, with bootstrap confidence intervals
+                st.subheader("Agreement (Pathway vs Audit)")
+                acol1, acol2 = st.columns(2)
+                agree_by = acol1.selectbox("Agreement by", options = ["COUNTY", "RESPONSIBLE DISTRICT"], key = "agree_by")
+                n_boot = acol2.selectbox("Bootstrap replicates", options = [0, 200, 1000], index = 2, key = "agree_boot")
+                try:
+                    st.dataframe(agreement(data = st.session_state["data"], item_list = item_list, suffixes = st.session_state["suffixes"], by = agree_by, n_boot = n_boot),
+                                 hide_index = True)
+                    st.caption("Bias and limits of agreement (LoA) of Pathway - Audit (Bland-Altman), ICC(2,1), Lin's concordance (CCC) and RMSE. "+
+                               "low/high: 95% bootstrap interval.")
+                except KeyError as e:
+                    st.error("Column not found: "+str(e))
+
             if qc_type == "Year by year":
                 st.subheader("District summary")
                 st.dataframe(data_sum[0])
@@ -390,42 +553,13 @@ if st.session_state["allow"]:
         st.subheader("Distribution Plots")
         if "data" in st.session_state:
             # Plot
+            specs = []
             for p in perf_indx:
-                list_temp = [x for x in perf_indx_list[p] if "UTIL" not in x]
-                rows = int(math.ceil(len(list_temp)/3))
                 st.write(p + " (Pathway - Audit/previous year) " + "distribution")
-                fig = make_subplots(rows= rows, cols = 3,
-                                    specs=[[{"secondary_y": True}]*3]*rows)
-
-                i = 0
-                for item in list_temp:
-                    if "UTIL" not in item:
-                        row = i//3+1
-                        col = i%3+1
-                        xdata = st.session_state["data"][["diff_"+item]]
-
-                        if p !="IRI":
-                            hist = go.Histogram(x=xdata["diff_"+item], nbinsx=50, showlegend = False)
-                            ecdf = px.ecdf(xdata["diff_"+item])#, x="d_"+item)
-                            ecdf = go.Scatter(x=ecdf._data[0]["x"], y=ecdf._data[0]['y'], mode='lines',  yaxis='y2', showlegend = False)
-                            fig.add_trace(hist, row=row, col=col, secondary_y = False)
-                            fig.add_trace(ecdf, row=row, col=col, secondary_y = True)
-                            #fig.update_layout(row = row, col = col, yaxis_title='Count', yaxis2=dict(title='cdf', overlaying='y', side='right'))
-                            fig.update_xaxes(title_text = "diff: "+item, row = row, col = col)
-                            fig.update_yaxes(title_text="count", row=row, col=col, secondary_y=False)
-                            fig.update_yaxes(title_text='cdf', row=row, col=col, secondary_y=True)
-                        if p == "IRI":
-                            iri_diff_bin = {"bins":[-np.inf, -200, -175, -150, -125, -100, -75, -50, -25, 0, 25, 50, 75, 100, 125, 150, 175, 200, np.inf], 
-                                            "labels":["<-200", "-200-175", "-175-150", "-150-125", "-125-100", "-100-75", "-75-50", "-50-25", "-25-0", "0-25", "25-50", "50-75", "75-100", "100-125", "125-150", "150-175", "175-200", ">200"]}
-                            xdata["diff_"+item] = pd.cut(xdata["diff_"+item], bins= iri_diff_bin["bins"], labels = iri_diff_bin["labels"])
-                            xdata = xdata.groupby(by="diff_"+item).size().reset_index(name="count")
-                            hist = go.Bar(x = xdata["diff_"+item], y = xdata["count"], showlegend = False)
-                            fig.add_trace(hist, row=row, col=col)
-                            fig.update_xaxes(title_text = "diff: "+item, row = row, col = col)
-                        i+=1
-                fig.update_layout(template="simple_white")
-                fig.update_layout(height=400*rows)
-                st.plotly_chart(fig, use_container_width= True)
+                diffs = {item: st.session_state["data"].values("diff_"+item) for item in perf_indx_list[p] if "UTIL" not in item}
+                specs.append((st.empty(), chart_pool().submit(distribution_spec, p, diffs)))
+            for slot, spec in specs:
+                slot.plotly_chart(spec.result(), use_container_width= True)
 
     # Filtered data
     with st.container():
@@ -438,181 +572,125 @@ if st.session_state["allow"]:
                                 ["diff_"+x for x in item_list]+
                                 [x+st.session_state["suffixes"][0] for x in item_list]+
                                 [x+st.session_state["suffixes"][1] for x in item_list])
-                st.dataframe(st.session_state["data_v1"][heading_cols +[x for x in st.session_state["data_v1"].columns if x not in heading_cols]],use_container_width=True)
+                heading_cols = [x for x in heading_cols if x in st.session_state["data_v1"].columns]
+                all_cols = heading_cols +[x for x in st.session_state["data_v1"].columns if x not in heading_cols]
+
+                # Table controls, only one page is sent to the browser
+                table_cols = st.multiselect("Columns", options = all_cols, default = heading_cols, key = "table_cols")
+                col1, col2, col3, col4, col5 = st.columns([3, 1, 3, 3, 1])
+                sort_col = col1.selectbox("Sort by", options = [None] + all_cols, key = "table_sort")
+                ascending = col2.selectbox("Order", options = ["Ascending", "Descending"], key = "table_asc") == "Ascending"
+                search_col = col3.selectbox("Search column", options = [None] + all_cols, key = "table_search_col")
+                search_text = col4.text_input("Search text", key = "table_search_text")
+                page_size = col5.selectbox("Rows", options = [50, 100, 500], index = 1, key = "table_page_size")
+
+                order = table_order(data = st.session_state["data_v1"], sort_col = sort_col, ascending = ascending, search_col = search_col, search_text = search_text)
+                n_pages = max(1, int(math.ceil(len(order)/page_size)))
+                if st.session_state.get("table_page", 1) > n_pages:
+                    st.session_state["table_page"] = 1
+                page = st.number_input("Page (of "+str(n_pages)+")", min_value = 1, max_value = n_pages, step = 1, key = "table_page")
+                st.dataframe(table_page(data = st.session_state["data_v1"], order = order, columns = table_cols or heading_cols, page = page, page_size = page_size), use_container_width=True)
+                st.caption("Rows "+str(min((page-1)*page_size+1, len(order)))+"-"+str(min(page*page_size, len(order)))+" of "+str(len(order)))
             except:
                 pass
+    # Sections ranked by a composite anomaly score of all measures (the flagged sections, or all matched sections before filtering)
+    with st.container():
+        st.subheader("Worst sections")
+        if "data" in st.session_state and len(st.session_state["data"]):
+            ranked_data = st.session_state.get("data_v1", st.session_state["data"])
+            acol1, acol2 = st.columns([3, 1])
+            score_method = acol1.selectbox("Score", options = list(qc_score.score_methods), format_func = lambda x: qc_score.score_methods[x], key = "score_method")
+            top_n = acol2.selectbox("Sections", options = [25, 100, 500], index = 1, key = "score_k")
+            id_cols = [x+suffix for suffix in st.session_state["suffixes"] for x in ['SIGNED HWY AND ROADBED ID', 'BEGINNING DFO', 'ENDING DFO', 'RESPONSIBLE DISTRICT', 'COUNTY']]
+            worst = top_anomalies(data = ranked_data, item_list = item_list, method = score_method, k = top_n, reference = st.session_state["data"], columns = id_cols)
+            st.dataframe(worst, use_container_width = True, hide_index = True)
+            st.caption("Differences are scaled by the median and MAD of all "+str(len(st.session_state["data"]))+" matched sections, ranked among "+str(len(ranked_data))+
+                       (" filtered" if "data_v1" in st.session_state else "")+" sections.")
+
+    # Longitudinal profile of a route, routes with the most flagged sections first
+    with st.container():
+        st.subheader("Route profile")
+        if "data" in st.session_state and len(st.session_state["data"]):
+            routes = route_index()
+            ranked = routes.routes(st.session_state.get("data_v1"))
+            pcol1, pcol2 = st.columns(2)
+            route = pcol1.selectbox("Route", options = ranked["route"].tolist(), key = "profile_route",
+                                    format_func = lambda x, flagged = dict(zip(ranked["route"], ranked["flagged"])): str(x)+" ("+str(flagged[x])+" flagged)")
+            profile_item = pcol2.selectbox("Measure", options = [x for x in item_list if "UTIL" not in x])
+            if route is not None and profile_item:
+                try:
+                    profile = route_profile(data = st.session_state["data"], index = routes, route = route, item = profile_item, data_out = st.session_state.get("data_v1"))
+                    st.plotly_chart(profile_figure(profile, profile_item, st.session_state["suffixes"], route), use_container_width = True)
+                    st.caption(" / ".join(suffix[1:]+": "+str(profile[suffix]["sections"])+" sections" for suffix in st.session_state["suffixes"])+
+                               ". Minimum and maximum of each DFO bucket are drawn.")
+                except KeyError as e:
+                    st.error("Column not found: "+str(e))
+
     # Container for show distribution of outliers across different variables and location
+    # The tables are computed in layout order, the figures are built in the chart pool and drawn in their slots in the same order
     with st.container():
         st.subheader("Distribution of outliers")
 
+        charts = []
+        def chart(function, *arguments):
+            charts.append((st.empty(), chart_pool().submit(function, *arguments)))
+
+        def outlier_breakdown(by, label = None, title = None, paired = False, sort = True, freq = None, stacked = False, hover_x = True):
+            df = breakdown(data = st.session_state["data_v2"], data_out = st.session_state["data_v1"], by = by, suffixes = st.session_state["suffixes"],
+                           paired = paired, sort = sort, freq = freq)
+            chart(breakdown_spec, df, by, label, title, stacked, hover_x)
+
         col1, col2 = st.columns(2, gap = "medium")
         with col1:
             if "data" in st.session_state.keys():
-                st.session_state["data_v2"] = st.session_state["data"].copy()
+                st.session_state["data_v2"] = st.session_state["data"]
 
             # County
             try: 
                 st.markdown("- COUNTY")
-                df1 = st.session_state["data_v1"].groupby(by = "COUNTY"+st.session_state["suffixes"][0]).agg(count_out = ("COUNTY"+st.session_state["suffixes"][0], "count"),
-                                                                                                             miles_out = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                
-                df2 = st.session_state["data_v2"].groupby(by = "COUNTY"+st.session_state["suffixes"][0]).agg(count_all = ("COUNTY"+st.session_state["suffixes"][0], "count"),
-                                                                                                             miles_all = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                df = df1.merge(df2, how = "left", on = "COUNTY"+st.session_state["suffixes"][0]).rename(columns = {"COUNTY"+st.session_state["suffixes"][0]: "COUNTY"}).sort_values(by = "count_out", ascending = False)
-                df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
-
-                fig = make_subplots(specs=[[{"secondary_y": True}]])
-                fig.add_trace(go.Bar(x =df["COUNTY"], y = df["count_out"], name = "Number of outliers", 
-                                     customdata = df["miles_out"],
-                                     hovertemplate ='<b>COUNTY</b>: %{x}'+'<br><b>Outlier data</b>: %{y:.0f}<br>'+'<b>Outlier Miles</b>:%{customdata:.2f}', offsetgroup=1), 
-                             secondary_y= False)                          
-                
-                fig.add_trace(go.Bar(x =df["COUNTY"], y = df["Percentage of all"], name = "Percentage of all", 
-                                     customdata = np.stack((df["count_all"], df["miles_all"]), axis = -1),
-                                     hovertemplate ='<b>COUNTY</b>: %{x}'+'<br><b>Outlier PCT</b>: %{y:.1f}'+'<br><b>All data</b>:%{customdata[0]:.0f}'+'<br><b>Total Miles</b>:%{customdata[1]:.2f}', offsetgroup=2),
-                             secondary_y= True)
-                
-                fig.update_xaxes(title_text="COUNTY")
-                fig.update_yaxes(title_text="Number of outliers", secondary_y=False)
-                fig.update_yaxes(title_text="Percentage of all", range = [0, 100], secondary_y=True)
-                fig.update_layout(hoverlabel_align = 'left')
-                st.plotly_chart(fig, use_container_width= True)
+                outlier_breakdown("COUNTY")
             except:
                 pass
 
             # count of the filtered data based on SIGNED HWY AND ROADBED ID
             try:
                 st.markdown("- SIGNED HWY AND ROADBED ID")
-                df1 = st.session_state["data_v1"].groupby(by = "SIGNED HWY AND ROADBED ID"+st.session_state["suffixes"][0]).size().reset_index(name = "count_out").sort_values(by = "count_out", ascending = False)
-                df1 = st.session_state["data_v1"].groupby(by = "SIGNED HWY AND ROADBED ID"+st.session_state["suffixes"][0]).agg(count_out = ("SIGNED HWY AND ROADBED ID"+st.session_state["suffixes"][0], "count"),
-                                                                                                                                miles_out = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-
-
-                df2 = st.session_state["data_v2"].groupby(by = "SIGNED HWY AND ROADBED ID"+st.session_state["suffixes"][0]).agg(count_all = ("SIGNED HWY AND ROADBED ID"+st.session_state["suffixes"][0], "count"),
-                                                                                                                                miles_all = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-
-                df = df1.merge(df2, how = "left", on = "SIGNED HWY AND ROADBED ID"+st.session_state["suffixes"][0]).rename(columns = {"SIGNED HWY AND ROADBED ID"+st.session_state["suffixes"][0]: "SIGNED HWY AND ROADBED ID"})
-                df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
-                df["SIGNED HWY AND ROADBED ID"] = df["SIGNED HWY AND ROADBED ID"]
-
-                fig = make_subplots(rows = 2, cols = 1, shared_xaxes= True)
-                fig.add_trace(go.Bar(x =df["SIGNED HWY AND ROADBED ID"], y = df["count_out"], name = "Number of outliers",
-                                     customdata = df["miles_out"],
-                                     hovertemplate ='<b>HIGHWAY ID</b>: %{x}<br>'+'<b>Outlier data</b>: %{y:.0f}<br>'+'<b>Outlier Miles</b>:%{customdata:.2f}'), 
-                              row=1, col=1)
-                
-                fig.add_trace(go.Bar(x =df["SIGNED HWY AND ROADBED ID"], y = df["Percentage of all"], name = "Percentage of all", 
-                                     customdata = np.stack((df["count_all"], df["miles_all"]), axis = -1),
-                                     hovertemplate ='<b>HIGHWAY ID</b>: %{x}'+'<br><b>Outlier PCT</b>: %{y:.1f}'+'<br><b>All data</b>:%{customdata[0]:.0f}'+'<br><b>Total Miles</b>:%{customdata[1]:.2f}'), 
-                              row=2, col=1)
-                
-                fig.update_xaxes(title_text="SIGNED HWY AND ROADBED ID", row=2, col =1)
-                fig.update_yaxes(title_text="Number of outliers", row =1, col =1)
-                fig.update_yaxes(title_text="Percentage of all", range = [0, 100], row = 2, col=1)
-                fig.update_layout(hoverlabel_align = 'left')
-                st.plotly_chart(fig, use_container_width= True)
+                df = breakdown(data = st.session_state["data_v2"], data_out = st.session_state["data_v1"], by = "SIGNED HWY AND ROADBED ID", suffixes = st.session_state["suffixes"], sort = False)
+
+                # Only the top routes of the selected page are drawn, the other routes are rolled into one bar
+                route_rank = {"Number of outliers": "count_out", "Outlier miles": "miles_out", "Percentage of all": "Percentage of all"}
+                rcol1, rcol2, rcol3 = st.columns(3)
+                with rcol1:
+                    rank_by = st.selectbox("Rank routes by", options = list(route_rank.keys()), key = "route_rank")
+                with rcol2:
+                    top_k = st.selectbox("Routes per page", options = [10, 25, 50, 100], index = 1, key = "route_k")
+                with rcol3:
+                    route_page = st.number_input("Route page", min_value = 1, value = 1, step = 1, key = "route_page")
+                total = (len(st.session_state["data_v2"]), st.session_state["data_v2"]["SECTION LENGTH"+st.session_state["suffixes"][0]].sum())
+                df, n_pages = top_groups(df, by = "SIGNED HWY AND ROADBED ID", k = top_k, rank = route_rank[rank_by], page = route_page, total = total)
+                st.caption("Page "+str(min(route_page, n_pages))+" of "+str(n_pages))
+                chart(breakdown_spec, df, "SIGNED HWY AND ROADBED ID", "HIGHWAY ID", None, True)
             except:
                 pass
 
             # Lane number
             try:
                 st.markdown("- LANE NUMBER")
-                st.session_state["data_v1"]["indicator"] = st.session_state["data_v1"]["LANE NUMBER" + st.session_state["suffixes"][0]].astype("str")+"-"+st.session_state["data_v1"]["LANE NUMBER" + st.session_state["suffixes"][1]].astype("str")
-                st.session_state["data_v2"]["indicator"]= st.session_state["data_v2"]["LANE NUMBER" + st.session_state["suffixes"][0]].astype("str")+"-"+st.session_state["data_v2"]["LANE NUMBER" + st.session_state["suffixes"][1]].astype("str")
-                
-                df1 = st.session_state["data_v1"].groupby(by = "indicator").agg(count_out = ("indicator", "count"),
-                                                                                miles_out = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                
-                df2 = st.session_state["data_v2"].groupby(by = "indicator").agg(count_all = ("indicator", "count"),
-                                                                                miles_all = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                df = df1.merge(df2, how = "left", on = "indicator")
-                df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
-                df.sort_values(by = "count_out", ascending = False, inplace = True)
-                
-                fig = make_subplots(specs=[[{"secondary_y": True}]])
-                fig.add_trace(go.Bar(x =df["indicator"], y = df["count_out"], name = "Number of outliers", 
-                                     customdata = df["miles_out"],
-                                     hovertemplate ='<b>Lane</b>: %{x}<br>'+'<b>Outlier data</b>: %{y:.0f}<br>'+'<b>Outlier Miles</b>:%{customdata:.2f}',
-                                     offsetgroup=1), 
-                             secondary_y= False)
-                
-                fig.add_trace(go.Bar(x =df["indicator"], y = df["Percentage of all"], name = "Percentage of all", 
-                                     customdata = np.stack((df["count_all"], df["miles_all"]), axis = -1),
-                                     hovertemplate ='<b>Lane</b>: %{x}'+'<br><b>Outlier PCT</b>: %{y:.1f}'+'<br><b>All data</b>:%{customdata[0]:.0f}'+'<br><b>Total Miles</b>:%{customdata[1]:.2f}', 
-                                     offsetgroup=2), 
-                              secondary_y= True)
-                fig.update_xaxes(title_text="LANE NUMBER")
-                fig.update_yaxes(title_text="Number of outliers", secondary_y=False)
-                fig.update_yaxes(title_text="Percentage of all", range = [0, 100], secondary_y=True)
-                fig.update_layout(hoverlabel_align = 'left')
-                st.plotly_chart(fig, use_container_width= True)
+                outlier_breakdown("LANE NUMBER", "Lane", paired = True)
             except:
                 pass
                         
             # Direction                
             try:
                 st.markdown("- DIRECTION")
-                st.session_state["data_v1"]["indicator"] = st.session_state["data_v1"]["DIRECTION" + st.session_state["suffixes"][0]].astype("str")+"-"+st.session_state["data_v1"]["DIRECTION" + st.session_state["suffixes"][1]].astype("str")
-                st.session_state["data_v2"]["indicator"]= st.session_state["data_v2"]["DIRECTION" + st.session_state["suffixes"][0]].astype("str")+"-"+st.session_state["data_v2"]["DIRECTION" + st.session_state["suffixes"][1]].astype("str")
-                df1 = st.session_state["data_v1"].groupby(by = "indicator").agg(count_out = ("indicator", "count"),
-                                                                                miles_out = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                df2 = st.session_state["data_v2"].groupby(by = "indicator").agg(count_all = ("indicator", "count"),
-                                                                                miles_all = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                df = df1.merge(df2, how = "left", on = "indicator")
-                df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
-                df.sort_values(by = "count_out", ascending = False, inplace = True)
-
-                fig = make_subplots(specs=[[{"secondary_y": True}]])
-                fig.add_trace(go.Bar(x =df["indicator"], y = df["count_out"], name = "Number of outliers", 
-                                     customdata = df["miles_out"],
-                                     hovertemplate ='<b>Direction</b>: %{x}<br>'+'<b>Outlier data</b>: %{y:.0f}<br>'+'<b>Outlier Miles</b>:%{customdata:.2f}', 
-                                     offsetgroup=1),
-                             secondary_y= False)
-                
-                fig.add_trace(go.Bar(x =df["indicator"], y = df["Percentage of all"], name = "Percentage of all", 
-                                     customdata = np.stack((df["count_all"], df["miles_all"]), axis = -1),
-                                     hovertemplate ='<b>Direction</b>: %{x}'+'<br><b>Outlier PCT</b>: %{y:.1f}'+'<br><b>All data</b>:%{customdata[0]:.0f}'+'<br><b>Total Miles</b>:%{customdata[1]:.2f}', 
-                                     offsetgroup=2),
-                              secondary_y= True)
-                fig.update_xaxes(title_text="DIRECTION")
-                fig.update_yaxes(title_text="Number of outliers", secondary_y=False)
-                fig.update_yaxes(title_text="Percentage of all", range = [0, 100], secondary_y=True)
-                fig.update_layout(hoverlabel_align = 'left')
-                st.plotly_chart(fig, use_container_width= True)
+                outlier_breakdown("DIRECTION", "Direction", paired = True)
             except:
                 pass
 
             # Vehicle id           
             try:
                 st.markdown("- VEHICLE ID")   
-                st.session_state["data_v1"]["indicator"] = st.session_state["data_v1"]["VEHICLE ID" + st.session_state["suffixes"][0]].astype("str")+"-"+st.session_state["data_v1"]["VEHICLE ID" + st.session_state["suffixes"][1]].astype("str")
-                st.session_state["data_v2"]["indicator"]= st.session_state["data_v2"]["VEHICLE ID" + st.session_state["suffixes"][0]].astype("str")+"-"+st.session_state["data_v2"]["VEHICLE ID" + st.session_state["suffixes"][1]].astype("str")
-                
-                df1 = st.session_state["data_v1"].groupby(by = "indicator").agg(count_out = ("indicator", "count"),
-                                                                                miles_out = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                df2 = st.session_state["data_v2"].groupby(by = "indicator").agg(count_all = ("indicator", "count"),
-                                                                                miles_all = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                
-                df = df1.merge(df2, how = "left", on = "indicator")
-                df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
-                df.sort_values(by = "count_out", ascending = False, inplace = True)
-
-                fig = make_subplots(specs=[[{"secondary_y": True}]])
-                fig.add_trace(go.Bar(x =df["indicator"], y = df["count_out"], name = "Number of outliers",
-                                     customdata = df["miles_out"],
-                                     hovertemplate ='<b>Outlier data</b>: %{y:.0f}<br>'+'<b>Outlier Miles</b>:%{customdata:.2f}',
-                                     offsetgroup=1),
-                              secondary_y= False)
-                fig.add_trace(go.Bar(x =df["indicator"], y = df["Percentage of all"], name = "Percentage of all", 
-                                     customdata = np.stack((df["count_all"], df["miles_all"]), axis = -1),
-                                     hovertemplate ='<b>Outlier PCT</b>: %{y:.1f}'+'<br><b>All data</b>:%{customdata[0]:.0f}'+'<br><b>Total Miles</b>:%{customdata[1]:.2f}', 
-                                     offsetgroup=2), 
-                              secondary_y= True)
-                fig.update_xaxes(title_text="VEHICLE ID")
-                fig.update_yaxes(title_text="Number of outliers", secondary_y=False)
-                fig.update_yaxes(title_text="Percentage of all", range = [0, 100], secondary_y=True)
-                fig.update_layout(hoverlabel_align = 'left')
-                st.plotly_chart(fig, use_container_width= True)
+                outlier_breakdown("VEHICLE ID", paired = True, hover_x = False)
             except:
                 pass
 
@@ -629,54 +707,8 @@ if st.session_state["allow"]:
                 st.session_state["data_v2"]["avg speed bins"] = pd.cut(st.session_state["data_v2"]["AVERAGE SPEED"+st.session_state["suffixes"][0]], bins = speed_avg_bins["bins"], labels = speed_avg_bins["labels"])
                 st.session_state["data_v2"]["diff speed bins"] = pd.cut(st.session_state["data_v2"]["AVERAGE SPEED"+st.session_state["suffixes"][0]] - st.session_state["data_v2"]["AVERAGE SPEED"+st.session_state["suffixes"][1]], bins = speed_diff_bins["bins"], labels = speed_diff_bins["labels"])
 
-                df1 = st.session_state["data_v1"].groupby(by = "avg speed bins").agg(count_out = ("avg speed bins", "count"),
-                                                                                     miles_out = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                df2 = st.session_state["data_v2"].groupby(by = "avg speed bins").agg(count_all = ("avg speed bins", "count"),
-                                                                                     miles_all = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                df = df1.merge(df2, how = "left", on = "avg speed bins")
-                df["Percentage of all"] = df["count_out"]/df["count_all"]*100
-
-                fig = make_subplots(specs=[[{"secondary_y": True}]])
-                fig.add_trace(go.Bar(x =df["avg speed bins"], y = df["count_out"], name = "Number of outliers", 
-                                     customdata = df["miles_out"],
-                                     hovertemplate ='<b>Speed</b>: %{x}<br>'+'<b>Outlier data</b>: %{y:.0f}<br>'+'<b>Outlier Miles</b>:%{customdata:.2f}', 
-                                     offsetgroup=1), 
-                              secondary_y= False)
-                fig.add_trace(go.Bar(x =df["avg speed bins"], y = df["Percentage of all"], name = "Percentage of all", 
-                                     customdata = np.stack((df["count_all"], df["miles_all"]), axis = -1),
-                                     hovertemplate ='<b>Speed</b>: %{x}'+'<br><b>Outlier PCT</b>: %{y:.1f}'+'<br><b>All data</b>:%{customdata[0]:.0f}'+'<br><b>Total Miles</b>:%{customdata[1]:.2f}', 
-                                     offsetgroup=2), 
-                              secondary_y= True)
-                fig.update_xaxes(title_text="AVERAGE SPEED")
-                fig.update_yaxes(title_text="Number of outliers", secondary_y=False)
-                fig.update_yaxes(title_text="Percentage of all", range = [0, 100], secondary_y=True)
-                fig.update_layout(hoverlabel_align = 'left')
-
-                st.plotly_chart(fig, use_container_width= True)
-
-                df1 = st.session_state["data_v1"].groupby(by = "diff speed bins").agg(count_out = ("diff speed bins", "count"),
-                                                                                      miles_out = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                df2 = st.session_state["data_v2"].groupby(by = "diff speed bins").agg(count_all = ("diff speed bins", "count"),
-                                                                                      miles_all = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-
-                df = df1.merge(df2, how = "left", on = "diff speed bins")
-                df["Percentage of all"] = df["count_out"]/df["count_all"]*100
-                fig = make_subplots(specs=[[{"secondary_y": True}]])
-                fig.add_trace(go.Bar(x =df["diff speed bins"], y = df["count_out"], name = "Number of outliers", 
-                                     customdata = df["miles_out"],
-                                     hovertemplate ='<b>Speed DIFF</b>: %{x}<br>'+'<b>Outlier data</b>: %{y:.0f}<br>'+'<b>Outlier Miles</b>:%{customdata:.2f}', 
-                                     offsetgroup=1), 
-                              secondary_y= False)
-                fig.add_trace(go.Bar(x =df["diff speed bins"], y = df["Percentage of all"], name = "Percentage of all", 
-                                     customdata = np.stack((df["count_all"], df["miles_all"]), axis = -1),
-                                     hovertemplate ='<b>Speed DIFF</b>: %{x}'+'<br><b>Outlier PCT</b>: %{y:.1f}'+'<br><b>All data</b>:%{customdata[0]:.0f}'+'<br><b>Total Miles</b>:%{customdata[1]:.2f}', 
-                                     offsetgroup=2), 
-                              secondary_y= True)
-                fig.update_xaxes(title_text="AVERAGE SPEED DIFF")
-                fig.update_yaxes(title_text="Number of outliers", secondary_y=False)
-                fig.update_yaxes(title_text="Percentage of all", range = [0, 100], secondary_y=True)
-                fig.update_layout(hoverlabel_align = 'left')
-                st.plotly_chart(fig, use_container_width= True)
+                outlier_breakdown("avg speed bins", "Speed", "AVERAGE SPEED", sort = False)
+                outlier_breakdown("diff speed bins", "Speed DIFF", "AVERAGE SPEED DIFF", sort = False)
             except:
                 pass
 
@@ -684,93 +716,29 @@ if st.session_state["allow"]:
                 # Start time
                 try: 
                     st.markdown("- START TIME")
-                    df1 = st.session_state["data_v1"].groupby(by = "START TIME"+st.session_state["suffixes"][0]).agg(count_out = ("START TIME"+st.session_state["suffixes"][0], "count"),
-                                                                                                                     miles_out = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                    df2 = st.session_state["data_v2"].groupby(by = "START TIME"+st.session_state["suffixes"][0]).agg(count_all = ("START TIME"+st.session_state["suffixes"][0], "count"),
-                                                                                                                     miles_all = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-
-                    df = df1.merge(df2, how = "left", on = "START TIME"+st.session_state["suffixes"][0]).rename(columns = {"START TIME"+st.session_state["suffixes"][0]: "START TIME"})
-                    df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
-                    df.sort_values(by = "count_out", ascending = False, inplace = True)
-
-                    fig = make_subplots(rows = 2, cols = 1, shared_xaxes= True)
-                    fig.add_trace(go.Bar(x =df["START TIME"], y = df["count_out"], name = "Number of outliers", 
-                                         customdata = df["miles_out"],
-                                         hovertemplate ='<b>Time</b>: %{x}<br>'+'<b>Outlier data</b>: %{y:.0f}<br>'+'<b>Outlier Miles</b>:%{customdata:.2f}', 
-                                         offsetgroup=1), 
-                                  row = 1, col=1)
-                    fig.add_trace(go.Bar(x =df["START TIME"], y = df["Percentage of all"], name = "Percentage of all", 
-                                         customdata = np.stack((df["count_all"], df["miles_all"]), axis = -1),
-                                         hovertemplate ='<b>Time</b>: %{x}'+'<br><b>Outlier PCT</b>: %{y:.1f}'+'<br><b>All data</b>:%{customdata[0]:.0f}'+'<br><b>Total Miles</b>:%{customdata[1]:.2f}', 
-                                         offsetgroup=2), 
-                                  row =2, col=1)
-                    fig.update_xaxes(title_text="START TIME", row=2, col=1)
-                    fig.update_yaxes(title_text="Number of outliers", row =1, col =1)
-                    fig.update_yaxes(title_text="Percentage of all", range = [0, 100], row = 2, col=1)
-                    fig.update_layout(hoverlabel_align = 'left')
-                    st.plotly_chart(fig, use_container_width= True)
+                    # Times and time gaps are counted in buckets, so the charts have a bounded number of bars
+                    time_freq = st.radio("Time bucket", options = ["hour", "day", "week"], index = 1, horizontal = True, key = "time_freq")
+                    outlier_breakdown("START TIME", "Time", sort = False, freq = time_freq, stacked = True)
 
                     st.session_state["data_v1"]["time_diff"] = st.session_state["data_v1"]["START TIME"+st.session_state["suffixes"][0]]-st.session_state["data_v1"]["START TIME"+st.session_state["suffixes"][1]]
                     st.session_state["data_v2"]["time_diff"] = st.session_state["data_v2"]["START TIME"+st.session_state["suffixes"][0]]-st.session_state["data_v2"]["START TIME"+st.session_state["suffixes"][1]]
 
-                    df1 = st.session_state["data_v1"].groupby(by = "time_diff").agg(count_out = ("time_diff", "count"),
-                                                                                    miles_out = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                    df2 = st.session_state["data_v2"].groupby(by = "time_diff").agg(count_all = ("time_diff", "count"),
-                                                                                    miles_all = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                    df = df1.merge(df2, how = "left", on = "time_diff")
-                    df["time_diff"] = df["time_diff"].dt.days
-                    df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
-                    df.sort_values(by = "count_out", ascending = False, inplace = True)
-
-                    fig = make_subplots(rows = 2, cols = 1, shared_xaxes= True)
-                    fig.add_trace(go.Bar(x =df["time_diff"], y = df["count_out"], name = "Number of outliers", 
-                                         customdata = df["miles_out"],
-                                         hovertemplate ='<b>Time Gap</b>: %{x}<br>'+'<b>Outlier data</b>: %{y:.0f}<br>'+'<b>Outlier Miles</b>:%{customdata:.2f}',
-                                         offsetgroup=1), 
-                                  row = 1, col=1)
-                    fig.add_trace(go.Bar(x =df["time_diff"], y = df["Percentage of all"], name = "Percentage of all", 
-                                         customdata = np.stack((df["count_all"], df["miles_all"]), axis = -1),
-                                         hovertemplate ='<b>Time Gap</b>: %{x}'+'<br><b>Outlier PCT</b>: %{y:.1f}'+'<br><b>All data</b>:%{customdata[0]:.0f}'+'<br><b>Total Miles</b>:%{customdata[1]:.2f}', 
-                                         offsetgroup=2), 
-                                  row =2, col=1)
-                    fig.update_xaxes(title_text="time_diff", row=2, col =1)
-                    fig.update_yaxes(title_text="Number of outliers", row =1, col =1)
-                    fig.update_yaxes(title_text="Percentage of all", range = [0, 100], row = 2, col=1)
-                    fig.update_layout(hoverlabel_align = 'left')
-                    st.plotly_chart(fig, use_container_width= True)
+                    outlier_breakdown("time_diff", "Time Gap", "time_diff ("+time_freq+"s)", sort = False, freq = time_freq, stacked = True)
+                except:
+                    pass
+
+                # Outlier rate timeline per vehicle
+                try:
+                    st.markdown("- Outlier rate by "+time_freq+" and VEHICLE ID")
+                    df = outlier_timeline(data = st.session_state["data_v2"], data_out = st.session_state["data_v1"], by = "VEHICLE ID", suffixes = st.session_state["suffixes"], freq = time_freq)
+                    chart(timeline_spec, df, "VEHICLE ID")
                 except:
                     pass
 
                 try:
                     # RIDE COMMENT CODE
                     st.markdown("- RIDE COMMENT CODE")
-                    st.session_state["data_v1"]["indicator"] = st.session_state["data_v1"]["RIDE COMMENT CODE" + st.session_state["suffixes"][0]].astype("str")+"-"+st.session_state["data_v1"]["RIDE COMMENT CODE" + st.session_state["suffixes"][1]].astype("str")
-                    st.session_state["data_v2"]["indicator"]= st.session_state["data_v2"]["RIDE COMMENT CODE" + st.session_state["suffixes"][0]].astype("str")+"-"+st.session_state["data_v2"]["RIDE COMMENT CODE" + st.session_state["suffixes"][1]].astype("str")
-                    
-                    df1 = st.session_state["data_v1"].groupby(by = "indicator").agg(count_out = ("indicator", "count"),
-                                                                                    miles_out = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                    df2 = st.session_state["data_v2"].groupby(by = "indicator").agg(count_all = ("indicator", "count"),
-                                                                                    miles_all = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                    df = df1.merge(df2, how = "left", on = "indicator")
-                    df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
-                    df.sort_values(by = "count_out", ascending = False, inplace = True)
-
-                    fig = make_subplots(specs=[[{"secondary_y": True}]])
-                    fig.add_trace(go.Bar(x =df["indicator"], y = df["count_out"], name = "Number of outliers", 
-                                         customdata = df["miles_out"],
-                                         hovertemplate ='<b>Outlier data</b>: %{y:.0f}<br>'+'<b>Outlier Miles</b>:%{customdata:.2f}',
-                                         offsetgroup=1), 
-                                  secondary_y= False)
-                    fig.add_trace(go.Bar(x =df["indicator"], y = df["Percentage of all"], name = "Percentage of all", 
-                                         customdata = np.stack((df["count_all"], df["miles_all"]), axis = -1),
-                                         hovertemplate ='<b>Outlier PCT</b>: %{y:.1f}'+'<br><b>All data</b>:%{customdata[0]:.0f}'+'<br><b>Total Miles</b>:%{customdata[1]:.2f}',
-                                         offsetgroup=2), 
-                                  secondary_y= True)
-                    fig.update_xaxes(title_text="RIDE COMMENT CODE")
-                    fig.update_yaxes(title_text="Number of outliers", secondary_y=False)
-                    fig.update_yaxes(title_text="Percentage of all", range = [0, 100], secondary_y=True)
-                    fig.update_layout(hoverlabel_align = 'left')
-                    st.plotly_chart(fig, use_container_width= True)
+                    outlier_breakdown("RIDE COMMENT CODE", paired = True, hover_x = False)
                 except:
                     pass
 
@@ -778,96 +746,21 @@ if st.session_state["allow"]:
                 try:
                     if "RUT" in perf_indx:
                         st.markdown("- ACP RUT AUTO COMMENT CODE")
-                        st.session_state["data_v1"]["indicator"] = st.session_state["data_v1"]["ACP RUT AUTO COMMENT CODE" + st.session_state["suffixes"][0]].astype("str")+"-"+st.session_state["data_v1"]["ACP RUT AUTO COMMENT CODE" + st.session_state["suffixes"][1]].astype("str")
-                        st.session_state["data_v2"]["indicator"]= st.session_state["data_v2"]["ACP RUT AUTO COMMENT CODE" + st.session_state["suffixes"][0]].astype("str")+"-"+st.session_state["data_v2"]["ACP RUT AUTO COMMENT CODE" + st.session_state["suffixes"][1]].astype("str")
-                        df1 = st.session_state["data_v1"].groupby(by = "indicator").agg(count_out = ("indicator", "count"),
-                                                                                        miles_out = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                        df2 = st.session_state["data_v2"].groupby(by = "indicator").agg(count_all = ("indicator", "count"),
-                                                                                        miles_all = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                        df = df1.merge(df2, how = "left", on = "indicator")
-                        df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
-                        df.sort_values(by = "count_out", ascending = False, inplace = True)
-
-                        fig = make_subplots(specs=[[{"secondary_y": True}]])
-                        fig.add_trace(go.Bar(x =df["indicator"], y = df["count_out"], name = "Number of outliers", 
-                                             customdata = df["miles_out"],
-                                             hovertemplate ='<b>RUT COMMENT</b>: %{x}'+'<b>Outlier data</b>: %{y:.0f}<br>'+'<b>Outlier Miles</b>:%{customdata:.2f}',
-                                             offsetgroup=1), 
-                                      secondary_y= False)
-                        fig.add_trace(go.Bar(x =df["indicator"], y = df["Percentage of all"], name = "Percentage of all", 
-                                             customdata = np.stack((df["count_all"], df["miles_all"]), axis = -1),
-                                             hovertemplate ='<b>RUT COMMENT</b>: %{x}'+'<b>Outlier PCT</b>: %{y:.1f}'+'<br><b>All data</b>:%{customdata[0]:.0f}'+'<br><b>Total Miles</b>:%{customdata[1]:.2f}',
-                                             offsetgroup=2), 
-                                      secondary_y= True)
-                        fig.update_xaxes(title_text="ACP RUT AUTO COMMENT CODE")
-                        fig.update_yaxes(title_text="Number of outliers", secondary_y=False)
-                        fig.update_yaxes(title_text="Percentage of all", range = [0, 100], secondary_y=True)
-                        fig.update_layout(hoverlabel_align = 'left')
-                        st.plotly_chart(fig, use_container_width= True)
+                        outlier_breakdown("ACP RUT AUTO COMMENT CODE", "RUT COMMENT", paired = True)
                 except:
                     pass
                 
                 # INTERFACE FLAG                
                 try:
-                    # INTERFACE FLAG
                     st.markdown("- INTERFACE FLAG")
-                    st.session_state["data_v1"]["indicator"] = st.session_state["data_v1"]["INTERFACE FLAG" + st.session_state["suffixes"][0]].astype("str")+"-"+st.session_state["data_v1"]["INTERFACE FLAG" + st.session_state["suffixes"][1]].astype("str")
-                    st.session_state["data_v2"]["indicator"]= st.session_state["data_v2"]["INTERFACE FLAG" + st.session_state["suffixes"][0]].astype("str")+"-"+st.session_state["data_v2"]["INTERFACE FLAG" + st.session_state["suffixes"][1]].astype("str")
-                    df1 = st.session_state["data_v1"].groupby(by = "indicator").agg(count_out = ("indicator", "count"),
-                                                                                    miles_out = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                    df2 = st.session_state["data_v2"].groupby(by = "indicator").agg(count_all = ("indicator", "count"),
-                                                                                    miles_all = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                    df = df1.merge(df2, how = "left", on = "indicator")
-                    df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
-                    df.sort_values(by = "count_out", ascending = False, inplace = True)
-
-                    fig = make_subplots(specs=[[{"secondary_y": True}]])
-                    fig.add_trace(go.Bar(x =df["indicator"], y = df["count_out"], name = "Number of outliers", 
-                                         customdata = df["miles_out"],
-                                         hovertemplate ='<b>Interface</b>: %{x}<br>'+'<b>Outlier data</b>: %{y:.0f}<br>'+'<b>Outlier Miles</b>:%{customdata:.2f}',
-                                         offsetgroup=1), 
-                                  secondary_y= False)
-                    fig.add_trace(go.Bar(x =df["indicator"], y = df["Percentage of all"], name = "Percentage of all", 
-                                         customdata = np.stack((df["count_all"], df["miles_all"]), axis = -1),
-                                         hovertemplate ='<b>Interface</b>: %{x}'+'<br><b>Outlier PCT</b>: %{y:.1f}'+'<br><b>All data</b>:%{customdata[0]:.0f}'+'<br><b>Total Miles</b>:%{customdata[1]:.2f}', 
-                                         offsetgroup=2), 
-                                  secondary_y= True)
-                    fig.update_xaxes(title_text="INTERFACE FLAG")
-                    fig.update_yaxes(title_text="Number of outliers", secondary_y=False)
-                    fig.update_yaxes(title_text="Percentage of all", range = [0, 100], secondary_y=True)
-                    fig.update_layout(hoverlabel_align = 'left')
-                    st.plotly_chart(fig, use_container_width= True)
+                    outlier_breakdown("INTERFACE FLAG", "Interface", paired = True)
                 except:
                     pass
 
                 # LANE WIDTH
                 try:
                     st.markdown("- LANE WIDTH")
-                    df1 = st.session_state["data_v1"].groupby(by = "LANE WIDTH"+st.session_state["suffixes"][0]).agg(count_out = ("LANE WIDTH"+st.session_state["suffixes"][0], "count"),
-                                                                                                                    miles_out = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                    df2 = st.session_state["data_v2"].groupby(by = "LANE WIDTH"+st.session_state["suffixes"][0]).agg(count_all = ("LANE WIDTH"+st.session_state["suffixes"][0], "count"),
-                                                                                                                    miles_all = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-
-                    df = df1.merge(df2, how = "left", on = "LANE WIDTH"+st.session_state["suffixes"][0]).rename(columns = {"LANE WIDTH"+st.session_state["suffixes"][0]: "LANE WIDTH"})
-                    df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
-                    df.sort_values(by = "count_out", ascending = False, inplace = True)
-
-                    fig = make_subplots(specs=[[{"secondary_y": True}]])
-                    fig.add_trace(go.Bar(x =df["LANE WIDTH"], y = df["count_out"], name = "Number of outliers", 
-                                         customdata = df["miles_out"],
-                                         hovertemplate ='<b>LANE WIDTH</b>: %{x}<br>'+'<b>Outlier data</b>: %{y:.0f}<br>'+'<b>Outlier Miles</b>:%{customdata:.2f}',
-                                         offsetgroup=1), 
-                                  secondary_y= False)
-                    fig.add_trace(go.Bar(x =df["LANE WIDTH"], y = df["Percentage of all"], name = "Percentage of all", 
-                                         customdata = np.stack((df["count_all"], df["miles_all"]), axis = -1),
-                                         hovertemplate ='<b>LANE WIDTH</b>: %{x}'+'<br><b>Outlier PCT</b>: %{y:.1f}'+'<br><b>All data</b>:%{customdata[0]:.0f}'+'<br><b>Total Miles</b>:%{customdata[1]:.2f}', 
-                                         offsetgroup=2), 
-                                  secondary_y= True)
-                    fig.update_xaxes(title_text="LANE WIDTH")
-                    fig.update_yaxes(title_text="Number of outliers", secondary_y=False)
-                    fig.update_yaxes(title_text="Percentage of all", range = [0, 100], secondary_y=True)
-                    fig.update_layout(hoverlabel_align = 'left')
-                    st.plotly_chart(fig, use_container_width= True)
+                    outlier_breakdown("LANE WIDTH")
                 except:
                     pass
                 
@@ -875,32 +768,15 @@ if st.session_state["allow"]:
                 try:
                     if "IRI" in perf_indx:
                         st.markdown("- RIDE SCORE TRAFFIC LEVEL")
-                        df1 = st.session_state["data_v1"].groupby(by = "RIDE SCORE TRAFFIC LEVEL"+st.session_state["suffixes"][0]).agg(count_out = ("RIDE SCORE TRAFFIC LEVEL"+st.session_state["suffixes"][0], "count"),
-                                                                                                                                        miles_out = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                        df2 = st.session_state["data_v2"].groupby(by = "RIDE SCORE TRAFFIC LEVEL"+st.session_state["suffixes"][0]).agg(count_all = ("RIDE SCORE TRAFFIC LEVEL"+st.session_state["suffixes"][0], "count"),
-                                                                                                                                        miles_all = ("SECTION LENGTH"+st.session_state["suffixes"][0], "sum")).reset_index()
-                        df2["data"] = "all matched"
-                        df = df1.merge(df2, how = "left", on = "RIDE SCORE TRAFFIC LEVEL"+st.session_state["suffixes"][0]).rename(columns = {"RIDE SCORE TRAFFIC LEVEL"+st.session_state["suffixes"][0]: "RIDE SCORE TRAFFIC LEVEL"})
-                        df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
-                        df.sort_values(by = "count_out", ascending = False, inplace = True)
-
-                        fig = make_subplots(specs=[[{"secondary_y": True}]])
-                        fig.add_trace(go.Bar(x =df["RIDE SCORE TRAFFIC LEVEL"], y = df["count_out"], name = "Number of outliers", 
-                                             customdata = df["miles_out"],
-                                             hovertemplate ='<b>RIDE TRAFFIC</b>: %{x}<br>'+'<b>Outlier data</b>: %{y:.0f}<br>'+'<b>Outlier Miles</b>:%{customdata:.2f}',
-                                             offsetgroup=1), 
-                                      secondary_y= False)
-                        fig.add_trace(go.Bar(x =df["RIDE SCORE TRAFFIC LEVEL"], y = df["Percentage of all"], name = "Percentage of all", 
-                                             customdata = np.stack((df["count_all"], df["miles_all"]), axis = -1),
-                                             hovertemplate ='<b>RIDE TRAFFIC</b>: %{x}'+'<br><b>Outlier PCT</b>: %{y:.1f}'+'<br><b>All data</b>:%{customdata[0]:.0f}'+'<br><b>Total Miles</b>:%{customdata[1]:.2f}',
-                                             offsetgroup=2), 
-                                      secondary_y= True)
-                        fig.update_xaxes(title_text="RIDE SCORE TRAFFIC LEVEL")
-                        fig.update_yaxes(title_text="Number of outliers", secondary_y=False)
-                        fig.update_yaxes(title_text="Percentage of all", range = [0, 100], secondary_y=True)
-                        fig.update_layout(hoverlabel_align = 'left')
-                        st.plotly_chart(fig, use_container_width= True)
+                        outlier_breakdown("RIDE SCORE TRAFFIC LEVEL", "RIDE TRAFFIC")
                 except:
                     pass
+
+        # Figures in layout order, each one as soon as it is built
+        for slot, spec in charts:
+            try:
+                slot.plotly_chart(spec.result(), use_container_width= True)
+            except:
+                slot.empty()
     #except:
     #    pass
@@ -0,0 +1,116 @@
+"""
+Agreement statistics of the QC data and the Audit data (Audit mode): Bland-Altman bias and limits of agreement, ICC, Lin's concordance
+correlation coefficient and RMSE, by county or district, with bootstrap confidence intervals.
+
+All statistics are computed from six sums of each group (n, sums of x and y, of their squares and of their products), so the bootstrap
+only resamples the rows and adds them up: the replicates of all groups are drawn as one matrix of row positions (rows sorted by group,
+each row replaced by a random row of its group) and summed with np.add.reduceat, in blocks of replicates to bound the memory.
+"""
+import warnings
+
+import pandas as pd
+import numpy as np
+
+
+# Statistics of the agreement table, each with a confidence interval
+agreement_stats = ["Bias", "LoA lower", "LoA upper", "ICC", "CCC", "RMSE"]
+
+def agreement_sums(x = None, y = None, starts = None):
+    """
+    Sums of the groups of rows (rows sorted by group, starts: first row of each group). x and y can be 2-D (replicates, rows).
+
+    Returns:
+    - sums: numpy array (6, ..., groups). n, sum of x, y, x*x, y*y, x*y.
+    """
+    n = np.broadcast_to(np.diff(np.append(starts, x.shape[-1])).astype("float64"), x.shape[:-1]+starts.shape)
+    return np.stack([n]+[np.add.reduceat(v, starts, axis = -1) for v in [x, y, x*x, y*y, x*y]])
+
+def agreement_from_sums(sums = None):
+    """
+    Agreement statistics from the sums of agreement_sums.
+
+    - Bias: mean of x - y. LoA: bias +/- 1.96 standard deviations of x - y (Bland-Altman).
+    - ICC: ICC(2,1), two-way random effects, absolute agreement, single rater.
+    - CCC: Lin's concordance correlation coefficient.
+    - RMSE: root mean square of x - y.
+
+    Returns:
+    - dict of numpy arrays, one per statistic (NaN for groups of less than two sections).
+    """
+    n, sx, sy, sxx, syy, sxy = sums
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        n1 = np.where(n > 1, n-1, np.nan)
+        mx, my = sx/n, sy/n
+        sdd = sxx - 2*sxy + syy
+        bias = mx - my
+        sd = np.sqrt(np.maximum(sdd - n*bias**2, 0)/n1)
+
+        # Two way ANOVA of the sections (rows) and the two data sets (raters)
+        m = (mx + my)/2
+        ssr = 2*((sxx + 2*sxy + syy)/4 - n*m**2)
+        ssc = n*bias**2/2
+        sse = sxx + syy - 2*n*m**2 - ssr - ssc
+        msr, msc, mse = ssr/n1, ssc, sse/n1
+        icc = (msr - mse)/(msr + mse + 2*(msc - mse)/n)
+
+        vx, vy, cxy = sxx/n - mx**2, syy/n - my**2, sxy/n - mx*my
+        ccc = 2*cxy/(vx + vy + bias**2)
+        rmse = np.sqrt(sdd/n)
+    return {"Bias": bias, "LoA lower": bias - 1.96*sd, "LoA upper": bias + 1.96*sd, "ICC": icc, "CCC": ccc, "RMSE": rmse}
+
+def agreement(data = None, item_list = None, suffixes = None, by = "COUNTY", n_boot = 1000, ci = 95, seed = 0, block = 5000000):
+    """
+    Agreement of the QC data and the Audit data for each measure and group.
+
+    Parameters:
+    - data: PairedView. The merged data.
+    - item_list: list. Measures (UTIL items are skipped).
+    - suffixes: list. Suffixes of data1 and data2 columns.
+    - by: str. "COUNTY" or "RESPONSIBLE DISTRICT" (of the QC data).
+    - n_boot: int. Number of bootstrap replicates (0: no confidence intervals).
+    - ci: float. Confidence level of the percentile intervals, in %.
+    - seed: int. Seed of the resampling, the same data and seed give the same intervals.
+    - block: int. Number of resampled values held at once (replicates x sections).
+
+    Returns:
+    - df: Pandas DataFrame. by, "Measure", "n" and each statistic of agreement_stats with its interval (" low", " high").
+    """
+    rng = np.random.default_rng(seed)
+    groups = data.values(by+suffixes[0])
+    tables = []
+    for item in [x for x in item_list if "UTIL" not in x]:
+        x = data[item+suffixes[0]].to_numpy(dtype = "float64", na_value = np.nan)
+        y = data[item+suffixes[1]].to_numpy(dtype = "float64", na_value = np.nan)
+        keep = ~(np.isnan(x) | np.isnan(y) | pd.isna(groups))
+        if not keep.any():
+            continue
+        codes, names = pd.factorize(groups[keep], sort = True)
+        order = np.argsort(codes, kind = "stable")
+        # Shifted by the overall mean, so the sums of squares do not lose precision (the statistics do not change with a common shift)
+        x, y = x[keep][order], y[keep][order]
+        center = (x.mean() + y.mean())/2
+        x, y = x - center, y - center
+        counts = np.bincount(codes, minlength = len(names))
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+        stats = agreement_from_sums(agreement_sums(x, y, starts))
+        table = pd.DataFrame({by: names, "Measure": item, "n": counts})
+        for stat in agreement_stats:
+            table[stat] = stats[stat]
+
+        if n_boot:
+            # Every row is replaced by a random row of its group: position = start of the group + random offset within the group
+            row_start, row_n = np.repeat(starts, counts), np.repeat(counts, counts)
+            boot = []
+            size = max(1, block//x.size)
+            for first in range(0, n_boot, size):
+                positions = row_start + (rng.random((min(size, n_boot-first), x.size))*row_n).astype("int64")
+                boot.append(agreement_from_sums(agreement_sums(x[positions], y[positions], starts)))
+            with warnings.catch_warnings():
+                # groups of one section have no interval
+                warnings.simplefilter("ignore", RuntimeWarning)
+                for stat in agreement_stats:
+                    values = np.concatenate([b[stat] for b in boot], axis = 0)
+                    table[stat+" low"], table[stat+" high"] = np.nanpercentile(values, [(100-ci)/2, (100+ci)/2], axis = 0)
+        tables.append(table)
+    return pd.concat(tables, ignore_index = True) if tables else pd.DataFrame(columns = [by, "Measure", "n"]+agreement_stats)
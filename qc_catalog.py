@@ -0,0 +1,49 @@
+"""
+PMIS QC catalog: pavement types, measures and inventory columns.
+
+Kept free of heavy imports, so the app can use it before pandas and plotly are loaded.
+"""
+
+# Pavement list code 
+pav_list = ["A - ASPHALTIC CONCRETE PAVEMENT (ACP)", "C - CONTINUOUSLY REINFORCED CONCRETE PAVEMENT (CRCP)", "J - JOINTED CONCRETE PAVEMENT (JCP)"]
+
+# List of distresses
+perf_indx_list = {  "IRI":['ROUGHNESS (IRI) - LEFT WHEELPATH','ROUGHNESS (IRI) - RIGHT WHEELPATH', 'ROUGHNESS (IRI) - AVERAGE','RIDE UTILITY VALUE'],
+                    
+                    # Rut
+                    "RUT": ['LEFT - WHEELPATH AVERAGE RUT DEPTH',
+                            'RIGHT - WHEELPATH AVERAGE RUT DEPTH', 
+                            'MAP21 Rutting AVG', 
+                            'ACP RUT AUTO SHALLOW AVG PCT', 'ACP RUT AUTO DEEP AVG PCT', 'ACP RUT AUTO SEVERE PCT', 'ACP RUT AUTO FAILURE PCT',
+                            'ACP RUT SHALLOW UTIL', 'ACP RUT DEEP UTIL',  'ACP RUT SEVERE UTIL']
+                }
+
+# All measure columns
+measure_cols = [item for items in perf_indx_list.values() for item in items]
+
+# Information list contains informaiton about location and measurement information
+inv_list = ['FISCAL YEAR', 'SIGNED HWY AND ROADBED ID', 'BEGINNING DFO', 'ENDING DFO',
+            'RESPONSIBLE DISTRICT', 'COUNTY','LANE NUMBER', 
+            'HEADER TYPE', 'START TIME', 'VEHICLE ID', 'VEHICLE VIN',
+            'CERTIFICATION DATE', 'TTI CERTIFICATION CODE', 'OPERATOR NAME',
+            'SOFTWARE VERSION', 'MAXIMUM SPEED', 'MINIMUM SPEED', 'AVERAGE SPEED',
+            'OPERATOR COMMENT', 'RATING CYCLE CODE', 'FILE NAME',
+            'RESPONSIBLE MAINTENANCE SECTION',
+            #'LATITUDE BEGIN', 'LONGITUDE BEGIN', 'ELEVATION BEGIN',
+            #'BEARING BEGIN', 'LATITUDE END', 'LONGITUDE END', 'ELEVATION END',
+            #'BEARING END', 
+            'BROAD PAVEMENT TYPE', 'MODIFIED BROAD PAVEMENT TYPE',
+            'BROAD PAVEMENT TYPE SHAPEFILE', 'RIDE COMMENT CODE',
+            "RIDE SCORE TRAFFIC LEVEL",
+            'ACP RUT AUTO COMMENT CODE', 'RATER NAME1', 'INTERFACE FLAG', 'RATER NAME2',
+            'DISTRESS COMMENT CODE', 'LANE WIDTH',
+            'DETAILED PVMNT TYPE ROAD LIFE',
+            'DETAILED PVMNT TYPE VISUAL CODE', 
+             'DIRECTION','LANE CODE','ATTACHMENT',
+            'USER UPDATE', 'DATE UPDATE', 
+            #'CALCULATED LATITUDE', 'CALCULATED LONGITUDE',
+            #'DFO FROM', 'DFO TO', 
+            'PMIS HIGHWAY SYSTEM', 'LAST YEAR LANE ERROR']
+
+# Columns used to push the location and pavement selections down into loading
+scope_cols = ["MODIFIED BROAD PAVEMENT TYPE", "RESPONSIBLE DISTRICT", "COUNTY", "ROUTE PREFIX"]
@@ -0,0 +1,176 @@
+"""
+Plotly figures of the QC results, shared by the app (Home.py) and the district reports (qc_report.py).
+"""
+import copy
+import functools
+import math
+
+import pandas as pd
+import numpy as np
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+from qc_catalog import perf_indx_list
+
+
+# Bins of the IRI differences
+iri_diff_bin = {"bins":[-np.inf, -200, -175, -150, -125, -100, -75, -50, -25, 0, 25, 50, 75, 100, 125, 150, 175, 200, np.inf],
+                "labels":["<-200", "-200-175", "-175-150", "-150-125", "-125-100", "-100-75", "-75-50", "-50-25", "-25-0", "0-25", "25-50", "50-75", "75-100", "100-125", "125-150", "150-175", "175-200", ">200"]}
+
+# Number of bins of the histograms and of points of the cdf curves (the figures hold binned data, not every section)
+hist_bins = 50
+cdf_points = 500
+
+@functools.lru_cache(maxsize = None)
+def subplot_grid(rows = 1, cols = 1, secondary_y = False, shared_xaxes = False):
+    """Axes of a make_subplots grid as a plain layout dict, made once per grid shape."""
+    fig = make_subplots(rows = rows, cols = cols, shared_xaxes = shared_xaxes, specs = [[{"secondary_y": secondary_y}]*cols]*rows)
+    return fig.layout.to_plotly_json()
+
+def subplot_ref(row = 1, col = 1, cols = 1, secondary_y = False, secondary = False):
+    """Axes of a trace in a subplot_grid cell (named like make_subplots: one x axis per cell, two y axes per cell with secondary_y)."""
+    k = (row-1)*cols + col-1
+    n = 2*k + (2 if secondary else 1) if secondary_y else k+1
+    return {"xaxis": "x"+(str(k+1) if k else ""), "yaxis": "y"+(str(n) if n > 1 else "")}
+
+def axis(layout = None, ref = None):
+    """Layout entry of an axis reference ("x2" -> layout["xaxis2"])."""
+    return layout.setdefault(ref[0]+"axis"+ref[1:], dict())
+
+def subplot_layout(rows = 1, cols = 1, secondary_y = False, shared_xaxes = False, **layout):
+    return dict(copy.deepcopy(subplot_grid(rows, cols, secondary_y, shared_xaxes)), **layout)
+
+def distribution_spec(measure = None, diffs = None, weights = None):
+    """
+    Distribution of the differences of the items of a measure, as a plain figure dict: binned counts for IRI, histogram and cdf for the others.
+    The bins and the cdf are computed here, so the figure holds a few hundred points whatever the number of sections.
+
+    Parameters:
+    - measure: str. "IRI" or "RUT".
+    - diffs: dict. Differences of each item (numpy array or Pandas Series).
+    - weights: numpy array, optional. Weight of each section (e.g. sampled sections), counts are sums of the weights.
+
+    Returns:
+    - spec: dict (plotly figure), three plots per row.
+    """
+    list_temp = [x for x in perf_indx_list[measure] if "UTIL" not in x]
+    rows = int(math.ceil(len(list_temp)/3))
+    data, layout = [], subplot_layout(rows, 3, True, template = "simple_white", height = 400*rows)
+
+    for i, item in enumerate(list_temp):
+        row = i//3+1
+        col = i%3+1
+        ref, ref2 = subplot_ref(row, col, 3, True), subplot_ref(row, col, 3, True, secondary = True)
+        values = pd.Series(diffs[item]).to_numpy(dtype = "float64", na_value = np.nan)
+        w = np.ones(values.size) if weights is None else np.asarray(weights, dtype = "float64")
+        keep = ~np.isnan(values)
+        values, w = values[keep], w[keep]
+
+        if measure !="IRI":
+            counts, edges = np.histogram(values, bins = hist_bins, weights = w) if values.size else (np.zeros(0), np.zeros(1))
+            data.append(dict(type = "bar", x = (edges[:-1]+edges[1:])/2, y = counts, width = np.diff(edges), showlegend = False,
+                             hovertemplate = "%{x:.3g}: %{y:.0f}<extra></extra>", **ref))
+            order = np.argsort(values, kind = "stable")
+            cum = np.cumsum(w[order])
+            points = np.unique(np.linspace(0, values.size-1, min(values.size, cdf_points)).astype("int64"))
+            data.append(dict(type = "scatter", x = values[order][points], y = cum[points]/max(cum[-1] if cum.size else 1, 1e-12), mode = "lines",
+                             showlegend = False, **ref2))
+            axis(layout, ref["xaxis"])["title"] = {"text": "diff: "+item}
+            axis(layout, ref["yaxis"])["title"] = {"text": "count"}
+            axis(layout, ref2["yaxis"])["title"] = {"text": "cdf"}
+        if measure == "IRI":
+            # Bins closed on the right, as pd.cut
+            codes = np.searchsorted(iri_diff_bin["bins"], values, side = "left") - 1
+            inside = (codes >= 0) & (codes < len(iri_diff_bin["labels"]))
+            counts = np.bincount(codes[inside], weights = w[inside], minlength = len(iri_diff_bin["labels"]))
+            data.append(dict(type = "bar", x = iri_diff_bin["labels"], y = counts, showlegend = False, **ref))
+            axis(layout, ref["xaxis"])["title"] = {"text": "diff: "+item}
+    return {"data": data, "layout": layout}
+
+def distribution_figure(measure = None, diffs = None, weights = None):
+    """Distribution plots of a measure as a plotly Figure (see distribution_spec)."""
+    return go.Figure(distribution_spec(measure, diffs, weights))
+
+def breakdown_spec(df = None, by = None, label = None, title = None, stacked = False, hover_x = True):
+    """
+    Number of outliers and percentage of all sections by a variable, as a plain figure dict: bars on two y axes,
+    or on two rows with a shared x axis (stacked, for long axes such as routes and times).
+
+    Parameters:
+    - df: Pandas DataFrame. Result of breakdown.
+    - by: str. The variable.
+    - label: str, optional. Name of the variable in the hover text.
+    - title: str, optional. Title of the x axis (by default the variable).
+    - stacked: bool. Bars on two rows.
+    - hover_x: bool. Show the value of the variable in the hover text.
+
+    Returns:
+    - spec: dict (plotly figure).
+    """
+    label = label or by
+    head = '<b>'+label+'</b>: %{x}<br>' if hover_x else ''
+    count = dict(type = "bar", x = df[by], y = df["count_out"], name = "Number of outliers", customdata = df["miles_out"],
+                 hovertemplate = head+'<b>Outlier data</b>: %{y:.0f}<br>'+'<b>Outlier Miles</b>:%{customdata:.2f}')
+    share = dict(type = "bar", x = df[by], y = df["Percentage of all"], name = "Percentage of all",
+                 customdata = np.stack((df["count_all"], df["miles_all"]), axis = -1),
+                 hovertemplate = head+'<b>Outlier PCT</b>: %{y:.1f}'+'<br><b>All data</b>:%{customdata[0]:.0f}'+'<br><b>Total Miles</b>:%{customdata[1]:.2f}')
+    if stacked:
+        layout = subplot_layout(2, 1, False, True, hoverlabel_align = 'left')
+        count.update(subplot_ref(1, 1), offsetgroup = 1)
+        share.update(subplot_ref(2, 1), offsetgroup = 2)
+        ref_count, ref_share = subplot_ref(1, 1), subplot_ref(2, 1)
+    else:
+        layout = subplot_layout(1, 1, True, hoverlabel_align = 'left')
+        count.update(subplot_ref(secondary_y = True), offsetgroup = 1)
+        share.update(subplot_ref(secondary_y = True, secondary = True), offsetgroup = 2)
+        ref_count, ref_share = subplot_ref(secondary_y = True), subplot_ref(secondary_y = True, secondary = True)
+    axis(layout, ref_share["xaxis"])["title"] = {"text": title or by}
+    axis(layout, ref_count["yaxis"])["title"] = {"text": "Number of outliers"}
+    axis(layout, ref_share["yaxis"]).update(title = {"text": "Percentage of all"}, range = [0, 100])
+    return {"data": [count, share], "layout": layout}
+
+def breakdown_figure(df = None, by = None, label = None):
+    """Number of outliers and percentage of all sections by a variable as a plotly Figure (see breakdown_spec)."""
+    return go.Figure(breakdown_spec(df.assign(**{by: df[by].astype("str")}), by, label))
+
+def timeline_spec(df = None, by = None):
+    """
+    Outlier rate over time, one line per group (result of outlier_timeline), as a plain figure dict.
+
+    Returns:
+    - spec: dict (plotly figure).
+    """
+    data = []
+    for name, group in df.groupby(df[by].astype("str"), sort = True):
+        data.append(dict(type = "scatter", x = group["START TIME"], y = group["Percentage of all"], mode = "lines+markers", name = name,
+                         customdata = np.stack((group["count_out"], group["count_all"], group["miles_out"], group["miles_all"]), axis = -1),
+                         hovertemplate = '<b>'+by+'</b>: '+name+'<br><b>START TIME</b>: %{x}<br><b>Outlier PCT</b>: %{y:.1f}'+
+                                         '<br><b>Outlier data</b>: %{customdata[0]:.0f} of %{customdata[1]:.0f}'+
+                                         '<br><b>Outlier Miles</b>: %{customdata[2]:.2f} of %{customdata[3]:.2f}<extra></extra>'))
+    return {"data": data, "layout": {"xaxis": {"title": {"text": "START TIME"}}, "yaxis": {"title": {"text": "Percentage of all"}, "range": [0, 100]},
+                                     "legend": {"title": {"text": by}}, "hoverlabel": {"align": "left"}}}
+
+def profile_figure(profile = None, item = None, suffixes = None, route = None):
+    """
+    Longitudinal profile of a measure along a route: both sides against their BEGINNING DFO, flagged sections as markers.
+
+    Parameters:
+    - profile: dict. Result of route_profile (see qc_profile.py).
+    - item: str. The measure.
+    - suffixes: list. Suffixes of data1 and data2 columns.
+    - route: str, optional. The route, in the title.
+
+    Returns:
+    - fig: plotly Figure.
+    """
+    fig = go.Figure()
+    for suffix in suffixes:
+        fig.add_trace(go.Scattergl(x = profile[suffix]["dfo"], y = profile[suffix]["value"], mode = "lines", name = suffix[1:],
+                                   hovertemplate = '<b>DFO</b>: %{x:.3f}<br><b>'+item+'</b>: %{y:.2f}'))
+    fig.add_trace(go.Scattergl(x = profile["flagged"]["dfo"], y = profile["flagged"]["value"], mode = "markers", name = "Flagged",
+                               marker = dict(color = "red", size = 7, symbol = "x"),
+                               hovertemplate = '<b>DFO</b>: %{x:.3f}<br><b>'+item+'</b>: %{y:.2f}'))
+    fig.update_xaxes(title_text = "BEGINNING DFO")
+    fig.update_yaxes(title_text = item)
+    fig.update_layout(template = "simple_white", hovermode = "closest", title_text = route or "", hoverlabel_align = 'left')
+    return fig
@@ -0,0 +1,269 @@
+"""
+Filter expressions on the merged data, e.g. `AVERAGE SPEED_Pathway < 30 and RIDE COMMENT CODE differs` or
+`VEHICLE ID in ("V1", "V2") and LANE WIDTH < 11`.
+
+An expression is parsed with the ast module and compiled once into a tree of functions, every function works on whole columns
+(pandas/numpy operations, no Python code per row). Column names can be written as they are (with spaces) or between backticks.
+A column name without suffix is the column of the QC data (first suffix), "X differs" (or differs(X)) compares the column X of both sides.
+
+The boolean mask of every sub-expression (comparisons, and/or/not) is kept in mask_cache by view and sub-expression, so an edited
+expression only evaluates its new parts.
+
+Syntax: comparisons (<, <=, >, >=, ==, !=, chained), in / not in a list of values, and, or, not (also &, |, ~), + - * /, numbers,
+strings, True/False and the functions abs, isna, notna and differs.
+"""
+import ast
+import operator
+import re
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+import numpy as np
+
+
+class MaskCache:
+    """Boolean masks of sub-expressions by (view key, sub-expression), least recently used masks are dropped above max_bytes."""
+
+    def __init__(self, max_bytes = 200*2**20):
+        self.max_bytes, self.bytes = max_bytes, 0
+        self._masks = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._masks:
+                self._masks.move_to_end(key)
+                self.hits += 1
+                return self._masks[key]
+            self.misses += 1
+        mask = compute()
+        with self._lock:
+            if key not in self._masks:
+                self._masks[key] = mask
+                self.bytes += mask.nbytes
+                while self.bytes > self.max_bytes and len(self._masks) > 1:
+                    self.bytes -= self._masks.popitem(last = False)[1].nbytes
+        return mask
+
+    def clear(self):
+        with self._lock:
+            self._masks.clear()
+            self.bytes = 0
+
+# Masks of the process (shared by the sessions of the app and by the service)
+mask_cache = MaskCache()
+
+compare_ops = {ast.Lt: "__lt__", ast.LtE: "__le__", ast.Gt: "__gt__", ast.GtE: "__ge__", ast.Eq: "__eq__", ast.NotEq: "__ne__"}
+arithmetic_ops = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv}
+functions = ["abs", "isna", "notna", "differs"]
+
+def as_mask(values = None):
+    """Boolean numpy array of a comparison result (missing values are False)."""
+    if isinstance(values, np.ndarray) and values.dtype == bool:
+        return values
+    if isinstance(values, pd.Series) and (pd.api.types.is_bool_dtype(values.dtype)):
+        return values.to_numpy(dtype = bool, na_value = False)
+    raise ValueError("Not a condition: use a comparison, isna, notna or differs")
+
+def substitute_names(text = None, names = None):
+    """
+    Replaces the column names of an expression by placeholders (string literals are left as they are).
+
+    Returns:
+    - text: str. The expression with placeholders _c0, _c1...
+    - placeholders: dict. Placeholder -> column name.
+    """
+    placeholders = dict()
+    def placeholder(name):
+        key = "_c"+str(len(placeholders))
+        placeholders[key] = name
+        return " "+key+" "
+
+    pattern = re.compile("|".join(r"(?<![\w])"+re.escape(x)+r"(?![\w])" for x in sorted(names, key = len, reverse = True))) if names else None
+    parts = re.split(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)""", text)
+    for i, part in enumerate(parts):
+        if part.startswith("`"):
+            parts[i] = placeholder(part[1:-1])
+        elif not part.startswith(("'", '"')) and pattern is not None:
+            parts[i] = pattern.sub(lambda m: placeholder(m.group(0)), part)
+    text = "".join(parts)
+    # Postfix "X differs"
+    text = re.sub(r"(_c\d+)\s+differs\b", r"differs(\1)", text)
+    return text, placeholders
+
+
+class FilterExpression:
+    """
+    A compiled filter expression.
+
+    Parameters:
+    - text: str. The expression.
+    - columns: list. Columns of the merged data (PairedView.columns).
+    - suffixes: list. Suffixes of data1 and data2 columns.
+    """
+
+    def __init__(self, text = None, columns = None, suffixes = None):
+        self.text, self.suffixes = text, suffixes
+        self.columns = set(columns)
+        base = [x[:-len(suffixes[0])] for x in columns if x.endswith(suffixes[0])]
+        source, self.placeholders = substitute_names(text.strip(), list(self.columns) + base)
+        try:
+            tree = ast.parse(source.strip(), mode = "eval")
+        except SyntaxError as e:
+            raise ValueError("Invalid expression: "+str(e.msg))
+        self.function = self.compile(tree.body)[1]
+
+    def __call__(self, data = None, cache = mask_cache):
+        """Boolean mask of the rows of data (PairedView) that satisfy the expression."""
+        return as_mask(self.function(data, cache))
+
+    def column(self, name = None):
+        """Full column name of a name of the expression (names without suffix are columns of the QC data)."""
+        if name in self.columns:
+            return name
+        if name+self.suffixes[0] in self.columns:
+            return name+self.suffixes[0]
+        raise ValueError("Column not found: "+name)
+
+    def compile(self, node = None):
+        """
+        Compiles a node of the syntax tree.
+
+        Returns:
+        - key: str. Canonical form of the sub-expression (column names resolved), the key of its mask in the cache.
+        - function: function (data, cache) -> values (Pandas Series or boolean numpy array).
+        """
+        if isinstance(node, ast.Name):
+            name = self.column(self.placeholders.get(node.id, node.id))
+            return "`"+name+"`", lambda data, cache: data[name]
+
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, str, bool)):
+            value = node.value
+            return repr(value), lambda data, cache: value
+
+        if isinstance(node, (ast.Tuple, ast.List)):
+            values = [self.constant(x) for x in node.elts]
+            return repr(values), lambda data, cache: values
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.Invert)):
+            key, operand = self.compile(node.operand)
+            return self.cached("not "+key, lambda data, cache: ~as_mask(operand(data, cache)))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            key, operand = self.compile(node.operand)
+            return "-"+key, lambda data, cache: -operand(data, cache)
+
+        if isinstance(node, ast.BoolOp) or (isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr))):
+            is_and = isinstance(node.op, (ast.And, ast.BitAnd))
+            operands = [self.compile(x) for x in (node.values if isinstance(node, ast.BoolOp) else [node.left, node.right])]
+            combine = np.logical_and.reduce if is_and else np.logical_or.reduce
+            key = "("+(" and " if is_and else " or ").join(x[0] for x in operands)+")"
+            return self.cached(key, lambda data, cache: combine([as_mask(f(data, cache)) for _, f in operands]))
+
+        if isinstance(node, ast.BinOp) and type(node.op) in arithmetic_ops:
+            (key1, left), (key2, right) = self.compile(node.left), self.compile(node.right)
+            op = arithmetic_ops[type(node.op)]
+            # operator functions also take a constant on the left (2 * AVERAGE SPEED)
+            return "("+key1+" "+op.__name__+" "+key2+")", lambda data, cache: op(numeric(left(data, cache)), numeric(right(data, cache)))
+
+        if isinstance(node, ast.Compare):
+            parts = []
+            operands = [self.compile(node.left)] + [self.compile(x) for x in node.comparators]
+            for op, (key1, left), (key2, right) in zip(node.ops, operands[:-1], operands[1:]):
+                parts.append(self.comparison(op, key1, left, key2, right))
+            if len(parts) == 1:
+                return parts[0]
+            key = "("+" and ".join(x[0] for x in parts)+")"
+            return self.cached(key, lambda data, cache: np.logical_and.reduce([f(data, cache) for _, f in parts]))
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in functions and len(node.args) == 1 and not node.keywords:
+            name = node.func.id
+            if name == "differs":
+                if not isinstance(node.args[0], ast.Name):
+                    raise ValueError("differs needs a column name")
+                written = self.placeholders.get(node.args[0].id, node.args[0].id)
+                base = written[:-len(self.suffixes[0])] if written.endswith(self.suffixes[0]) else written
+                col1, col2 = self.column(base+self.suffixes[0]), base+self.suffixes[1]
+                if col2 not in self.columns:
+                    raise ValueError("Column not found: "+col2)
+                return self.cached("differs(`"+base+"`)", lambda data, cache: differs(data[col1], data[col2]))
+            key, operand = self.compile(node.args[0])
+            def values(data, cache):
+                result = operand(data, cache)
+                if not isinstance(result, pd.Series):
+                    raise ValueError(name+" needs a column: "+ast.unparse(node))
+                return result
+            if name == "abs":
+                return "abs("+key+")", lambda data, cache: numeric(values(data, cache)).abs()
+            if name == "isna":
+                return self.cached("isna("+key+")", lambda data, cache: values(data, cache).isna().to_numpy())
+            return self.cached("notna("+key+")", lambda data, cache: values(data, cache).notna().to_numpy())
+
+        raise ValueError("Not supported in a filter expression: "+ast.unparse(node))
+
+    def constant(self, node = None):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, str, bool)):
+            return node.value
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) and isinstance(node.operand, ast.Constant):
+            return -node.operand.value
+        raise ValueError("Lists can only hold values: "+ast.unparse(node))
+
+    def comparison(self, op = None, key1 = None, left = None, key2 = None, right = None):
+        if isinstance(op, (ast.In, ast.NotIn)):
+            negate = isinstance(op, ast.NotIn)
+            def function(data, cache):
+                values = right(data, cache)
+                if not isinstance(values, list):
+                    raise ValueError("in needs a list of values, e.g. (1, 2)")
+                mask = left(data, cache).isin(values).to_numpy()
+                return ~mask if negate else mask
+            return self.cached(key1+(" not in " if negate else " in ")+key2, function)
+        if type(op) not in compare_ops:
+            raise ValueError("Not supported in a filter expression: "+type(op).__name__)
+        method = compare_ops[type(op)]
+        def function(data, cache):
+            a, b = left(data, cache), right(data, cache)
+            if not isinstance(a, pd.Series):
+                # constant on the left: the reflected comparison of the column
+                a, b, name = b, a, {"__lt__": "__gt__", "__le__": "__ge__", "__gt__": "__lt__", "__ge__": "__le__"}.get(method, method)
+            else:
+                name = method
+            try:
+                return as_mask(a.__getattribute__(name)(b))
+            except TypeError as e:
+                raise ValueError("Can not compare "+key1+" and "+key2+": "+str(e))
+        return self.cached(key1+" "+method+" "+key2, function)
+
+    @staticmethod
+    def cached(key = None, function = None):
+        """A mask function whose result is kept in the cache under the view key and the sub-expression."""
+        return key, lambda data, cache: cache.get_or_compute((data.key, key), lambda: function(data, cache)) if cache is not None else function(data, cache)
+
+
+def numeric(values = None):
+    """Numeric values of a column or constant for arithmetic (text columns and strings raise an error)."""
+    if isinstance(values, pd.Series) and not pd.api.types.is_numeric_dtype(values.dtype):
+        raise ValueError("Arithmetic needs numeric columns: "+str(values.name))
+    if isinstance(values, (str, list)):
+        raise ValueError("Arithmetic needs numbers: "+repr(values))
+    return values
+
+def differs(a = None, b = None):
+    """Values of both sides that are not equal (a missing value on one side only differs)."""
+    both_missing = (a.isna() & b.isna()).to_numpy()
+    return ~((a == b).to_numpy(dtype = bool, na_value = False) | both_missing)
+
+def expression_filter(data = None, expression = None, cache = mask_cache):
+    """
+    Rows of the merged data that satisfy a filter expression.
+
+    Parameters:
+    - data: PairedView. The merged data.
+    - expression: str. The filter expression (see the module docstring).
+    - cache: MaskCache, optional. Masks of the sub-expressions (None: no caching).
+
+    Returns:
+    - mask: numpy array of bool.
+    """
+    return FilterExpression(expression, data.columns, data.suffixes)(data, cache)
@@ -0,0 +1,907 @@
+"""
+PMIS QC pipeline: loading, matching, filtering and summaries of PMIS data.
+
+The functions do not depend on Streamlit, they are shared by the app (Home.py) and the local service (qc_service.py).
+"""
+import gzip
+import hashlib
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import pandas as pd
+import numpy as np
+
+from qc_catalog import pav_list, perf_indx_list, measure_cols, inv_list, scope_cols
+
+
+def scope_mask(data = None, scope = None, suffix = ""):
+    """
+    Returns a boolean mask of the rows within the selected scope.
+
+    Parameters:
+    - data: Pandas DataFrame. The data to be filtered.
+    - scope: dict, optional. Selected values for each column in scope_cols. Empty selections keep all rows. "ROUTE PREFIX" holds prefixes of SIGNED HWY AND ROADBED ID.
+    - suffix: str. Suffix of the columns (used for merged data).
+
+    Returns:
+    - mask: numpy array of bool.
+    """
+    mask = np.ones(data.shape[0], dtype = bool)
+    for col, values in (scope or {}).items():
+        if not values:
+            continue
+        if col == "ROUTE PREFIX":
+            mask &= data["SIGNED HWY AND ROADBED ID"+suffix].astype("str").str.startswith(tuple(values)).to_numpy()
+        else:
+            mask &= data[col+suffix].isin(values).to_numpy()
+    return mask
+
+def scope_within(scope = None, scope_loaded = None):
+    """Returns `True` if every row selected by scope is also selected by scope_loaded."""
+    for col in scope_cols:
+        loaded, new = (scope_loaded or {}).get(col), (scope or {}).get(col)
+        if not loaded:
+            continue
+        if not new:
+            return False
+        if col == "ROUTE PREFIX":
+            if not all(x.startswith(tuple(loaded)) for x in new):
+                return False
+        elif not set(new) <= set(loaded):
+            return False
+    return True
+
+def csv_sources(data_path = None):
+    """
+    Lists the csv files of one side of the comparison. Zip archives are expanded to their csv members and 
+    gzip files are decompressed while they are read, so no combined csv is ever written.
+
+    Parameters:
+    - data_path: str, file-like object or a list of them. csv, zip or gz files.
+
+    Returns:
+    - sources: list of (name, open function) pairs.
+    """
+    sources = []
+    for path in (data_path if isinstance(data_path, (list, tuple)) else [data_path]):
+        name = getattr(path, "name", str(path))
+        if hasattr(path, "seek"):
+            path.seek(0)
+        if name.lower().endswith(".zip"):
+            archive = zipfile.ZipFile(path)
+            sources += [(name+"/"+member, (lambda archive = archive, member = member: archive.open(member)))
+                        for member in archive.namelist() if member.lower().endswith((".csv", ".csv.gz"))]
+        elif name.lower().endswith(".gz"):
+            sources.append((name, (lambda path = path: gzip.open(path))))
+        else:
+            sources.append((name, (lambda path = path: nullcontext(path))))
+    return sources
+
+def unify_columns(data = None):
+    """Orders the columns as in the column catalog (inv_list and perf_indx_list). Missing catalog columns are added as empty columns."""
+    data.columns = data.columns.str.strip()
+    catalog = inv_list + measure_cols
+    return data.reindex(columns = catalog + [x for x in data.columns if x not in catalog])
+
+def read_scope(data_path = None, scope = None, chunksize = 200000):
+    """
+    Reads a PMIS csv file chunk by chunk and keeps only the rows within the scope, so unselected rows are never kept in memory.
+
+    Parameters:
+    - data_path: str or file-like object. The csv file.
+    - scope: dict, optional. See scope_mask.
+    - chunksize: int. Number of rows parsed at a time.
+
+    Returns:
+    - data: Pandas DataFrame with the columns of the catalog (see unify_columns).
+    """
+    if hasattr(data_path, "seek"):
+        data_path.seek(0)
+    # Each chunk is filtered as it is read, only the selected rows of the chunks are concatenated
+    chunks = (unify_columns(chunk) for chunk in pd.read_csv(data_path, chunksize = chunksize, low_memory = False))
+    return pd.concat((chunk.loc[scope_mask(chunk, scope)] for chunk in chunks), ignore_index = True)
+
+def read_sources(data_path = None, scope = None, max_workers = None):
+    """
+    Reads all csv files of one side of the comparison in parallel (see csv_sources and read_scope) and 
+    concatenates them into one dataset.
+
+    Parameters:
+    - data_path: str, file-like object or a list of them. csv, zip or gz files.
+    - scope: dict, optional. See scope_mask.
+    - max_workers: int, optional. Number of worker threads.
+
+    Returns:
+    - data: Pandas DataFrame.
+    """
+    def read(source):
+        with source[1]() as f:
+            return read_scope(f, scope)
+
+    sources = csv_sources(data_path)
+    if len(sources) == 1:
+        return read(sources[0])
+    with ThreadPoolExecutor(max_workers = max_workers or min(8, os.cpu_count() or 1)) as executor:
+        return pd.concat(list(executor.map(read, sources)), ignore_index = True)
+
+def parse_start_time(values = None):
+    """Parses START TIME (yyyymmddHHMMSS), also when it was read as a number."""
+    if pd.api.types.is_numeric_dtype(values):
+        values = values.astype("Int64").astype("string")
+    return pd.to_datetime(values, format='%Y%m%d%H%M%S', errors = "coerce")
+
+# District and county options of a file (reads only these two columns)
+def scope_options(data_path = None):
+    data = []
+    for name, open_source in csv_sources(data_path):
+        with open_source() as f:
+            if hasattr(f, "seek"):
+                f.seek(0)
+            data.append(pd.read_csv(f, usecols = lambda x: x.strip() in ["RESPONSIBLE DISTRICT", "COUNTY"]).rename(columns = str.strip).drop_duplicates())
+    data = pd.concat(data).reindex(columns = ["RESPONSIBLE DISTRICT", "COUNTY"])
+    return sorted(data["RESPONSIBLE DISTRICT"].dropna().unique()), sorted(data["COUNTY"].dropna().unique())
+
+# Columns shown first
+heading_cols = ['FISCAL YEAR', 'SIGNED HWY AND ROADBED ID', 'BEGINNING DFO', 'ENDING DFO', 'RESPONSIBLE DISTRICT', 'COUNTY']
+
+def prepare_data(data = None):
+    """Parses START TIME, adds SECTION LENGTH and puts the heading columns first."""
+    data['START TIME'] = parse_start_time(data['START TIME'])
+    data["SECTION LENGTH"] = abs(data["BEGINNING DFO"]-data["ENDING DFO"])
+    return data[heading_cols+ [x for x in data.columns if x not in heading_cols]]
+
+# Data loading
+def data_load(data1_path, data2_path, scope = None):
+
+    # File uploading, pavement type only restricts the QC data
+    scope2 = {key: value for key, value in (scope or {}).items() if key != "MODIFIED BROAD PAVEMENT TYPE"}
+    data1 = prepare_data(read_sources(data1_path, scope))
+    data2 = prepare_data(read_sources(data2_path, scope2))
+    return data1, data2
+
+# Columns of the matching keys: route and county, and the direction and lane when lanes are matched
+match_keys = ["SIGNED HWY AND ROADBED ID", "COUNTY"]
+lane_keys = ["DIRECTION", "LANE NUMBER"]
+
+# Index of the data to compare on route, county (direction, lane) and DFO
+class MatchIndex:
+    """
+    Sorted index of data2 on the matching keys and BEGINNING DFO. Sections of data1 are matched by a binary search 
+    of the DFO window within their route and county (and direction and lane), so matching costs time proportional to data1 (plus the matches), 
+    and new sections can be matched without matching the whole data again.
+
+    The key columns are encoded once into integer codes (values of data2), packed into one int64 key per row, 
+    so matching never hashes the strings of several columns together.
+    """
+    # DFO tolerance of a match (miles)
+    tol = 0.05
+
+    def __init__(self, data2 = None, lanes = False):
+        self.by = match_keys + (lane_keys if lanes else [])
+        self.levels = [pd.Index(pd.factorize(data2[col], use_na_sentinel = False)[1]) for col in self.by]
+        if np.prod([float(len(level)) for level in self.levels]) >= 2**62:
+            raise ValueError("Too many distinct values of "+", ".join(self.by)+" to pack the keys")
+        packed = self.pack(data2)
+        self.groups = np.unique(packed[packed >= 0])
+        codes = self.group_codes(packed)
+        begin = data2["BEGINNING DFO"].to_numpy(dtype = "float64", na_value = np.nan)
+        keep = np.flatnonzero((codes >= 0) & ~np.isnan(begin))
+
+        # One sort key: group code*span + (DFO - minimum), the DFO window of a code never reaches the next code
+        self.bmin = begin[keep].min() if keep.size else 0
+        self.span = (begin[keep].max() - self.bmin + 1 + 2*self.tol) if keep.size else 1
+        keys = codes[keep]*self.span + (begin[keep] - self.bmin)
+        order = np.argsort(keys, kind = "stable")
+        self.keys, self.rows = keys[order], keep[order]
+        self.begin = begin
+        self.end = data2["ENDING DFO"].to_numpy(dtype = "float64", na_value = np.nan)
+
+    def pack(self, data = None):
+        """int64 key of each row: mixed radix packing of the codes of the key columns, -1 when a value is not in data2."""
+        packed = np.zeros(data.shape[0], dtype = "int64")
+        valid = np.ones(data.shape[0], dtype = bool)
+        for col, level in zip(self.by, self.levels):
+            # Each distinct value is looked up once
+            codes, uniques = pd.factorize(data[col], use_na_sentinel = False)
+            codes = level.get_indexer(uniques)[codes]
+            valid &= codes >= 0
+            packed = packed*len(level) + codes
+        return np.where(valid, packed, -1)
+
+    def group_codes(self, packed = None):
+        """Position of the packed keys among the keys of data2 (dense codes), -1 when not found."""
+        codes = np.searchsorted(self.groups, packed)
+        found = (codes < self.groups.size) & (packed >= 0)
+        found[found] = self.groups[codes[found]] == packed[found]
+        return np.where(found, codes, -1)
+
+    def match(self, data1 = None, offset = 0):
+        """
+        Matches the sections of data1 (beginning and ending DFO within the tolerance, same route and county, and same direction and lane when lanes are matched).
+
+        Parameters:
+        - data1: Pandas DataFrame. The QC data (or new sections of it).
+        - offset: int. Added to the row positions of data1, e.g. the number of rows already appended.
+
+        Returns:
+        - idx1, idx2: numpy arrays. Paired row positions in data1 and data2, ordered by data1 then data2 rows.
+        """
+        codes = self.group_codes(self.pack(data1))
+        begin = data1["BEGINNING DFO"].to_numpy(dtype = "float64", na_value = np.nan)
+        end = data1["ENDING DFO"].to_numpy(dtype = "float64", na_value = np.nan)
+        rows = np.flatnonzero((codes >= 0) & ~np.isnan(begin))
+        keys = codes[rows]*self.span + (begin[rows] - self.bmin)
+        # Sorted queries keep the binary searches in cache (the pairs are ordered by data1 rows below)
+        order = np.argsort(keys, kind = "stable")
+        rows, keys = rows[order], keys[order]
+
+        # Candidate window of each row (slightly wider, the tolerance is checked on the DFO values below)
+        lo = np.searchsorted(self.keys, keys - 2*self.tol, "left")
+        hi = np.searchsorted(self.keys, keys + 2*self.tol, "right")
+        counts = hi - lo
+        idx1 = np.repeat(rows, counts)
+        idx2 = self.rows[np.repeat(lo - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())]
+
+        ok = (abs(begin[idx1] - self.begin[idx2]) < self.tol) & (abs(end[idx1] - self.end[idx2]) < self.tol)
+        idx1, idx2 = idx1[ok], idx2[ok]
+        order = np.lexsort((idx2, idx1))
+        return idx1[order] + offset, idx2[order]
+
+def match_suffixes(data1 = None, data2 = None, qctype = None):
+    """Suffixes of data1 and data2 columns: "_Pathway"/"_Audit", or the fiscal years for Year by year."""
+    if qctype == "Audit":
+        return ["_Pathway", "_Audit"]
+    if qctype == "Year by year": 
+        year1, year2 = data1["FISCAL YEAR"].unique()[0], data2["FISCAL YEAR"].unique()[0]
+        return ["_"+str(year1), "_"+str(year2)]
+
+# Segment lengths of the resegmentation (miles)
+segment_lengths = [0.5, 1.0, 2.0]
+
+def read_projects(data_path = None):
+    """Project limits (csv file, see resegment)."""
+    if hasattr(data_path, "seek"):
+        data_path.seek(0)
+    return pd.read_csv(data_path).rename(columns = str.strip)
+
+def resegment(data = None, length = None, projects = None, lanes = False):
+    """
+    Rolls the sections of each route (route and county, and direction and lane when lanes are matched) up to fixed-length segments 
+    or to project limits. Measures are SECTION LENGTH-weighted means of the sections within a segment (parts of a section count 
+    with the length inside the segment), other columns are the values of the first section of the segment.
+
+    Means come from sorted cumulative sums of value*length along each route: the integral up to any DFO is read with binary searches 
+    of the section beginnings and endings, so overlapping sections (e.g. both lanes when lanes are not matched) count with their part
+    inside the segment, segments of any length cost the same and no segment is processed on its own.
+
+    Parameters:
+    - data: Pandas DataFrame. Loaded data (see data_load).
+    - length: float, optional. Segment length (miles), segments start at multiples of the length on every route.
+    - projects: Pandas DataFrame, optional. Project limits instead of fixed segments: SIGNED HWY AND ROADBED ID, COUNTY, BEGINNING DFO 
+      and ENDING DFO (other columns, e.g. a project id, are added to the segments).
+    - lanes: bool. Roll up each direction and lane separately.
+
+    Returns:
+    - segments: Pandas DataFrame with the columns of data (SECTION LENGTH: length covered by sections), ready for data_match.
+    """
+    by = match_keys + (lane_keys if lanes else [])
+    begin = data["BEGINNING DFO"].to_numpy(dtype = "float64", na_value = np.nan)
+    end = data["ENDING DFO"].to_numpy(dtype = "float64", na_value = np.nan)
+    lo, hi = np.fmin(begin, end), np.fmax(begin, end)
+    groups = data.groupby(by, sort = False, dropna = False).ngroup().to_numpy()
+    rows = np.flatnonzero(hi > lo)
+    if not rows.size:
+        return data.iloc[:0]
+    order = rows[np.lexsort((lo[rows], groups[rows]))]
+    g, s, e = groups[order], lo[order], hi[order]
+    starts = np.flatnonzero(np.concatenate([[True], g[1:] != g[:-1]]))
+    gmin, gmax = np.minimum.reduceat(s, starts), np.maximum.reduceat(e, starts)
+
+    # Segments of each route: (route position, beginning, ending)
+    if projects is None:
+        first, last = np.floor(gmin/length).astype("int64"), np.ceil(gmax/length).astype("int64")
+        counts = last - first
+        wg = np.repeat(np.arange(starts.size), counts)
+        k = first[wg] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        wa, wb, extra = k*length, (k+1)*length, None
+    else:
+        routes = data.iloc[order[starts]][by].reset_index(drop = True).assign(_route = np.arange(starts.size))
+        limits = projects.rename(columns = str.strip)
+        extra = [x for x in limits.columns if x not in by+["BEGINNING DFO", "ENDING DFO"]]
+        limits = routes.merge(limits, on = match_keys, how = "inner")
+        wg = limits["_route"].to_numpy()
+        pa, pb = limits["BEGINNING DFO"].to_numpy(dtype = "float64"), limits["ENDING DFO"].to_numpy(dtype = "float64")
+        wa, wb = np.fmin(pa, pb), np.fmax(pa, pb)
+        extra = limits[extra].reset_index(drop = True)
+        length = 0
+
+    # One sorted key for all routes: route position*span + DFO (segments are clipped to the data of their route)
+    bmin = s.min()
+    span = e.max() - bmin + 1 + length
+    route = np.repeat(np.arange(starts.size), np.diff(np.append(starts, g.size)))
+    keys = route*span + (s - bmin)
+    end_keys = route*span + (e - bmin)
+    end_order = np.argsort(end_keys, kind = "stable")
+    end_keys = end_keys[end_order]
+
+    # Sections of a route can overlap (lanes, repeated runs). The integral of a rate up to a DFO q adds rate*(q - beginning) over the
+    # sections beginning before q and subtracts rate*(q - ending) over the sections ending before q, so partly covered sections are clipped.
+    # Sums are taken from the first section of the route, on the DFO relative to bmin.
+    def query(w):
+        base = wg*span
+        q = np.clip(w, gmin[wg], gmax[wg]) - bmin
+        return (q, np.searchsorted(keys, base + q, "right"), np.searchsorted(keys, base, "left"),
+                np.searchsorted(end_keys, base + q, "right"), np.searchsorted(end_keys, base, "left"))
+    queries = [query(wa), query(wb)]
+    s_local, e_local = s - bmin, (e - bmin)[end_order]
+
+    def integral(rate, queries):
+        # Integral of a rate (one value per section) between the segment limits
+        cum = [np.concatenate([[0], np.cumsum(x)]) for x in [rate, rate*s_local, rate[end_order], rate[end_order]*e_local]]
+        total = []
+        for q, i, i0, j, j0 in queries:
+            total.append(q*(cum[0][i] - cum[0][i0]) - (cum[1][i] - cum[1][i0]) - q*(cum[2][j] - cum[2][j0]) + (cum[3][j] - cum[3][j0]))
+        return total[1] - total[0]
+
+    # Covered length of the segments first: segments without sections (gaps of the route) are dropped before the measures
+    lengths = e - s
+    covered = integral(np.ones(lengths.size), queries)
+    keep = covered > 1e-9
+    queries = [tuple(x[keep] for x in q) for q in queries]
+    qa = wg[keep]*span + queries[0][0]
+
+    # Integrals of value*length and of the length with a value, divided: length-weighted means of the sections within each segment
+    items = [x for x in measure_cols if x in data.columns]
+    means = np.zeros((keep.sum(), len(items)))
+    for n, item in enumerate(items):
+        values = data[item].to_numpy(dtype = "float64", na_value = np.nan)[order]
+        valid = (~np.isnan(values)).astype("float64")
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            means[:, n] = integral(np.nan_to_num(values, nan = 0), queries)/integral(valid, queries)
+
+    # Other columns from the first section of the segment
+    i = np.searchsorted(keys, qa, "right") - 1
+    i = np.where((i < 0) | (e[np.maximum(i, 0)] - s[np.maximum(i, 0)] + keys[np.maximum(i, 0)] <= qa), i+1, i)
+    segments = data.iloc[order[np.minimum(i, order.size-1)]].reset_index(drop = True)
+    segments["BEGINNING DFO"], segments["ENDING DFO"] = wa[keep], wb[keep]
+    segments["SECTION LENGTH"] = covered[keep]
+    for n, item in enumerate(items):
+        segments[item] = means[:, n]
+    if extra is not None:
+        for col in extra.columns:
+            segments[col] = extra[col].to_numpy()[keep]
+    return segments
+
+# Function to match data1 and data2 based on routename and DFO
+def data_match(data1 = None, data2 = None, qctype = None, lanes = False):
+    """
+    Matches the sections of data1 and data2. The result does not depend on the selected measures.
+
+    Parameters:
+    - data1: Pandas DataFrame. The QC data.
+    - data2: Pandas DataFrame. The data to compare.
+    - qctype: str. The quality control type, "Audit" or "Year by year".
+    - lanes: bool. Also match the direction and lane number, so sections of different lanes are not paired.
+
+    Returns:
+    - suffixes: list. Suffixes of data1 and data2 columns.
+    - idx1, idx2: numpy arrays. Paired row positions in data1 and data2.
+    """
+    suffixes = match_suffixes(data1, data2, qctype)
+    idx1, idx2 = MatchIndex(data2, lanes).match(data1)
+    return suffixes, idx1, idx2
+
+def frame_digest(data = None):
+    """Hash of the columns and of every value of a DataFrame (all rows, so two datasets only share a digest when they are equal)."""
+    h = hashlib.sha1(str(list(data.columns)).encode()+str(data.shape).encode())
+    h.update(pd.util.hash_pandas_object(data, index = False).to_numpy().tobytes())
+    return h.hexdigest()
+
+class PairedView:
+    """
+    Matched sections of data1 and data2, held as two arrays of row positions instead of a merged DataFrame.
+
+    Columns are named as in a merged DataFrame: the columns of data1 and data2 with suffixes (e.g. "COUNTY_Pathway") 
+    and "diff_"+item for every measure. A column is gathered from data1/data2 (take) when it is first used and kept 
+    for reuse. Other columns can be added with view[name] = values.
+    """
+
+    def __init__(self, data1 = None, data2 = None, idx1 = None, idx2 = None, suffixes = None, key = None, cols = None):
+        self.data1, self.data2 = data1, data2
+        self.idx1, self.idx2 = np.asarray(idx1, dtype = "int64"), np.asarray(idx2, dtype = "int64")
+        self.suffixes = suffixes
+        self._cols = cols if cols is not None else dict()
+        self.key = key or self.fingerprint()
+
+    def fingerprint(self):
+        """Hash of all values of data1/data2 and of the row positions, the cache key of a view created without a lineage key."""
+        h = hashlib.sha1(str(self.suffixes).encode())
+        for data in [self.data1, self.data2]:
+            h.update(frame_digest(data).encode())
+        h.update(self.idx1.tobytes())
+        h.update(self.idx2.tobytes())
+        return h.hexdigest()
+
+    def __len__(self):
+        return self.idx1.size
+
+    @property
+    def shape(self):
+        return (len(self), len(self.columns))
+
+    @property
+    def columns(self):
+        columns = ([x+self.suffixes[0] for x in self.data1.columns] + [x+self.suffixes[1] for x in self.data2.columns] + 
+                   ["diff_"+x for x in measure_cols if (x in self.data1.columns) and (x in self.data2.columns)])
+        return columns + [x for x in self._cols if x not in columns]
+
+    def source(self, name):
+        """Returns the data, row positions and column of a suffixed column name."""
+        for data, idx, suffix in [(self.data1, self.idx1, self.suffixes[0]), (self.data2, self.idx2, self.suffixes[1])]:
+            if name.endswith(suffix) and name[:-len(suffix)] in data.columns:
+                return data, idx, name[:-len(suffix)]
+        raise KeyError(name)
+
+    def values(self, name):
+        if name not in self._cols:
+            if name.startswith("diff_"):
+                item = name[len("diff_"):]
+                self._cols[name] = (self[item+self.suffixes[0]].to_numpy(dtype = "float64", na_value = np.nan) - 
+                                    self[item+self.suffixes[1]].to_numpy(dtype = "float64", na_value = np.nan))
+            else:
+                data, idx, col = self.source(name)
+                self._cols[name] = data[col].array.take(idx)
+        return self._cols[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        if isinstance(name, list):
+            return self.frame(name)
+        return pd.Series(self.values(name), name = name)
+
+    def __setitem__(self, name, values):
+        values = values.array if hasattr(values, "array") else np.asarray(values)
+        if len(values) != len(self):
+            raise ValueError("Length of values does not match the view")
+        self._cols[name] = values
+
+    def take(self, positions):
+        """Returns the view of a subset of the rows (integer positions or boolean mask). Gathered columns are carried over."""
+        positions = np.asarray(positions)
+        positions = np.flatnonzero(positions) if positions.dtype == bool else positions.astype("int64")
+        key = hashlib.sha1((self.key).encode()+positions.tobytes()).hexdigest()
+        return PairedView(self.data1, self.data2, self.idx1[positions], self.idx2[positions], self.suffixes, key = key,
+                          cols = {name: values.take(positions) for name, values in self._cols.items()})
+
+    def compact(self):
+        """The same view (key and gathered columns) holding only its own rows of data1 and data2, small enough to send to a worker process."""
+        rows1, idx1 = np.unique(self.idx1, return_inverse = True)
+        rows2, idx2 = np.unique(self.idx2, return_inverse = True)
+        return PairedView(self.data1.iloc[rows1].reset_index(drop = True), self.data2.iloc[rows2].reset_index(drop = True), idx1, idx2,
+                          self.suffixes, key = self.key, cols = dict(self._cols))
+
+    def frame(self, columns = None):
+        """Gathers the columns (all columns by default) into a Pandas DataFrame."""
+        return pd.DataFrame({name: self.values(name) for name in (columns or self.columns)})
+
+# Function to merge data1 and data2 based on routename and DFO
+def data_merge(data1 = None, data2 = None, qctype = None, lanes = False): 
+    """
+    Matches data1 and data2 (see data_match) and returns the matched sections as a PairedView, 
+    no merged DataFrame is built.
+
+    Returns:
+    - suffixes: list. Suffixes of data1 and data2 columns.
+    - data: PairedView. The merged data.
+    """
+    suffixes, idx1, idx2 = data_match(data1 = data1, data2 = data2, qctype = qctype, lanes = lanes)
+    return suffixes, PairedView(data1, data2, idx1, idx2, suffixes)
+
+def scope_filter(data = None, scope = None, suffix = ""):
+    """
+    Filters the matched data based on the selected pavement type, district, county and route prefix. Used to narrow an already matched superset without loading and merging again.
+
+    Parameters:
+    - data: PairedView. The merged data to be filtered.
+    - scope: dict, optional. See scope_mask. Pavement type is checked on the QC data (first suffix) only.
+    - suffix: str. Suffix of the QC data columns.
+
+    Returns:
+    - data_v1: PairedView. The filtered data.
+    """
+    return data.take(scope_mask(data, scope, suffix))
+
+# filter function
+def thre_flag(data= None, thresholds = None, qctype = None):
+    """
+    Flags the sections outside the thresholds.
+
+    Parameters:
+    - data: PairedView. The merged data.
+    - thresholds: dict. Lower and upper thresholds of each measure.
+    - qctype: str. "Audit" (absolute difference >= upper threshold) or "Year by year" (difference <= lower or >= upper threshold).
+
+    Returns:
+    - flag: numpy array of bool.
+    """
+    flag = np.zeros(len(data), dtype = bool)
+    if qctype =="Audit":
+        for key in thresholds:
+            flag |= abs(data.values("diff_"+key))>=thresholds[key][1]
+    if qctype == "Year by year":
+        for key in thresholds:
+            flag |= (data.values("diff_"+key)>=thresholds[key][1])|(data.values("diff_"+key)<=thresholds[key][0])
+    return flag
+
+def thre_filter(data= None, thresholds = None, qctype = None):
+    """
+    Filters the data based on the specified thresholds and quality control type.
+
+    Parameters:
+    - data: PairedView. The input data to be filtered.
+    - thresholds: dict, optional. A dictionary containing the thresholds for each key. The keys are the column names in the data DataFrame and the values are tuples with the lower and upper thresholds. If not provided, the function will return the unfiltered data.
+    - qctype: str, optional. The quality control type. Possible values are "Audit" and "Year by year". If not provided, the function will return the unfiltered data.
+
+    Returns:
+    - data_v1: PairedView. The filtered data based on the specified thresholds and quality control type. If no data meets the thresholds, an empty view will be returned.
+    """
+    return data.take(thre_flag(data, thresholds, qctype))
+
+# Summary by district or county
+def summary_partials(data = None, suffixes = None, item_list = None):
+    """
+    Sums and counts behind the county and district summaries. Partials of separate parts of the data can be added (see summary_add), 
+    so the summary of appended data is updated without going over all the data again.
+
+    Parameters:
+    - data: PairedView. The merged data.
+    - suffixes: list. Suffixes of data1 and data2 columns.
+    - item_list: list. Measures to summarize.
+
+    Returns:
+    - partials: dict. For each side: sums and counts of the measures by county ("sum", "n") and by fiscal year ("year_sum", "year_n"), 
+      miles by county and ride traffic level ("traffic"). Also the number of matches by county of the QC data ("count").
+    """
+    cols = ["FISCAL YEAR", "COUNTY", "SECTION LENGTH", "RIDE SCORE TRAFFIC LEVEL"] + item_list
+    data1 = data[[x+suffix for suffix in suffixes for x in cols]]
+    partials = {"sum": [], "n": [], "year_sum": [], "year_n": [], "traffic": []}
+    for suffix in suffixes:
+        values = data1[[x+suffix for x in item_list]].set_axis(item_list, axis = 1)
+        for key, by in [("", "COUNTY"), ("year_", "FISCAL YEAR")]:
+            grouped = values.groupby(data1[by+suffix].rename(by))
+            partials[key+"sum"].append(grouped.sum())
+            partials[key+"n"].append(grouped.count())
+        partials["traffic"].append(data1.groupby(by = [data1["COUNTY"+suffix].rename("COUNTY"), data1["RIDE SCORE TRAFFIC LEVEL"+suffix].rename("RIDE SCORE TRAFFIC LEVEL")])["SECTION LENGTH"+suffix].sum())
+    partials["count"] = data1.groupby(data1["COUNTY"+suffixes[0]].rename("COUNTY")).size()
+    return partials
+
+def summary_add(partials = None, partials_new = None):
+    """Adds the summary partials of new data (see summary_partials)."""
+    if partials is None:
+        return partials_new
+    added = {key: [a.add(b, fill_value = 0) for a, b in zip(partials[key], partials_new[key])] for key in partials if key != "count"}
+    added["count"] = partials["count"].add(partials_new["count"], fill_value = 0).astype("int64")
+    return added
+
+def summary_table(partials = None, perf_indx = None, qctype = None, item_list = None, suffixes = None):
+    """
+    Builds the county (and for Year by year the district) summary from summary partials. See diff_summary.
+    """
+    # county level summary (only matched data records), means of each side
+    county_sum = []
+    for i, suffix in enumerate(suffixes):
+        county_mean = (partials["sum"][i][sorted(item_list)]/partials["n"][i][sorted(item_list)]).dropna(how = "all").reset_index()
+        county_mean["RATING CYCLE CODE"] = suffix[1:]
+        county_sum.append(county_mean)
+    county_sum = pd.concat(county_sum).reset_index(drop=True)
+
+    # Additional grouping by ride traffic level for IRI only
+    if "IRI" in perf_indx:
+        county_sum0 = []
+        for i, suffix in enumerate(suffixes):
+            traffic = partials["traffic"][i].rename("SECTION LENGTH").reset_index()
+            traffic["RATING CYCLE CODE"] = suffix[1:]
+            county_sum0.append(traffic.pivot(index=['COUNTY', "RATING CYCLE CODE"], 
+                                             columns='RIDE SCORE TRAFFIC LEVEL',
+                                             values="SECTION LENGTH").reset_index())
+        county_sum0 = pd.concat(county_sum0).reset_index(drop=True)
+        county_sum0 = county_sum0[["COUNTY", "RATING CYCLE CODE", "LOW", "MEDIUM", "HIGH"]].rename(columns = {"LOW":"LOW RIDE TRIFFIC MILES", 
+                                                                                                            "MEDIUM": "MEDIUM RIDE TRIFFIC MILES",
+                                                                                                            "HIGH": "HIGH RIDE TRIFFIC MILES"})
+        county_sum = county_sum.merge(county_sum0, on= ["COUNTY", "RATING CYCLE CODE"],
+                                      how = "left", left_index=False)
+
+    count_sum = partials["count"].reset_index(name = "count").sort_values(by = "COUNTY")
+    county_sum = county_sum.merge(count_sum, on = "COUNTY", how = "left")
+    county_sum= county_sum[["COUNTY", "RATING CYCLE CODE", "count"]+
+                           [x for x in county_sum.columns if x not in ["COUNTY", "RATING CYCLE CODE", "count"]]].rename(columns={"count": "Number of matching data"}).sort_values(by = ["COUNTY", "RATING CYCLE CODE"])
+
+    # District level, true when compare year by year
+    if qctype == "Year by year":
+        util_list = [x for x in item_list if "UTIL" in x]
+        dist_sum = []
+        for i in range(2):
+            dist_mean = (partials["year_sum"][i][sorted(util_list)]/partials["year_n"][i][sorted(util_list)]).dropna(how = "all")
+            dist_sum.append(dist_mean.rename_axis("RATING CYCLE CODE").reset_index())
+        dist_sum = pd.concat(dist_sum).reset_index(drop=True)
+        dist_sum = dist_sum[["RATING CYCLE CODE"]+util_list].sort_values(by = ["RATING CYCLE CODE"])
+        return dist_sum, county_sum
+    else:
+        return county_sum
+
+def diff_summary(data= None, perf_indx= None, qctype = None, item_list = None):
+    """
+        A function that generates a summary of the data based on the provided parameters.
+
+        Parameters:
+        - data (PairedView): The input data used for generating the summary.
+        - qctype (str): The type of quality control, which can be "Audit" or "Year by year".
+        - item_list (list): A list of items to include in the summary.
+
+        Returns:
+        - If qctype is "Year by year":
+        - dist_sum (pandas.DataFrame): The district-level summary of the data.
+        - county_sum (pandas.DataFrame): The county-level summary of the data.
+        - Otherwise:
+        - county_sum (pandas.DataFrame): The county-level summary of the data.
+    """
+    # prefix
+    if qctype == "Audit":
+        suffixes = ["_Pathway", "_Audit"]
+    if qctype == "Year by year": 
+        years = [x for x in data.columns if "FISCAL YEAR" in x]
+        suffixes = ["_"+str(years[0][-4:]), "_"+str(years[1][-4:])]
+    return summary_table(summary_partials(data, suffixes, item_list), perf_indx, qctype, item_list, suffixes)
+
+# Threshold sweep curves
+def sweep_curve(data = None, item = None, suffix = None, absolute = False):
+    """
+    Precomputes the number and miles of sections flagged by a measure as a function of its threshold, 
+    in total and by county and district, from the sorted diffs and cumulative sums of section length.
+
+    Parameters:
+    - data: PairedView. The merged data.
+    - item: str. The measure (its diff_ column is used).
+    - suffix: str. Suffix of the QC data columns (section length, county and district).
+    - absolute: bool. Use the absolute difference (Audit).
+
+    Returns:
+    - curve: dict. Sorted values ("values") and cumulative miles ("miles"), and for "COUNTY" and "RESPONSIBLE DISTRICT" 
+      the group names and the values sorted by group (see sweep_count).
+    """
+    values = data["diff_"+item].to_numpy(dtype = "float64")
+    values = abs(values) if absolute else values
+    keep = ~np.isnan(values)
+    values, length = values[keep], np.nan_to_num(data["SECTION LENGTH"+suffix].to_numpy(dtype = "float64")[keep])
+
+    order = np.argsort(values, kind = "stable")
+    curve = {"values": values[order], "miles": np.concatenate([[0], np.cumsum(length[order])])}
+
+    # Groups are sorted by (group, value) on one key: group code*span + (value - vmin)
+    curve["vmin"] = values.min() if values.size else 0
+    curve["span"] = (values.max() - curve["vmin"] + 1) if values.size else 1
+    for group in ["COUNTY", "RESPONSIBLE DISTRICT"]:
+        codes, names = pd.factorize(data[group+suffix].to_numpy()[keep])
+        keys = codes*curve["span"] + (values - curve["vmin"])
+        order = np.argsort(keys, kind = "stable")
+        counts = np.bincount(codes, minlength = len(names))
+        curve[group] = {"names": np.asarray(names), "keys": keys[order], 
+                        "miles": np.concatenate([[0], np.cumsum(length[order])]),
+                        "start": np.cumsum(counts) - counts, "end": np.cumsum(counts)}
+    return curve
+
+def sweep_count(curve = None, lower = -np.inf, upper = np.inf, group = None):
+    """
+    Looks up the sections with value <= lower or value >= upper on a sweep curve, without scanning the data.
+
+    Parameters:
+    - curve: dict. See sweep_curve.
+    - lower, upper: float. Thresholds.
+    - group: str, optional. "COUNTY" or "RESPONSIBLE DISTRICT".
+
+    Returns:
+    - If group is not provided: number and miles of flagged sections.
+    - Otherwise: Pandas DataFrame with the number and miles of flagged sections by group.
+    """
+    if group is None:
+        i_lo = np.searchsorted(curve["values"], lower, "right")
+        i_hi = max(np.searchsorted(curve["values"], upper, "left"), i_lo)
+        return int(i_lo + curve["values"].size - i_hi), curve["miles"][i_lo] + curve["miles"][-1] - curve["miles"][i_hi]
+
+    g = curve[group]
+    base = np.arange(g["names"].size)*curve["span"]
+    i_lo = np.searchsorted(g["keys"], base + np.clip(lower - curve["vmin"], -0.5, curve["span"]-0.5), "right")
+    i_hi = np.maximum(np.searchsorted(g["keys"], base + np.clip(upper - curve["vmin"], -0.5, curve["span"]-0.5), "left"), i_lo)
+    return pd.DataFrame({group: g["names"], 
+                         "count_out": (i_lo - g["start"]) + (g["end"] - i_hi),
+                         "miles_out": (g["miles"][i_lo] - g["miles"][g["start"]]) + (g["miles"][g["end"]] - g["miles"][i_hi]),
+                         "count_all": g["end"] - g["start"]})
+
+def sweep_quantile(curve = None, q = None):
+    """Percentiles q (list) of the curve values, read from the sorted values (same as np.nanpercentile)."""
+    values = curve["values"]
+    if values.size == 0:
+        return np.full(len(q), np.nan)
+    pos = np.asarray(q, dtype = "float64")/100*(values.size-1)
+    lo = np.floor(pos).astype("int64")
+    hi = np.minimum(lo+1, values.size-1)
+    return values[lo] + (pos-lo)*(values[hi]-values[lo])
+
+# Row order of the filtered data table (search and sort run on the server)
+def table_order(data = None, sort_col = None, ascending = True, search_col = None, search_text = None):
+    """
+    Computes the row positions of the table view after searching and sorting.
+
+    Parameters:
+    - data: PairedView or Pandas DataFrame. The data shown in the table.
+    - sort_col: str, optional. The column used to sort the rows. If not provided, the original order is kept.
+    - ascending: bool. Sorting direction.
+    - search_col: str, optional. The column searched for search_text.
+    - search_text: str, optional. Case-insensitive text that the search column must contain.
+
+    Returns:
+    - order: numpy array. Positions of the matching rows in display order.
+    """
+    mask = np.ones(data.shape[0], dtype = bool)
+    if search_col and search_text:
+        mask = data[search_col].astype("str").str.contains(search_text, case = False, regex = False).to_numpy()
+
+    if sort_col:
+        values = data[sort_col].reset_index(drop = True)[mask]
+        return values.sort_values(ascending = ascending, kind = "stable", na_position = "last").index.to_numpy()
+    return np.flatnonzero(mask)
+
+def table_page(data = None, order = None, columns = None, page = 1, page_size = 100):
+    """
+    Returns one page of the table view. Only the rows and columns of the page are gathered, so the cost does not depend on the number of rows.
+
+    Parameters:
+    - data: PairedView or Pandas DataFrame. The data shown in the table.
+    - order: numpy array. Row positions in display order (see table_order).
+    - columns: list. Columns to show.
+    - page: int. Page number starting from 1.
+    - page_size: int. Number of rows per page.
+
+    Returns:
+    - Pandas DataFrame with the rows of the requested page.
+    """
+    start = (page-1)*page_size
+    return data.take(order[start:start+page_size])[columns]
+
+# Time bucket granularities and their lengths
+time_units = {"hour": pd.Timedelta(hours = 1), "day": pd.Timedelta(days = 1), "week": pd.Timedelta(weeks = 1)}
+
+def time_bucket(values = None, freq = "day"):
+    """
+    Buckets times or time differences at a granularity.
+
+    Parameters:
+    - values: Pandas Series of datetimes (e.g. START TIME) or timedeltas (e.g. time_diff).
+    - freq: str. "hour", "day" or "week".
+
+    Returns:
+    - buckets: Pandas Series. Datetimes are floored to the start of the hour, day or week (weeks start on Monday),
+      time differences are converted to a whole number of hours, days or weeks (rounded down).
+    """
+    if pd.api.types.is_timedelta64_dtype(values):
+        return values // time_units[freq]
+    if freq == "week":
+        day = values.dt.floor("D")
+        return day - pd.to_timedelta(day.dt.dayofweek, unit = "D")
+    return values.dt.floor("h" if freq == "hour" else "D")
+
+# Breakdown of the outliers by a variable
+def group_counts(data = None, by = None, suffixes = None, paired = False, freq = None, name = "all"):
+    """
+    Counts the sections (number and miles) by the values of a variable. See breakdown for the parameters.
+
+    Returns:
+    - df: Pandas DataFrame with columns by, "count_"+name and "miles_"+name.
+    """
+    if paired:
+        key = data[by+suffixes[0]].astype("str")+"-"+data[by+suffixes[1]].astype("str")
+    else:
+        key = data[by+suffixes[0]] if by+suffixes[0] in data.columns else data[by]
+    if freq:
+        key = time_bucket(key, freq)
+    df_temp = pd.DataFrame({by: key.values, "miles": data["SECTION LENGTH"+suffixes[0]].to_numpy()})
+    return df_temp.groupby(by = by).agg(**{"count_"+name: (by, "count"), "miles_"+name: ("miles", "sum")}).reset_index()
+
+def breakdown(data = None, data_out = None, by = None, suffixes = None, paired = False, sort = True, freq = None):
+    """
+    Counts the outliers and all matched sections (number and miles) by a variable.
+
+    Parameters:
+    - data: PairedView. All matched data.
+    - data_out: PairedView. The outliers (filtered data).
+    - by: str. The variable, without suffix. Columns that are not suffixed (e.g. bins added to both data) are used as they are.
+    - suffixes: list. Suffixes of data1 and data2 columns. Section length is taken from the first one.
+    - paired: bool. Group by the values of both data, e.g. "1-2" for LANE NUMBER.
+    - sort: bool. Sort by the number of outliers.
+    - freq: str, optional. Bucket a time variable (or time difference) by "hour", "day" or "week", see time_bucket.
+
+    Returns:
+    - df: Pandas DataFrame with columns by, count_out, miles_out, count_all, miles_all and "Percentage of all".
+    """
+    df = group_counts(data_out, by, suffixes, paired, freq, "out").merge(group_counts(data, by, suffixes, paired, freq, "all"), how = "left", on = by)
+    df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
+    if sort:
+        df = df.sort_values(by = "count_out", ascending = False)
+    return df
+
+def top_groups(df = None, by = None, k = 25, rank = "count_out", page = 1, total = None):
+    """
+    Returns one page of the groups of a breakdown ranked by outliers, with the groups of earlier pages and the groups ranked below the page
+    rolled into one row each. Only the groups up to the requested page are ranked (partial selection), the others are not sorted.
+
+    Parameters:
+    - df: Pandas DataFrame. Result of breakdown.
+    - by: str. The variable of the breakdown.
+    - k: int. Number of groups per page.
+    - rank: str. "count_out", "miles_out" or "Percentage of all".
+    - page: int. Page number starting from 1.
+    - total: tuple, optional. Number and miles of all matched sections, so the "Others" row also counts groups without outliers.
+
+    Returns:
+    - df_page: Pandas DataFrame with a "Higher ranked" row for the groups of earlier pages (from page 2), the groups of the page (highest first)
+      and an "Others" row for the groups ranked below the page.
+    - n_pages: int. Number of pages.
+    """
+    values = df[rank].to_numpy(dtype = float)
+    values = np.where(np.isnan(values), -np.inf, values)
+    n_pages = max(1, -(-len(values)//k))
+    page = min(max(1, page), n_pages)
+    end = min(page*k, len(values))
+
+    # Partial selection of the top groups up to the end of the page, then sort only those
+    top = np.argpartition(-values, end-1)[:end] if end < len(values) else np.arange(len(values))
+    top = top[np.argsort(-values[top], kind = "stable")]
+    df_page, df_higher = df.iloc[top[(page-1)*k:end]], df.iloc[top[:(page-1)*k]]
+
+    def rolled(label, count_out, miles_out, count_all, miles_all):
+        row = {by: label, "count_out": int(count_out), "miles_out": miles_out, "count_all": int(count_all), "miles_all": miles_all}
+        row["Percentage of all"] = 100*count_out/count_all if count_all else 0
+        return row
+
+    count_all, miles_all = total if total is not None else (df["count_all"].sum(), df["miles_all"].sum())
+    # Groups below the page: all sections less the ranked groups
+    rest = [df["count_out"].sum(), df["miles_out"].sum(), count_all, miles_all]
+    ranked = df.iloc[top][["count_out", "miles_out", "count_all", "miles_all"]].sum().to_numpy()
+    others = rolled("Others ("+str(len(values)-end)+")", *(np.array(rest, dtype = float)-ranked))
+    df_page = df_page.astype({by: "object"})
+    if len(df_higher):
+        higher = rolled("Higher ranked ("+str(len(df_higher))+")", *[df_higher[col].sum() for col in ["count_out", "miles_out", "count_all", "miles_all"]])
+        df_page = pd.concat([pd.DataFrame([higher]), df_page], ignore_index = True)
+    if end < len(values) or others["count_all"]:
+        df_page = pd.concat([df_page, pd.DataFrame([others])], ignore_index = True)
+    return df_page, n_pages
+
+def outlier_timeline(data = None, data_out = None, by = "VEHICLE ID", suffixes = None, freq = "day"):
+    """
+    Outlier rate over time for each value of a variable, e.g. per collection day and vehicle.
+
+    Parameters:
+    - data: PairedView. All matched data.
+    - data_out: PairedView. The outliers (filtered data).
+    - by: str. The variable, without suffix.
+    - suffixes: list. Suffixes of data1 and data2 columns. START TIME, the variable and section length are taken from the first one.
+    - freq: str. "hour", "day" or "week".
+
+    Returns:
+    - df: Pandas DataFrame with columns START TIME, by, count_out, miles_out, count_all, miles_all and "Percentage of all",
+      sorted by time. Buckets without outliers are kept with zero counts.
+    """
+    def group(df, name):
+        df_temp = pd.DataFrame({"START TIME": time_bucket(df["START TIME"+suffixes[0]], freq).to_numpy(),
+                                by: df[by+suffixes[0]].to_numpy(),
+                                "miles": df["SECTION LENGTH"+suffixes[0]].to_numpy()})
+        return df_temp.groupby(by = ["START TIME", by]).agg(**{"count_"+name: ("miles", "size"), "miles_"+name: ("miles", "sum")}).reset_index()
+
+    df = group(data, "all").merge(group(data_out, "out"), how = "left", on = ["START TIME", by])
+    df[["count_out", "miles_out"]] = df[["count_out", "miles_out"]].fillna(0)
+    df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
+    return df[["START TIME", by, "count_out", "miles_out", "count_all", "miles_all", "Percentage of all"]].sort_values(by = ["START TIME", by])
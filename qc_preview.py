@@ -0,0 +1,227 @@
+"""
+Preview of a comparison from a stratified sample of the QC data, shown while the exact loading and merging runs in the background.
+
+The sample is drawn while the csv files are read (one pass, only the columns the preview needs): every row gets a random key and
+each stratum (county and pavement type) keeps the rows with the smallest keys, a simple random sample of the stratum. Only the rows
+of the data to compare that match a sampled section are kept, so the sampled sections are matched exactly as in the full data.
+Means and outlier shares (by county, district, route and measure) are stratified ratio estimates, with 95% confidence intervals.
+"""
+import pandas as pd
+import numpy as np
+
+from qc_pipeline import (csv_sources, unify_columns, scope_mask, prepare_data, heading_cols, MatchIndex, match_keys, lane_keys,
+                         match_suffixes, PairedView)
+
+
+# Strata of the sample and number of sampled sections per stratum
+strata_cols = ["COUNTY", "MODIFIED BROAD PAVEMENT TYPE"]
+preview_k = 200
+
+def preview_cols(item_list = None):
+    """Columns read for the preview."""
+    cols = heading_cols + match_keys + lane_keys + strata_cols + ["START TIME", "RIDE SCORE TRAFFIC LEVEL"] + list(item_list or [])
+    return list(dict.fromkeys(cols))
+
+def read_chunks(data_path = None, scope = None, usecols = None, chunksize = 200000):
+    """Chunks of the csv files of one side (see csv_sources) within the scope, with the columns in usecols only."""
+    for name, open_source in csv_sources(data_path):
+        with open_source() as f:
+            if hasattr(f, "seek"):
+                f.seek(0)
+            for chunk in pd.read_csv(f, chunksize = chunksize, low_memory = False, usecols = lambda x: x.strip() in usecols):
+                chunk = unify_columns(chunk)
+                yield chunk.loc[scope_mask(chunk, scope)]
+
+def stratum_labels(data = None):
+    return data[strata_cols[0]].astype("string").fillna("")+" | "+data[strata_cols[1]].astype("string").fillna("")
+
+def read_sample(data_path = None, scope = None, usecols = None, k = preview_k, seed = 0):
+    """
+    Stratified sample of the QC data, drawn while the files are read.
+
+    Returns:
+    - sample: Pandas DataFrame. Sampled rows, with the column "STRATUM".
+    - population: Pandas Series. Number of rows of each stratum.
+    """
+    rng = np.random.default_rng(seed)
+    sample, population = None, pd.Series(dtype = "int64")
+    for chunk in read_chunks(data_path, scope, usecols):
+        chunk = chunk.assign(STRATUM = stratum_labels(chunk).to_numpy(), **{"SAMPLE KEY": rng.random(chunk.shape[0])})
+        population = population.add(chunk["STRATUM"].value_counts(), fill_value = 0).astype("int64")
+        if sample is not None:
+            # Rows above the largest kept key of a full stratum can not enter the sample
+            kept = sample.groupby("STRATUM")["SAMPLE KEY"].agg(["max", "size"])
+            limit = kept["max"].where(kept["size"] >= k, 1.0)
+            chunk = chunk[chunk["SAMPLE KEY"].to_numpy() < chunk["STRATUM"].map(limit).fillna(1.0).to_numpy()]
+        sample = chunk if sample is None else pd.concat([sample, chunk], ignore_index = True)
+        sample = sample.sort_values(by = ["STRATUM", "SAMPLE KEY"])
+        sample = sample[sample.groupby("STRATUM").cumcount().to_numpy() < k]
+    if sample is None:
+        raise ValueError("No rows within the selected scope")
+    return sample.drop(columns = "SAMPLE KEY").reset_index(drop = True), population
+
+def read_matching(data_path = None, scope = None, usecols = None, index = None):
+    """Rows of the data to compare that match a sampled section (index: MatchIndex of the sample)."""
+    parts = []
+    for chunk in read_chunks(data_path, scope, usecols):
+        rows, _ = index.match(chunk)
+        parts.append(chunk.iloc[np.unique(rows)])
+    return pd.concat(parts, ignore_index = True)
+
+
+class QCPreview:
+    """
+    Sampled sections of the QC data and their matches. Estimates are computed per sampled section of the QC data
+    (sums over its matches), so sections without a match are part of the estimates like in the full data.
+    """
+
+    def __init__(self, data1 = None, data2 = None, population = None, qctype = None, lanes = False):
+        self.qctype = qctype
+        self.suffixes = match_suffixes(data1, data2, qctype)
+        idx1, idx2 = MatchIndex(data2, lanes).match(data1)
+        self.view = PairedView(data1, data2, idx1, idx2, self.suffixes)
+        self.n1 = data1.shape[0]
+
+        # Stratum of each sampled section, sampled and population sizes of the strata
+        self.stratum, labels = pd.factorize(data1["STRATUM"])
+        self.n_h = np.bincount(self.stratum, minlength = len(labels)).astype("float64")
+        self.N_h = population.reindex(labels).to_numpy(dtype = "float64")
+        self.weight = (self.N_h/self.n_h)[self.stratum]
+
+    @classmethod
+    def load(cls, data1_path = None, data2_path = None, scope = None, qctype = None, lanes = False, item_list = None, k = preview_k, seed = 0):
+        """
+        Reads the sample of the QC data and its matches in the data to compare (same scope as data_load).
+
+        Returns:
+        - preview: QCPreview.
+        """
+        usecols = preview_cols(item_list)
+        scope2 = {key: value for key, value in (scope or {}).items() if key != "MODIFIED BROAD PAVEMENT TYPE"}
+        sample, population = read_sample(data1_path, scope, usecols, k, seed)
+        data1 = prepare_data(sample)
+        data2 = prepare_data(read_matching(data2_path, scope2, usecols, MatchIndex(data1, lanes)))
+        return cls(data1, data2, population, qctype, lanes)
+
+    @property
+    def sections(self):
+        return self.n1
+
+    def pair_weights(self):
+        """Weight of each matched pair (population rows represented by its sampled section)."""
+        return self.weight[self.view.idx1]
+
+    def estimate(self, pair_values = None, pair_valid = None, by = "COUNTY"):
+        """
+        Stratified ratio estimate of the mean of pair_values over the valid pairs of each group (by: column of the QC data, None for
+        all sections), with its 95% confidence interval.
+
+        Returns:
+        - df: Pandas DataFrame. by, "estimate", "ci" (half width), "pairs" (estimated number of valid pairs) and "sampled".
+        """
+        valid = pair_valid & ~np.isnan(pair_values)
+        a = np.bincount(self.view.idx1, weights = np.where(valid, pair_values, 0), minlength = self.n1)
+        b = np.bincount(self.view.idx1, weights = valid.astype("float64"), minlength = self.n1)
+        if by is None:
+            groups, names = np.zeros(self.n1, dtype = "int64"), pd.Index(["All"])
+        else:
+            groups, names = pd.factorize(self.view.data1[by], sort = True)
+        n_groups = len(names)
+        keep = groups >= 0
+        x = np.bincount(groups[keep], weights = (self.weight*b)[keep], minlength = n_groups)
+        y = np.bincount(groups[keep], weights = (self.weight*a)[keep], minlength = n_groups)
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            ratio = y/x
+            # Linearized ratio: residuals of the sampled sections of the group (0 outside the group), variance of their stratum totals.
+            # Groups can cut across strata (routes), so the sums are taken by stratum and group.
+            e = np.where(keep, a - np.nan_to_num(ratio)[np.maximum(groups, 0)]*b, 0)
+            cell, h_g = np.unique(self.stratum[keep]*n_groups + groups[keep], return_inverse = True)
+            s1 = np.bincount(h_g, weights = e[keep], minlength = cell.size)
+            s2 = np.bincount(h_g, weights = e[keep]**2, minlength = cell.size)
+            h, g = cell//n_groups, cell % n_groups
+            n_h, N_h = self.n_h[h], self.N_h[h]
+            var_hg = np.where(n_h > 1, (s2 - s1**2/n_h)/(n_h-1), 0)
+            var_hg = N_h**2*(1 - n_h/N_h)*var_hg/n_h
+            var = np.bincount(g, weights = var_hg, minlength = n_groups)/x**2
+        return pd.DataFrame({by or "Group": names, "estimate": ratio, "ci": 1.96*np.sqrt(var), "pairs": x,
+                             "sampled": np.bincount(groups[keep], minlength = n_groups)})
+
+    def summary(self, item_list = None, by = "COUNTY"):
+        """
+        Estimated means of each side and of the differences by county (or district), with 95% confidence intervals (see estimate).
+
+        Returns:
+        - df: Pandas DataFrame.
+        """
+        tables = []
+        valid = np.ones(len(self.view), dtype = bool)
+        for item in item_list:
+            table = None
+            for name in [item+self.suffixes[0], item+self.suffixes[1], "diff_"+item]:
+                df = self.estimate(self.view.values(name), valid, by)
+                label = name.replace(item, "Mean") if name != "diff_"+item else "Mean diff"
+                df = df.rename(columns = {"estimate": label, "ci": label+" ±"})
+                table = df if table is None else table.merge(df[[by, label, label+" ±"]], on = by)
+            tables.append(table.assign(Measure = item))
+        if not tables:
+            return pd.DataFrame(columns = [by, "Measure", "Sampled sections", "Estimated matches"])
+        df = pd.concat(tables, ignore_index = True).rename(columns = {"pairs": "Estimated matches", "sampled": "Sampled sections"})
+        first = [by, "Measure", "Sampled sections", "Estimated matches"]
+        return df[first+[x for x in df.columns if x not in first]]
+
+    def diffs(self, item = None):
+        """Differences of a measure and the weights of the pairs (for weighted distribution plots)."""
+        return self.view.values("diff_"+item), self.pair_weights()
+
+    def thresholds(self, item_list = None):
+        """Default thresholds of the filter (percentile identifier) from weighted quantiles of the sample."""
+        thresholds = dict()
+        for item in [x for x in item_list if "UTIL" not in x]:
+            values, weights = self.diffs(item)
+            if self.qctype == "Audit":
+                thresholds[item] = [0, weighted_quantile(np.abs(values), weights, [95])[0]]
+            else:
+                thresholds[item] = list(weighted_quantile(values, weights, [2.5, 97.5]))
+        return thresholds
+
+    def flags(self, thresholds = None):
+        """Outlier flags of the matched pairs by measure (see thre_flag)."""
+        flags = dict()
+        for item, (lower, upper) in thresholds.items():
+            diff = self.view.values("diff_"+item)
+            flags[item] = (np.abs(diff) >= upper) if self.qctype == "Audit" else ((diff >= upper) | (diff <= lower))
+        return flags
+
+    def outlier_share(self, flag = None, by = "COUNTY"):
+        """Estimated share (in %) and number of flagged pairs by group, see estimate."""
+        df = self.estimate(flag.astype("float64")*100, np.ones(len(self.view), dtype = bool), by)
+        df = df.rename(columns = {"estimate": "Percentage of all", "ci": "Percentage of all ±", "pairs": "Estimated matches",
+                                  "sampled": "Sampled sections"})
+        df["Estimated outliers"] = df["Percentage of all"]/100*df["Estimated matches"]
+        return df
+
+    def outliers(self, thresholds = None, by = "COUNTY"):
+        """
+        Estimated share of outliers (see thre_flag) by a column of the QC data (county, district or route), in %, with 95% confidence 
+        intervals, and the estimated number of outliers.
+        """
+        flags = self.flags(thresholds)
+        flag = np.logical_or.reduce(list(flags.values())) if flags else np.zeros(len(self.view), dtype = bool)
+        return self.outlier_share(flag, by)
+
+    def measure_outliers(self, thresholds = None):
+        """Estimated share of outliers of each measure alone (all sampled sections), see outliers."""
+        tables = [self.outlier_share(flag, None).drop(columns = "Group").assign(Measure = item) for item, flag in self.flags(thresholds).items()]
+        df = pd.concat(tables, ignore_index = True) if tables else pd.DataFrame(columns = ["Measure"])
+        return df[["Measure"]+[x for x in df.columns if x != "Measure"]]
+
+
+def weighted_quantile(values = None, weights = None, q = None):
+    """Percentiles q (list) of weighted values (NaN values are left out)."""
+    keep = ~np.isnan(values)
+    values, weights = values[keep], weights[keep]
+    if not values.size:
+        return np.full(len(q), np.nan)
+    order = np.argsort(values)
+    cum = np.cumsum(weights[order])
+    return np.interp(np.asarray(q, dtype = "float64")/100*cum[-1], cum, values[order])
@@ -0,0 +1,107 @@
+"""
+Longitudinal profile of a route: a measure of both sides of the comparison along the DFO, with the flagged sections.
+
+RouteIndex sorts the matched sections once (when the data is merged) by route and DFO, each side by its own BEGINNING DFO,
+so the sections of a route are one slice of a sorted array and a referencing shift between the sides shows in the profile.
+Profiles are downsampled to the minimum and maximum of each pixel bucket of the DFO, so spikes are kept and a profile
+never has more than two points per bucket, whatever the length of the route.
+"""
+import pandas as pd
+import numpy as np
+
+
+# Number of DFO buckets of a profile (about one per pixel of the plot)
+profile_buckets = 1000
+
+class RouteIndex:
+    """
+    Row positions of a PairedView sorted by route (SIGNED HWY AND ROADBED ID of the QC data) and BEGINNING DFO of each side.
+    """
+
+    def __init__(self, data = None):
+        self.key, self.suffixes = data.key, data.suffixes
+        codes, names = pd.factorize(data.values("SIGNED HWY AND ROADBED ID"+data.suffixes[0]), sort = True)
+        self.names = np.asarray(names, dtype = "object")
+        rows = np.flatnonzero(codes >= 0)
+        counts = np.bincount(codes[rows], minlength = len(names))
+        self.start, self.end = np.cumsum(counts) - counts, np.cumsum(counts)
+        self.order = []
+        for suffix in data.suffixes:
+            dfo = data["BEGINNING DFO"+suffix].to_numpy(dtype = "float64", na_value = np.nan)
+            self.order.append(rows[np.lexsort((dfo[rows], codes[rows]))])
+
+    def routes(self, data_out = None):
+        """
+        Routes sorted by their number of flagged sections (data_out: the filtered data, a subset of the indexed data), then by name.
+
+        Returns:
+        - df: Pandas DataFrame. "route", "sections" and "flagged".
+        """
+        flagged = np.zeros(self.names.size, dtype = "int64")
+        if data_out is not None and len(data_out):
+            codes = pd.Index(self.names).get_indexer(data_out.values("SIGNED HWY AND ROADBED ID"+self.suffixes[0]))
+            flagged = np.bincount(codes[codes >= 0], minlength = self.names.size)
+        df = pd.DataFrame({"route": self.names, "sections": self.end - self.start, "flagged": flagged})
+        return df.sort_values(by = ["flagged", "route"], ascending = [False, True], kind = "stable").reset_index(drop = True)
+
+    def positions(self, route = None, side = 0):
+        """Row positions of the sections of a route, sorted by the BEGINNING DFO of a side (0: QC data, 1: data to compare)."""
+        code = np.searchsorted(self.names, route)
+        if code >= self.names.size or self.names[code] != route:
+            return np.zeros(0, dtype = "int64")
+        return self.order[side][self.start[code]:self.end[code]]
+
+def bucket_extremes(x = None, y = None, buckets = profile_buckets):
+    """
+    Downsampling of a profile sorted by x: positions of the minimum and maximum of y in each of the equal-width buckets of x
+    (NaN values are left out), in the order of x.
+
+    Returns:
+    - positions: numpy array of int.
+    """
+    keep = np.flatnonzero(~(np.isnan(x) | np.isnan(y)))
+    if keep.size <= 2*buckets:
+        return keep
+    x0, x1 = x[keep[0]], x[keep[-1]]
+    bucket = np.minimum(((x[keep] - x0)/max(x1 - x0, 1e-12)*buckets).astype("int64"), buckets-1)
+    # Sorted by bucket then value: the first and last row of a bucket are its minimum and maximum
+    sort = np.lexsort((y[keep], bucket))
+    order, b = keep[sort], bucket[sort]
+    first = np.flatnonzero(np.concatenate([[True], b[1:] != b[:-1]]))
+    last = np.append(first[1:], b.size) - 1
+    return np.unique(np.concatenate([order[first], order[last]]))
+
+def route_profile(data = None, index = None, route = None, item = None, data_out = None, buckets = profile_buckets):
+    """
+    Profile of a measure along a route, for both sides of the comparison.
+
+    Parameters:
+    - data: PairedView. The merged data (indexed by index).
+    - index: RouteIndex. Index of data.
+    - route: str. SIGNED HWY AND ROADBED ID.
+    - item: str. The measure.
+    - data_out: PairedView, optional. The filtered data, its sections on the route are highlighted.
+    - buckets: int. Number of DFO buckets of the downsampling.
+
+    Returns:
+    - profile: dict. For each suffix, "dfo" and "value" of the downsampled profile and "sections" (number before downsampling);
+      "flagged": the same for the QC data of the flagged sections of the route.
+    """
+    profile = {}
+    for side, suffix in enumerate(data.suffixes):
+        route_data = data.take(index.positions(route, side))
+        dfo = route_data["BEGINNING DFO"+suffix].to_numpy(dtype = "float64", na_value = np.nan)
+        value = pd.to_numeric(route_data[item+suffix], errors = "coerce").to_numpy(dtype = "float64", na_value = np.nan)
+        keep = bucket_extremes(dfo, value, buckets)
+        profile[suffix] = {"dfo": dfo[keep], "value": value[keep], "sections": dfo.size}
+
+    profile["flagged"] = {"dfo": np.zeros(0), "value": np.zeros(0), "sections": 0}
+    if data_out is not None and len(data_out):
+        flagged = data_out.take((data_out["SIGNED HWY AND ROADBED ID"+data.suffixes[0]] == route).to_numpy(dtype = bool, na_value = False))
+        dfo = flagged["BEGINNING DFO"+data.suffixes[0]].to_numpy(dtype = "float64", na_value = np.nan)
+        value = pd.to_numeric(flagged[item+data.suffixes[0]], errors = "coerce").to_numpy(dtype = "float64", na_value = np.nan)
+        # Flagged sections are downsampled the same way (a route can have many of them)
+        order = np.argsort(dfo, kind = "stable")
+        keep = order[bucket_extremes(dfo[order], value[order], buckets)]
+        profile["flagged"] = {"dfo": dfo[keep], "value": value[keep], "sections": dfo.size}
+    return profile
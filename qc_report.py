@@ -0,0 +1,173 @@
+"""
+District QC reports: county summary, distribution plots and outlier breakdowns of each district, as HTML or PDF files.
+
+Each district is one task of a process pool: the main process only splits the matched data by district (a compact view of the rows
+of the district, see PairedView.compact), the worker computes the summary and breakdowns through the disk store (see qc_store.py),
+renders the figures and writes the file. Whether figures can be rendered as images is checked once, in the main process.
+
+Optional dependencies: kaleido renders the figures as static images (otherwise the HTML reports embed interactive plots),
+PDF reports need kaleido and weasyprint.
+"""
+import base64
+import html
+import importlib.util
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import qc_pipeline
+from qc_catalog import perf_indx_list
+from qc_charts import distribution_figure, breakdown_figure
+from qc_store import store
+
+
+# Outlier breakdowns of the reports: (variable, paired, label)
+report_breakdowns = [("COUNTY", False, "COUNTY"), ("SIGNED HWY AND ROADBED ID", False, "HIGHWAY ID"), ("LANE NUMBER", True, "Lane"),
+                     ("DIRECTION", True, "Direction"), ("VEHICLE ID", True, "Vehicle")]
+
+# Number of routes shown in the route breakdown (the others are rolled into one bar)
+report_routes = 25
+
+# Same stages (and keys) as the app
+diff_summary = store.memo("summary", qc_pipeline.diff_summary)
+breakdown = store.memo("breakdown", qc_pipeline.breakdown)
+
+
+def report_payload(data = None, data_out = None, district = None, qctype = None, perf_indx = None, item_list = None, suffixes = None, thresholds = None):
+    """
+    Tables and differences of one district, everything the report of the district needs.
+
+    Parameters:
+    - data: PairedView. All matched data.
+    - data_out: PairedView. The outliers (filtered data).
+    - district: str. The district (RESPONSIBLE DISTRICT of the QC data).
+    - qctype, perf_indx, item_list, suffixes: see diff_summary and breakdown.
+    - thresholds: dict, optional. The thresholds of the filter, listed in the report.
+
+    Returns:
+    - payload: dict.
+    """
+    scope = {"RESPONSIBLE DISTRICT": [district]}
+    data_d = qc_pipeline.scope_filter(data, scope, suffixes[0])
+    out_d = qc_pipeline.scope_filter(data_out, scope, suffixes[0])
+    return district_payload(data_d, out_d, district, qctype, perf_indx, item_list, suffixes, thresholds)
+
+def district_payload(data_d = None, out_d = None, district = None, qctype = None, perf_indx = None, item_list = None, suffixes = None, thresholds = None):
+    """Payload of a district from its matched data and outliers (data_d, out_d: PairedView), see report_payload."""
+    summary = diff_summary(data = data_d, perf_indx = perf_indx, qctype = qctype, item_list = item_list)
+    diffs = {p: {item: data_d.values("diff_"+item) for item in perf_indx_list[p] if "UTIL" not in item} for p in perf_indx}
+    tables = []
+    for by, paired, label in report_breakdowns:
+        df = breakdown(data = data_d, data_out = out_d, by = by, suffixes = suffixes, paired = paired, sort = by != "SIGNED HWY AND ROADBED ID", freq = None)
+        if by == "SIGNED HWY AND ROADBED ID":
+            total = (len(data_d), data_d["SECTION LENGTH"+suffixes[0]].sum())
+            df = qc_pipeline.top_groups(df, by = by, k = report_routes, total = total)[0]
+        tables.append((by, label, df))
+    return {"district": district, "qctype": qctype, "suffixes": suffixes, "thresholds": thresholds or dict(),
+            "sections": len(data_d), "outliers": len(out_d), "summary": summary if isinstance(summary, tuple) else (summary,),
+            "diffs": diffs, "breakdowns": tables}
+
+def figure_html(fig = None, static = True):
+    """A figure as an embedded PNG image (needs kaleido) or as an interactive plot."""
+    if static:
+        png = fig.to_image(format = "png", width = 1100, height = fig.layout.height or 450)
+        return '<img src="data:image/png;base64,'+base64.b64encode(png).decode()+'" style="width:100%">'
+    return fig.to_html(full_html = False, include_plotlyjs = "cdn")
+
+def static_images(fmt = "html"):
+    """Whether figures can be rendered as images (kaleido and the browser it uses are available). Required for PDF reports."""
+    if importlib.util.find_spec("kaleido") is not None:
+        try:
+            breakdown_figure(pd.DataFrame({"x": [], "count_out": [], "miles_out": [], "count_all": [], "miles_all": [], "Percentage of all": []}), "x").to_image(format = "png")
+            return True
+        except RuntimeError:
+            pass
+    if fmt == "pdf":
+        raise ImportError("PDF reports need the kaleido package (with its browser) and weasyprint")
+    return False
+
+def render_report(payload = None, folder = None, fmt = "html", static = None):
+    """
+    Writes the report of one district. static: figures as images (see static_images, checked here when not given).
+
+    Returns:
+    - path: str. The report file.
+    """
+    static = static_images(fmt) if static is None else static
+    district = html.escape(str(payload["district"]))
+    parts = ["<h1>PMIS QC report: "+district+"</h1>",
+             "<p>QC type: "+html.escape(payload["qctype"])+" ("+html.escape(" vs ".join(x[1:] for x in payload["suffixes"]))+"). "+
+             str(payload["outliers"])+" outliers out of "+str(payload["sections"])+" matched sections.</p>"]
+    if payload["thresholds"]:
+        thresholds = pd.DataFrame([[item]+list(value) for item, value in payload["thresholds"].items()], columns = ["Measure", "Lower", "Upper"])
+        parts += ["<h2>Thresholds</h2>", thresholds.to_html(index = False)]
+
+    parts.append("<h2>Summary</h2>")
+    for table in payload["summary"]:
+        parts.append(table.to_html(index = False, float_format = lambda x: "%.2f" % x, na_rep = ""))
+
+    parts.append("<h2>Distribution plots</h2>")
+    for p, diffs in payload["diffs"].items():
+        parts += ["<h3>"+p+" (Pathway - Audit/previous year) distribution</h3>", figure_html(distribution_figure(p, diffs), static)]
+
+    parts.append("<h2>Distribution of outliers</h2>")
+    for by, label, df in payload["breakdowns"]:
+        parts += ["<h3>"+html.escape(by)+"</h3>", figure_html(breakdown_figure(df, by, label), static)]
+
+    doc = ('<html><head><meta charset="utf-8"><title>PMIS QC '+district+'</title>'
+           '<style>body{font-family:sans-serif;margin:2em} table{border-collapse:collapse;font-size:0.8em} td,th{border:1px solid #ccc;padding:2px 6px}</style>'
+           '</head><body>'+"\n".join(parts)+'</body></html>')
+    path = os.path.join(folder, "report_"+re.sub(r"[^A-Za-z0-9]+", "_", str(payload["district"])).strip("_")+"."+fmt)
+    if fmt == "pdf":
+        import weasyprint
+        weasyprint.HTML(string = doc).write_pdf(path)
+    else:
+        with open(path, "w", encoding = "utf-8") as f:
+            f.write(doc)
+    return path
+
+def district_report(data_d = None, out_d = None, district = None, qctype = None, perf_indx = None, item_list = None, suffixes = None,
+                    thresholds = None, folder = None, fmt = "html", static = False):
+    """Task of a worker process: payload and report file of one district (see district_payload and render_report)."""
+    payload = district_payload(data_d, out_d, district, qctype, perf_indx, item_list, suffixes, thresholds)
+    return render_report(payload, folder, fmt, static)
+
+def district_reports(data = None, data_out = None, qctype = None, perf_indx = None, item_list = None, suffixes = None, folder = None,
+                     districts = None, fmt = "html", thresholds = None, max_workers = None):
+    """
+    Writes the reports of several districts in parallel.
+
+    Parameters:
+    - data, data_out, qctype, perf_indx, item_list, suffixes, thresholds: see report_payload.
+    - folder: str. Folder of the reports.
+    - districts: list, optional. All districts of the QC data by default.
+    - fmt: str. "html" or "pdf".
+    - max_workers: int, optional. Number of worker processes (one per district up to the number of CPUs by default).
+
+    Returns:
+    - paths: list of the report files.
+    """
+    if fmt == "pdf" and importlib.util.find_spec("weasyprint") is None:
+        raise ImportError("PDF reports need the kaleido package (with its browser) and weasyprint")
+    # Checked once here, not in every worker
+    static = static_images(fmt)
+    if not districts:
+        districts = sorted(data["RESPONSIBLE DISTRICT"+suffixes[0]].dropna().unique())
+    if not len(districts):
+        return []
+
+    os.makedirs(folder, exist_ok = True)
+    # Spawned workers: the app and the service run threads, which should not be forked
+    with ProcessPoolExecutor(max_workers = max_workers or min(len(districts), os.cpu_count() or 1),
+                             mp_context = multiprocessing.get_context("spawn")) as executor:
+        tasks = []
+        for district in districts:
+            # Only the rows of the district are sent to its worker
+            scope = {"RESPONSIBLE DISTRICT": [district]}
+            data_d = qc_pipeline.scope_filter(data, scope, suffixes[0]).compact()
+            out_d = qc_pipeline.scope_filter(data_out, scope, suffixes[0]).compact()
+            tasks.append(executor.submit(district_report, data_d, out_d, district, qctype, perf_indx, item_list, suffixes, thresholds, folder, fmt, static))
+        return [task.result() for task in tasks]
@@ -0,0 +1,130 @@
+"""
+Composite anomaly score of the matched sections, to rank the flagged sections (worst first).
+
+The differences of the selected measures are standardized robustly (median and MAD of all matched sections, so the outliers
+do not inflate the scale) and combined into one score per section, as one matrix operation over all measures:
+- "max": the largest absolute robust z of the measures.
+- "mahalanobis": Mahalanobis distance of the robust z's, with the covariance of the central sections (all |z| below 3),
+  so measures that move together (e.g. left, right and average IRI) are not counted several times.
+
+The top K sections come from a partial selection (np.argpartition), only the K selected scores are sorted.
+The same score is used in Audit and Year by year, the differences are the diff_ columns of the merged data in both modes.
+"""
+import warnings
+
+import pandas as pd
+import numpy as np
+
+
+# Scores and their names in the app
+score_methods = {"max": "Max |robust z|", "mahalanobis": "Robust Mahalanobis distance"}
+
+def robust_z(data = None, item_list = None, reference = None):
+    """
+    Robust z of the differences of each measure: (diff - median)/(1.4826*MAD), with the median and MAD of the reference data.
+
+    Parameters:
+    - data: PairedView. The sections to score.
+    - item_list: list. Measures (UTIL items are skipped).
+    - reference: PairedView, optional. Sections of the median and MAD (data by default), e.g. all matched sections when data is filtered.
+
+    Returns:
+    - z: numpy array (sections, measures), NaN for missing differences.
+    - items: list. The measures of the columns of z.
+    """
+    items = [x for x in item_list if "UTIL" not in x and "diff_"+x in data.columns]
+    reference = data if reference is None else reference
+    if not items:
+        return np.zeros((len(data), 0)), items
+    x = np.column_stack([data.values("diff_"+item) for item in items]).astype("float64")
+    r = np.column_stack([reference.values("diff_"+item) for item in items]).astype("float64")
+    with warnings.catch_warnings():
+        # measures without any difference
+        warnings.simplefilter("ignore", RuntimeWarning)
+        center = np.nanmedian(r, axis = 0)
+        scale = 1.4826*np.nanmedian(np.abs(r - center), axis = 0)
+        # Measures without spread (e.g. constant differences) are scaled by their standard deviation, or left at 0
+        scale = np.where(scale > 0, scale, np.nanstd(r, axis = 0))
+        z = (x - center)/np.where(scale > 0, scale, np.inf)
+    return z, items
+
+def composite_score(z = None, method = "max", z_reference = None):
+    """
+    Anomaly score of each row of robust z's (see robust_z). z_reference: robust z's of the reference sections (z by default).
+    """
+    missing = np.isnan(z).all(axis = 1)
+    if method == "max":
+        score = np.max(np.abs(np.nan_to_num(z, nan = 0)), axis = 1)
+    elif method == "mahalanobis":
+        zr = z if z_reference is None else z_reference
+        central = zr[(np.abs(np.nan_to_num(zr, nan = np.inf)) < 3).all(axis = 1)]
+        m = z.shape[1]
+        cov = np.cov(central, rowvar = False).reshape(m, m) if central.shape[0] > m else np.eye(m)
+        # Regularized, so perfectly correlated measures still have an inverse
+        cov = cov + 1e-6*max(np.trace(cov)/m, 1e-12)*np.eye(m)
+        # Missing differences are at the center (they add nothing to the distance)
+        w = np.linalg.solve(np.linalg.cholesky(cov), np.nan_to_num(z, nan = 0).T)
+        score = np.sqrt(np.einsum("ij,ij->j", w, w))
+    else:
+        raise ValueError("Unknown score method: "+str(method))
+    score[missing] = np.nan
+    return score
+
+def anomaly_score(data = None, item_list = None, method = "max", reference = None):
+    """
+    Composite anomaly score of each section.
+
+    Parameters:
+    - data: PairedView. The sections to score.
+    - item_list: list. Measures.
+    - method: str. "max" or "mahalanobis" (see score_methods).
+    - reference: PairedView, optional. Sections of the robust center, scale and covariance (data by default).
+
+    Returns:
+    - score: numpy array. NaN for sections without any difference.
+    - z: numpy array (sections, measures). The robust z's (see robust_z).
+    - items: list. The scored measures.
+    """
+    z, items = robust_z(data, item_list, reference)
+    if not items:
+        return np.full(len(data), np.nan), z, items
+    z_reference = robust_z(reference, items)[0] if reference is not None and method == "mahalanobis" else None
+    return composite_score(z, method, z_reference), z, items
+
+def top_k(score = None, k = 100):
+    """
+    Positions of the k highest scores, highest first, by partial selection (NaN scores come last).
+
+    Returns:
+    - positions: numpy array of int.
+    """
+    values = np.where(np.isnan(score), -np.inf, score)
+    k = min(k, values.size)
+    if k <= 0:
+        return np.zeros(0, dtype = "int64")
+    positions = np.argpartition(-values, k-1)[:k]
+    return positions[np.argsort(-values[positions], kind = "stable")]
+
+def top_anomalies(data = None, item_list = None, method = "max", k = 100, reference = None, columns = None):
+    """
+    The k sections with the highest anomaly scores.
+
+    Parameters:
+    - data: PairedView. The sections to rank (e.g. the flagged sections).
+    - item_list, method, reference: see anomaly_score.
+    - k: int. Number of sections.
+    - columns: list, optional. Columns of the table (besides the score and the differences).
+
+    Returns:
+    - df: Pandas DataFrame. "Rank", "Anomaly score", the columns, the diff_ columns and the robust z of each measure, worst first.
+    """
+    score, z, items = anomaly_score(data, item_list, method, reference)
+    positions = top_k(score, k) if items else np.zeros(0, dtype = "int64")
+    columns = [x for x in (columns or []) if x in data.columns] + ["diff_"+x for x in items]
+    # frame() of no columns would gather all of them
+    df = data.take(positions).frame(columns) if columns else pd.DataFrame(index = range(positions.size))
+    for n, item in enumerate(items):
+        df["z "+item] = z[positions, n]
+    df.insert(0, "Anomaly score", score[positions])
+    df.insert(0, "Rank", np.arange(1, positions.size+1))
+    return df
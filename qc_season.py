@@ -0,0 +1,264 @@
+"""
+Incremental QC season: daily deliveries of the QC data are appended to a season kept in a folder, and only the new sections are matched.
+
+The folder holds the data to compare, one file per delivery (with its matches) and the running aggregates of the season
+(summary sums, quantile sketches and breakdown counts), so appending a delivery costs time proportional to the delivery, not to the season.
+The matched season is available as a PairedView (see qc_pipeline.py) like loaded and merged data.
+"""
+import hashlib
+import os
+import pickle
+
+import pandas as pd
+import numpy as np
+
+from qc_pipeline import (measure_cols, read_sources, prepare_data, MatchIndex, match_suffixes, PairedView, frame_digest, thre_flag,
+                         summary_partials, summary_add, summary_table, group_counts)
+
+
+# Breakdowns counted while appending: (variable, paired)
+season_breakdowns = [("COUNTY", False), ("SIGNED HWY AND ROADBED ID", False), ("LANE NUMBER", True), ("DIRECTION", True),
+                     ("VEHICLE ID", True), ("RIDE COMMENT CODE", True), ("ACP RUT AUTO COMMENT CODE", True), ("INTERFACE FLAG", True),
+                     ("LANE WIDTH", False), ("RIDE SCORE TRAFFIC LEVEL", False)]
+
+
+class QuantileSketch:
+    """
+    Histogram of values on log-spaced buckets (relative accuracy), which can be updated with new values.
+    Quantiles are read from the bucket counts, within the relative accuracy of the exact quantiles.
+    """
+
+    def __init__(self, accuracy = 0.005):
+        self.gamma = (1+accuracy)/(1-accuracy)
+        self.buckets = [dict(), dict()] # negative and positive values
+        self.zeros, self.n = 0, 0
+        self.min, self.max = np.inf, -np.inf
+
+    def add(self, values = None):
+        values = np.asarray(values, dtype = "float64")
+        values = values[np.isfinite(values)]
+        if not values.size:
+            return
+        self.n += values.size
+        self.zeros += int((values == 0).sum())
+        self.min, self.max = min(self.min, values.min()), max(self.max, values.max())
+        for sign, buckets in [(-1, self.buckets[0]), (1, self.buckets[1])]:
+            v = values[values*sign > 0]*sign
+            keys, counts = np.unique(np.ceil(np.log(v)/np.log(self.gamma)).astype("int64"), return_counts = True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                buckets[key] = buckets.get(key, 0) + count
+
+    def quantile(self, q = None, absolute = False):
+        """Percentiles q (list), interpolated like sweep_quantile. absolute: percentiles of the absolute values."""
+        if self.n == 0:
+            return np.full(len(q), np.nan)
+        if absolute:
+            buckets = dict(self.buckets[1])
+            for key, count in self.buckets[0].items():
+                buckets[key] = buckets.get(key, 0) + count
+            keys = sorted(buckets)
+            values = np.concatenate([[0], 2*self.gamma**np.array(keys, dtype = "float64")/(self.gamma+1)])
+            counts = np.array([self.zeros]+[buckets[key] for key in keys])
+            vmin, vmax = 0, max(abs(self.min), abs(self.max))
+        else:
+            neg, pos = sorted(self.buckets[0], reverse = True), sorted(self.buckets[1])
+            values = np.concatenate([-2*self.gamma**np.array(neg, dtype = "float64")/(self.gamma+1), [0],
+                                     2*self.gamma**np.array(pos, dtype = "float64")/(self.gamma+1)])
+            counts = np.array([self.buckets[0][key] for key in neg]+[self.zeros]+[self.buckets[1][key] for key in pos])
+            vmin, vmax = self.min, self.max
+
+        # value of the sections at a rank (0 based) and linear interpolation between ranks
+        cum = np.cumsum(counts)
+        pos = np.asarray(q, dtype = "float64")/100*(self.n-1)
+        lo = np.floor(pos)
+        hi = np.minimum(lo+1, self.n-1)
+        value_lo, value_hi = values[np.searchsorted(cum, lo, "right")], values[np.searchsorted(cum, hi, "right")]
+        return np.clip(value_lo + (pos-lo)*(value_hi-value_lo), vmin, vmax)
+
+
+class QCSeason:
+    """
+    QC season kept in a folder. Files:
+    - season.pkl: QC type, lane matching, digests of the data, suffixes, deliveries, thresholds and the running aggregates (written last, when a delivery is complete).
+    - data2.pkl: the data to compare.
+    - part-00001.pkl, part-00001.npz: a delivery of the QC data and its matches (row positions in the season and in data2, outlier flags).
+    """
+
+    def __init__(self, path = None):
+        self.path = path
+        with open(os.path.join(path, "season.pkl"), "rb") as f:
+            self.state = pickle.load(f)
+        self.data2 = pd.read_pickle(os.path.join(path, "data2.pkl"))
+        self.index = MatchIndex(self.data2, self.state.get("lanes", False))
+        self._parts, self._matches = None, None
+        self._view, self._outliers = None, None
+
+    @classmethod
+    def open(cls, path = None, data2_path = None, qctype = None, lanes = False):
+        """
+        Opens the season in a folder, or starts a new one from the data to compare.
+
+        Parameters:
+        - path: str. The season folder.
+        - data2_path: path, file or list of them, optional. The data to compare (csv, zip or gz), needed to start a season.
+        - qctype: str. "Audit" or "Year by year", needed to start a season.
+        - lanes: bool. Match the direction and lane of the sections (see MatchIndex), set when the season is started.
+
+        Returns:
+        - season: QCSeason.
+        """
+        if not os.path.exists(os.path.join(path, "season.pkl")):
+            if not data2_path:
+                raise ValueError("No season in "+str(path)+", the data to compare is needed to start one")
+            os.makedirs(path, exist_ok = True)
+            data2 = prepare_data(read_sources(data2_path))
+            data2.to_pickle(os.path.join(path, "data2.pkl"))
+            state = {"qctype": qctype, "lanes": lanes, "digest": frame_digest(data2), "suffixes": None, "items": None, "parts": [], "rows": 0,
+                     "thresholds": None, "summary": None, "sketches": dict(), "counts_all": dict(), "counts_out": dict()}
+            cls.write_state(path, state)
+        return cls(path)
+
+    @staticmethod
+    def write_state(path, state):
+        # Written to a temporary file and renamed, so an interrupted append leaves the previous state
+        with open(os.path.join(path, "season.pkl.tmp"), "wb") as f:
+            pickle.dump(state, f)
+        os.replace(os.path.join(path, "season.pkl.tmp"), os.path.join(path, "season.pkl"))
+
+    @property
+    def suffixes(self):
+        return self.state["suffixes"]
+
+    @property
+    def key(self):
+        """Lineage key of the season view: the data to compare and the digests of the deliveries (read from the state, no data is loaded)."""
+        parts = [part.get("digest", part["name"]) for part in self.state["parts"]]
+        return "season-"+hashlib.sha1(str([os.path.abspath(self.path), self.state.get("digest"), self.state["qctype"],
+                                            self.state.get("lanes", False), parts]).encode()).hexdigest()
+
+    def load_parts(self):
+        """Reads the deliveries and their matches (once, later deliveries are added in memory)."""
+        if self._parts is None:
+            self._parts, self._matches = [], []
+            for part in self.state["parts"]:
+                self._parts.append(pd.read_pickle(os.path.join(self.path, part["name"]+".pkl")))
+                with np.load(os.path.join(self.path, part["name"]+".npz")) as matches:
+                    self._matches.append({key: matches[key] for key in matches.files})
+
+    def append(self, data1_path = None):
+        """
+        Appends a delivery of the QC data: matches its sections against the data to compare and updates the aggregates.
+
+        Parameters:
+        - data1_path: path, file or list of them. The delivery (csv, zip or gz).
+
+        Returns:
+        - dict with the number of rows and of matched sections of the delivery. A delivery that was already appended is skipped: the dict
+          then has the part it was stored as under "duplicate", with no rows.
+        """
+        data1 = prepare_data(read_sources(data1_path))
+        state = self.state
+        digest = frame_digest(data1)
+        # The same delivery appended twice would count its sections twice in the aggregates
+        for part in state["parts"]:
+            if part.get("digest") == digest:
+                return {"rows": 0, "matched": 0, "duplicate": part["name"]}
+        if state["suffixes"] is None:
+            state["suffixes"] = match_suffixes(data1, self.data2, state["qctype"])
+            state["items"] = [x for x in measure_cols if (x in data1.columns) and (x in self.data2.columns)]
+        idx1, idx2 = self.index.match(data1)
+        # Keyed by the delivery, so the data to compare is not hashed again
+        batch = PairedView(data1, self.data2, idx1, idx2, state["suffixes"], key = "delivery-"+digest)
+
+        # Aggregates of the delivery are added to the season
+        state["summary"] = summary_add(state["summary"], summary_partials(batch, state["suffixes"], state["items"]))
+        for item in state["items"]:
+            state["sketches"].setdefault(item, QuantileSketch()).add(batch.values("diff_"+item))
+        flag = thre_flag(batch, state["thresholds"], state["qctype"]) if state["thresholds"] else np.zeros(len(batch), dtype = bool)
+        self.add_counts(batch, "counts_all", "all")
+        if state["thresholds"]:
+            self.add_counts(batch.take(flag), "counts_out", "out")
+
+        name = "part-%05d" % (len(state["parts"])+1)
+        matches = {"idx1": idx1+state["rows"], "idx2": idx2, "flag": flag}
+        data1.to_pickle(os.path.join(self.path, name+".pkl"))
+        np.savez(os.path.join(self.path, name+".npz"), **matches)
+        state["parts"].append({"name": name, "rows": data1.shape[0], "matches": len(idx1), "digest": digest})
+        state["rows"] += data1.shape[0]
+        self.write_state(self.path, state)
+
+        # Earlier deliveries are not read: a season that is already in memory gets the new delivery, otherwise all are read with the next view
+        if self._parts is not None:
+            self._parts.append(data1)
+            self._matches.append(matches)
+        self._view, self._outliers = None, None
+        return {"rows": data1.shape[0], "matched": len(idx1)}
+
+    def add_counts(self, data = None, key = None, name = None):
+        for by, paired in season_breakdowns:
+            if (by+self.suffixes[0] in data.columns) and (not paired or by+self.suffixes[1] in data.columns):
+                counts = group_counts(data, by, self.suffixes, paired, name = name).set_index(by)
+                self.state[key][(by, paired)] = counts.add(self.state[key][(by, paired)], fill_value = 0) if (by, paired) in self.state[key] else counts
+
+    def view(self):
+        """Matched sections of the season (PairedView)."""
+        if not self.state["parts"]:
+            raise ValueError("No delivery has been appended to the season")
+        if self._view is None:
+            self.load_parts()
+            self._view = PairedView(pd.concat(self._parts, ignore_index = True), self.data2,
+                                    np.concatenate([x["idx1"] for x in self._matches]), np.concatenate([x["idx2"] for x in self._matches]),
+                                    self.suffixes, key = self.key)
+        return self._view
+
+    def outliers(self):
+        """Sections flagged by the season thresholds (PairedView), None before thresholds are set."""
+        if not self.state["thresholds"]:
+            return None
+        if self._outliers is None:
+            self._outliers = self.view().take(np.concatenate([x["flag"] for x in self._matches]))
+        return self._outliers
+
+    def set_thresholds(self, thresholds = None):
+        """
+        Sets the thresholds used to flag the appended sections (see thre_filter). The flags and outlier counts of the season are computed again.
+
+        Returns:
+        - data_v1: PairedView. The flagged sections (an empty view without thresholds).
+        """
+        view = self.view()
+        flag = thre_flag(view, thresholds, self.state["qctype"])
+        start = 0
+        for part, matches in zip(self.state["parts"], self._matches):
+            matches["flag"] = flag[start:start+part["matches"]]
+            np.savez(os.path.join(self.path, part["name"]+".npz"), **matches)
+            start += part["matches"]
+        self.state["thresholds"] = thresholds
+        self.state["counts_out"] = dict()
+        self.add_counts(view.take(flag), "counts_out", "out")
+        self.write_state(self.path, self.state)
+        self._outliers = None
+        return self.outliers() if thresholds else view.take(flag)
+
+    def summary(self, perf_indx = None, item_list = None):
+        """County (and district) summary of the season, see diff_summary."""
+        return summary_table(self.state["summary"], perf_indx, self.state["qctype"], item_list, self.suffixes)
+
+    def quantiles(self, item = None, q = None, absolute = False):
+        """Percentiles q (list) of the differences of a measure (absolute differences for Audit), from the quantile sketch."""
+        return self.state["sketches"][item].quantile(q, absolute)
+
+    def breakdown(self, by = None, paired = False, sort = True):
+        """
+        Outlier counts of the season by a variable, see breakdown.
+        Returns None when the variable is not counted while appending (see season_breakdowns) or no thresholds are set.
+        """
+        if not self.state["thresholds"] or (by, paired) not in self.state["counts_all"]:
+            return None
+        counts_out = self.state["counts_out"].get((by, paired), pd.DataFrame(columns = ["count_out", "miles_out"]))
+        df = counts_out[counts_out["count_out"] > 0].join(self.state["counts_all"][(by, paired)], how = "left").rename_axis(by).reset_index()
+        df = df.astype({"count_out": "int64", "count_all": "int64"})
+        df["Percentage of all"] = 100*df["count_out"]/df["count_all"]
+        if sort:
+            df = df.sort_values(by = "count_out", ascending = False)
+        return df
@@ -0,0 +1,428 @@
+"""
+Local HTTP service for the PMIS QC pipeline.
+
+Exposes the same loading, matching, filtering, summary and breakdown functions as the app (see qc_pipeline.py),
+so other tools can use them without the Streamlit UI. Loaded and merged datasets are kept in a shared cache
+between calls and are referred to by handles. The service only listens on the local machine by default.
+
+Usage:
+    python qc_service.py --port 8765
+
+Endpoints (POST with a JSON body):
+- /load: {"data1": path or list of paths, "data2": path or list of paths, "scope": {...}} -> {"handle", "rows"}
+  (csv, zip and gz files)
+- /append: {"season": folder, "data1": delivery path or list of paths, "data2": data to compare (to start a season), "qctype", "lanes", "measures"}
+  -> {"handle": merge handle, "rows", "appended", "matched"}
+- /validate: {"handle": load handle, "measures": ["IRI", ...], "lanes": false (sections are matched by direction and lane)}
+  -> table of issues (missing columns, values out of range, duplicate and overlapping sections of a lane)
+- /merge: {"handle": load handle, "qctype": "Audit" or "Year by year", "measures": ["IRI", ...], "lanes": false (match direction and lane),
+  "segment": segment length in miles (sections are rolled up before matching), "projects": project limits csv instead of fixed segments}
+  -> {"handle", "suffixes", "rows"}
+- /filter: {"handle": merge handle, "thresholds": {item: [lower, upper]}, "expression": filter expression (see qc_expr.py)} -> {"handle", "rows"}
+  (sections flagged by the thresholds and matching the expression, either one can be left out)
+- /summary: {"handle": merge handle, "table": "county" or "district"} -> table
+- /agreement: {"handle": merge handle (Audit), "by": "COUNTY" or "RESPONSIBLE DISTRICT", "replicates": 1000} -> table
+- /breakdown: {"handle": filter handle, "by": "COUNTY", "paired": false, "freq": "hour", "day" or "week" for START TIME,
+  "top": groups per page, "rank": "count_out", "miles_out" or "Percentage of all", "page"} -> table
+- /anomalies: {"handle": merge or filter handle, "method": "max" or "mahalanobis", "k": 100, "measures": ["IRI", ...] (the measures of the merge by default)}
+  -> table of the k sections with the highest composite anomaly score (robust z of the differences, see qc_score.py)
+- /data: {"handle": merge or filter handle, "columns": [...], "sort_col", "ascending", "search_col", "search_text", "page", "page_size"} -> table
+Tables are returned as JSON records, or as an Arrow IPC stream when "format" is "arrow".
+Loaded data, matches, flags, summaries, agreement, breakdown and anomaly tables are also kept in the disk store (see qc_store.py), handles are their lineage keys,
+so a restarted service answers previous requests without computing them again.
+GET /handles lists the cached handles.
+Invalid request bodies are answered with 400, unknown handles with 404 and other errors with 500, always with an "error" message.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+import qc_pipeline
+from qc_agreement import agreement as agreement_table
+from qc_validate import validation_report
+from qc_expr import expression_filter
+from qc_score import top_anomalies, score_methods
+from qc_season import QCSeason
+from qc_store import store
+
+
+class SharedCache:
+    """
+    Thread-safe LRU cache of pipeline results. Concurrent requests for the same key compute it once,
+    the other requests wait for the result (or get the error of the computation).
+    """
+
+    def __init__(self, max_items = 32):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._pending[key] = {"event": threading.Event(), "error": None}
+        event = pending["event"]
+        if not owner:
+            event.wait()
+            if pending["error"] is not None:
+                raise pending["error"]
+            return self.get(key)
+
+        try:
+            value = compute()
+            with self._lock:
+                self._items[key] = value
+                while len(self._items) > self.max_items:
+                    self._items.popitem(last = False)
+            return value
+        except Exception as e:
+            # Waiting requests get the same error, the next request computes the key again
+            pending["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+
+    def keys(self):
+        with self._lock:
+            return list(self._items.keys())
+
+
+cache = SharedCache()
+log = logging.getLogger("pmis_qc")
+
+# Measures requested on a merged dataset (used by the summary)
+measure_lock = threading.Lock()
+
+# Open seasons by folder, appends are serialized
+seasons = dict()
+season_lock = threading.Lock()
+
+
+class SeasonEntry(dict):
+    """
+    Cache entry of an appended season. Its view ("data") is built when a request first reads it, so /append
+    only reads the new delivery.
+    """
+
+    def __missing__(self, key):
+        if key != "data":
+            raise KeyError(key)
+        with season_lock:
+            season = self["season"]
+            if season.key != self["key"]:
+                raise ValueError("The season has new deliveries, use the handle of the last /append")
+            self["data"] = season.view()
+        return self["data"]
+
+    def __contains__(self, key):
+        return key == "data" or dict.__contains__(self, key)
+
+
+class UnknownHandle(LookupError):
+    """A handle that is not in the cache (never created or dropped), answered with 404."""
+
+
+# Fields of the request bodies: name -> (types, required). Other fields are ignored, optional fields can be null.
+body_fields = {
+    "/load": {"data1": ((str, list), True), "data2": ((str, list), True), "scope": (dict, False)},
+    "/validate": {"handle": (str, True), "measures": (list, False), "lanes": (bool, False)},
+    "/append": {"season": (str, True), "data1": ((str, list), False), "data2": ((str, list), False), "qctype": (str, False), "lanes": (bool, False),
+                "measures": (list, False)},
+    "/merge": {"handle": (str, True), "qctype": (str, False), "measures": (list, False), "lanes": (bool, False), "segment": ((int, float), False),
+               "projects": (str, False)},
+    "/filter": {"handle": (str, True), "thresholds": (dict, False), "expression": (str, False)},
+    "/summary": {"handle": (str, True), "table": (str, False)},
+    "/agreement": {"handle": (str, True), "by": (str, False), "replicates": (int, False)},
+    "/breakdown": {"handle": (str, True), "by": (str, True), "paired": (bool, False), "freq": (str, False), "top": (int, False), "rank": (str, False),
+                   "page": (int, False)},
+    "/anomalies": {"handle": (str, True), "method": (str, False), "k": (int, False), "measures": (list, False)},
+    "/data": {"handle": (str, True), "columns": (list, False), "sort_col": (str, False), "ascending": (bool, False), "search_col": (str, False),
+              "search_text": (str, False), "page": (int, False), "page_size": (int, False)},
+}
+
+def check_body(path, body):
+    """Raises ValueError (answered with 400) when a request body is not valid."""
+    if not isinstance(body, dict):
+        raise ValueError("The body must be a JSON object")
+    for name, (types, required) in body_fields[path].items():
+        value = body.get(name)
+        if value is None:
+            if required:
+                raise ValueError("Missing field: "+name)
+            # null is the same as a missing field, the defaults of the endpoints apply
+            body.pop(name, None)
+            continue
+        # true/false are not numbers
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in (types if isinstance(types, tuple) else (types,))):
+            raise ValueError("Invalid field: "+name)
+    if body.get("qctype") is not None and body["qctype"] not in ["Audit", "Year by year"]:
+        raise ValueError("qctype must be Audit or Year by year")
+    unknown = [x for x in (body.get("measures") or []) if x not in qc_pipeline.perf_indx_list]
+    if unknown:
+        raise ValueError("Unknown measures: "+", ".join(map(str, unknown)))
+    for item, bounds in (body.get("thresholds") or {}).items() if path == "/filter" else []:
+        if not (isinstance(bounds, list) and len(bounds) == 2 and all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in bounds)):
+            raise ValueError("Thresholds of "+item+" must be [lower, upper]")
+    for col, values in (body.get("scope") or {}).items():
+        if col not in qc_pipeline.scope_cols:
+            raise ValueError("Unknown scope column: "+str(col)+" (expected "+", ".join(qc_pipeline.scope_cols)+")")
+        if not isinstance(values, list) or (col == "ROUTE PREFIX" and not all(isinstance(x, str) for x in values)):
+            raise ValueError("Scope of "+col+" must be a list of values")
+    if path == "/breakdown" and body.get("freq") is not None and body["freq"] not in qc_pipeline.time_units:
+        raise ValueError("freq must be one of "+", ".join(qc_pipeline.time_units))
+    if path == "/breakdown" and body.get("rank") is not None and body["rank"] not in ["count_out", "miles_out", "Percentage of all"]:
+        raise ValueError("rank must be count_out, miles_out or Percentage of all")
+    if path == "/anomalies" and body.get("method") is not None and body["method"] not in score_methods:
+        raise ValueError("method must be one of "+", ".join(score_methods))
+    for name in ["k", "top", "page", "page_size", "replicates"]:
+        if body.get(name) is not None and body[name] < (0 if name == "replicates" else 1):
+            raise ValueError("Invalid field: "+name)
+
+def make_handle(stage, *parts):
+    """Deterministic handle of a stage result from its inputs."""
+    return stage+"-"+hashlib.sha1(json.dumps(parts, sort_keys = True, default = str).encode()).hexdigest()[:16]
+
+def lookup(handle):
+    try:
+        return cache.get(handle)
+    except KeyError:
+        raise UnknownHandle("Unknown handle: "+str(handle))
+
+def get_handle(handle, stage):
+    if not str(handle).startswith(stage+"-"):
+        raise ValueError("Expected a "+stage+" handle")
+    return lookup(handle)
+
+def item_list(measures):
+    return [item for measure in measures for item in qc_pipeline.perf_indx_list[measure]]
+
+
+def load(body):
+    paths = [body["data1"], body["data2"]]
+    # file size and modification time are part of the handle, so changed files are loaded again
+    stats = [[(os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)) for path in (x if isinstance(x, list) else [x])] for x in paths]
+    handle = make_handle("load", stats, body.get("scope"))
+    data1, data2 = cache.get_or_compute(handle, lambda: store.get_or_compute(handle, lambda: qc_pipeline.data_load(paths[0], paths[1], scope = body.get("scope"))))
+    return {"handle": handle, "rows": [data1.shape[0], data2.shape[0]]}
+
+def validate(body):
+    data1, data2 = get_handle(body["handle"], "load")
+    measures, lanes = body.get("measures") or [], body.get("lanes", False)
+    handle = make_handle("validate", body["handle"], measures, *([lanes] if lanes else []))
+    return cache.get_or_compute(handle, lambda: store.get_or_compute(handle, lambda: validation_report(data1, data2, item_list(measures), lanes = lanes)))
+
+def merge(body):
+    data1, data2 = get_handle(body["handle"], "load")
+    qctype, lanes = body.get("qctype", "Audit"), body.get("lanes", False)
+    segment, projects = body.get("segment"), body.get("projects")
+    projects_stat = (os.path.abspath(projects), os.path.getsize(projects), os.path.getmtime(projects)) if projects else None
+    handle = make_handle("merge", body["handle"], qctype, qc_pipeline.MatchIndex.tol, lanes, *([segment, projects_stat] if segment or projects else []))
+
+    def compute():
+        nonlocal data1, data2
+        if segment or projects:
+            limits = qc_pipeline.read_projects(projects) if projects else None
+            data1, data2 = [qc_pipeline.resegment(data, segment, limits, lanes) for data in [data1, data2]]
+        suffixes, idx1, idx2 = store.get_or_compute(handle, lambda: qc_pipeline.data_match(data1, data2, qctype, lanes))
+        data = qc_pipeline.PairedView(data1, data2, idx1, idx2, suffixes, key = handle)
+        return {"suffixes": suffixes, "data": data, "qctype": qctype, "measures": []}
+
+    merged = cache.get_or_compute(handle, compute)
+    with measure_lock:
+        merged["measures"] = list(dict.fromkeys(merged["measures"] + (body.get("measures") or [])))
+    return {"handle": handle, "suffixes": merged["suffixes"], "rows": merged["data"].shape[0]}
+
+def append(body):
+    path = os.path.abspath(body["season"])
+    with season_lock:
+        if path not in seasons:
+            seasons[path] = QCSeason.open(path, data2_path = body.get("data2"), qctype = body.get("qctype", "Audit"), lanes = body.get("lanes", False))
+        season = seasons[path]
+        appended = season.append(body["data1"]) if body.get("data1") else {"rows": 0, "matched": 0}
+        # The handle changes with every delivery, the summary of the season is read from its running aggregates
+        handle = make_handle("merge", path, season.key)
+        merged = cache.get_or_compute(handle, lambda: SeasonEntry(suffixes = season.suffixes, qctype = season.state["qctype"], measures = [], season = season,
+                                                                  key = season.key))
+        rows = sum(part["matches"] for part in season.state["parts"])
+    with measure_lock:
+        merged["measures"] = list(dict.fromkeys(merged["measures"] + (body.get("measures") or [])))
+    response = {"handle": handle, "rows": rows, "appended": appended["rows"], "matched": appended["matched"]}
+    if "duplicate" in appended:
+        # Already appended: nothing was added to the season
+        response["duplicate"] = appended["duplicate"]
+    return response
+
+def filter_data(body):
+    merged = get_handle(body["handle"], "merge")
+    thresholds, expression = body.get("thresholds"), body.get("expression")
+    if thresholds is None and not expression:
+        raise ValueError("Expected thresholds or an expression")
+    missing = [item for item in (thresholds or {}) if "diff_"+item not in merged["data"].columns]
+    if missing:
+        raise ValueError("Measures not found: "+", ".join(missing))
+    handle = make_handle("filter", body["handle"], thresholds, *([expression] if expression else []))
+
+    def compute_flag():
+        mask = np.ones(len(merged["data"]), dtype = bool)
+        if thresholds is not None:
+            mask &= qc_pipeline.thre_flag(merged["data"], thresholds, merged["qctype"])
+        if expression:
+            mask &= expression_filter(merged["data"], expression)
+        return mask
+
+    flag = lambda: store.get_or_compute(handle, compute_flag)
+    filtered = cache.get_or_compute(handle, lambda: {"merge": body["handle"], "data": merged["data"].take(flag())})
+    return {"handle": handle, "rows": filtered["data"].shape[0]}
+
+def summary(body):
+    merged = get_handle(body["handle"], "merge")
+    handle = make_handle("summary", body["handle"], merged["measures"])
+    if "season" in merged:
+        tables = cache.get_or_compute(handle, lambda: merged["season"].summary(merged["measures"], item_list(merged["measures"])))
+    else:
+        tables = cache.get_or_compute(handle, lambda: store.get_or_compute(handle, lambda: qc_pipeline.diff_summary(merged["data"], merged["measures"], merged["qctype"], item_list(merged["measures"]))))
+    if merged["qctype"] == "Year by year":
+        return tables[0] if body.get("table") == "district" else tables[1]
+    return tables
+
+def agreement(body):
+    merged = get_handle(body["handle"], "merge")
+    if merged["qctype"] != "Audit":
+        raise ValueError("Agreement statistics are for Audit data")
+    by, n_boot = body.get("by", "COUNTY"), body.get("replicates", 1000)
+    handle = make_handle("agreement", body["handle"], merged["measures"], by, n_boot)
+    return cache.get_or_compute(handle, lambda: store.get_or_compute(handle, lambda: agreement_table(merged["data"], item_list(merged["measures"]), merged["suffixes"],
+                                                                                                   by = by, n_boot = n_boot)))
+
+def breakdown(body):
+    filtered = get_handle(body["handle"], "filter")
+    merged = get_handle(filtered["merge"], "merge")
+    data, suffixes = merged["data"], merged["suffixes"]
+    by = body["by"]
+    if by+suffixes[0] not in data.columns and by not in data.columns:
+        raise ValueError("Column not found: "+by)
+    if body.get("paired") and by+suffixes[1] not in data.columns:
+        raise ValueError("Column not found in the data to compare: "+by)
+    if body.get("freq"):
+        kind = data[by+suffixes[0] if by+suffixes[0] in data.columns else by].dtype
+        if not (pd.api.types.is_datetime64_any_dtype(kind) or pd.api.types.is_timedelta64_dtype(kind)):
+            raise ValueError("freq is for time variables, "+by+" is not one")
+    handle = make_handle("breakdown", body["handle"], body["by"], body.get("paired", False), body.get("freq"))
+    df = cache.get_or_compute(handle, lambda: store.get_or_compute(handle, lambda: qc_pipeline.breakdown(merged["data"], filtered["data"], body["by"], merged["suffixes"],
+                                                                                                       paired = body.get("paired", False), sort = not body.get("freq"),
+                                                                                                       freq = body.get("freq"))))
+    if not body.get("top"):
+        return df
+    total = (len(data), data["SECTION LENGTH"+suffixes[0]].sum())
+    return qc_pipeline.top_groups(df, body["by"], body["top"], body.get("rank", "count_out"), body.get("page", 1), total)[0]
+
+def anomalies(body):
+    entry = lookup(body["handle"])
+    if not isinstance(entry, dict) or "data" not in entry:
+        raise ValueError("Expected a merge or filter handle")
+    # The differences are scaled by all matched sections, also when ranking the filtered ones
+    merged = get_handle(entry["merge"], "merge") if "merge" in entry else entry
+    measures = body.get("measures") or merged["measures"]
+    method, k = body.get("method", "max"), body.get("k", 100)
+    heading = [x+suffix for suffix in merged["suffixes"] for x in ["SIGNED HWY AND ROADBED ID", "BEGINNING DFO", "ENDING DFO", "RESPONSIBLE DISTRICT", "COUNTY"]]
+    handle = make_handle("anomalies", body["handle"], measures, method, k)
+    return cache.get_or_compute(handle, lambda: store.get_or_compute(handle, lambda: top_anomalies(entry["data"], item_list(measures), method, k,
+                                                                                                 reference = merged["data"], columns = heading)))
+
+def data(body):
+    entry = lookup(body["handle"])
+    if not isinstance(entry, dict) or "data" not in entry:
+        raise ValueError("Expected a merge or filter handle")
+    order = qc_pipeline.table_order(entry["data"], body.get("sort_col"), body.get("ascending", True), body.get("search_col"), body.get("search_text"))
+    return qc_pipeline.table_page(entry["data"], order, body.get("columns") or list(entry["data"].columns),
+                                  body.get("page", 1), body.get("page_size", 1000))
+
+endpoints = {"/load": load, "/validate": validate, "/append": append, "/merge": merge, "/filter": filter_data, "/summary": summary, "/agreement": agreement, "/breakdown": breakdown, "/anomalies": anomalies, "/data": data}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def send(self, status, payload, content_type = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_json(self, status, obj):
+        self.send(status, json.dumps(obj, default = str).encode())
+
+    def do_GET(self):
+        if self.path == "/handles":
+            self.send_json(200, {"handles": cache.keys()})
+        else:
+            self.send_json(404, {"error": "Unknown endpoint"})
+
+    def do_POST(self):
+        if self.path not in endpoints:
+            return self.send_json(404, {"error": "Unknown endpoint"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            check_body(self.path, body)
+            payload, content_type = self.encode(endpoints[self.path](body), body)
+        except UnknownHandle as e:
+            return self.send_json(404, {"error": str(e)})
+        except (ValueError, OSError) as e:
+            return self.send_json(400, {"error": str(e)})
+        except Exception as e:
+            # Any other error is a failure of the service, the client still gets an answer
+            log.exception("Error in "+self.path)
+            return self.send_json(500, {"error": type(e).__name__+": "+str(e)})
+        self.send(200, payload, content_type)
+
+    @staticmethod
+    def encode(result, body):
+        """Payload and content type of a result: JSON, or an Arrow IPC stream for tables when "format" is "arrow"."""
+        if not hasattr(result, "to_json"):
+            return json.dumps(result, default = str).encode(), "application/json"
+        if body.get("format") == "arrow":
+            import pyarrow as pa
+            sink = pa.BufferOutputStream()
+            table = pa.Table.from_pandas(result, preserve_index = False)
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            return sink.getvalue().to_pybytes(), "application/vnd.apache.arrow.stream"
+        return result.to_json(orient = "records", date_format = "iso").encode(), "application/json"
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Local HTTP service for the PMIS QC pipeline")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 8765)
+    parser.add_argument("--cache-size", type = int, default = 32, help = "Number of cached results")
+    args = parser.parse_args()
+
+    cache.max_items = args.cache_size
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print("PMIS QC service on http://"+args.host+":"+str(args.port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
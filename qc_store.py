@@ -0,0 +1,158 @@
+"""
+Disk store of derived QC results (loaded data, matched pairs, summaries, flagged sections and breakdown tables),
+so they survive a restart of the app or of the service.
+
+Entries are keyed by a lineage hash: fingerprints of the input files and the parameters of each stage (QC type, DFO tolerance,
+measures, thresholds...). Results of a stage on a PairedView are keyed by the view key, which is derived from the lineage of the match.
+Entries expire after a time to live, and the least recently used entries are removed when the store grows over its size limit.
+
+Settings (environment variables):
+- PMIS_QC_STORE: folder of the store (default ".qc_store"), "off" disables the store.
+- PMIS_QC_STORE_TTL: time to live of an entry in hours (default 168).
+- PMIS_QC_STORE_SIZE: size limit in MB (default 5000).
+"""
+import functools
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+
+import numpy as np
+
+
+def source_fingerprint(data_path = None):
+    """
+    Fingerprint of input files: content hash of uploaded files, path, size and modification time of files on disk.
+
+    Parameters:
+    - data_path: path or file-like object (e.g. Streamlit upload), or a list of them.
+
+    Returns:
+    - list of fingerprints.
+    """
+    fingerprints = []
+    for x in (data_path if isinstance(data_path, (list, tuple)) else [data_path]):
+        if hasattr(x, "getvalue"):
+            fingerprints.append([getattr(x, "name", ""), hashlib.sha1(x.getvalue()).hexdigest()])
+        else:
+            fingerprints.append([os.path.abspath(x), os.path.getsize(x), os.path.getmtime(x)])
+    return fingerprints
+
+def lineage_part(value):
+    """JSON form of a stage input: views by their key, arrays by a hash of their bytes."""
+    if hasattr(value, "key") and hasattr(value, "take"):
+        return {"view": value.key}
+    if isinstance(value, np.ndarray):
+        return {"array": hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+class ArtifactStore:
+    """
+    Pickled results in a folder, one file per lineage key. The modification time of a file is the time it was written (time to live),
+    its access time is set when it is read (least recently used eviction).
+    """
+
+    def __init__(self, path = ".qc_store", ttl = 168*3600, max_bytes = 5000*2**20):
+        self.path, self.ttl, self.max_bytes = path, ttl, max_bytes
+        self._lock = threading.Lock()
+
+    def lineage(self, stage, *parts):
+        """Key of a stage result from its inputs (fingerprints, keys of earlier stages and parameters)."""
+        return stage+"-"+hashlib.sha1(json.dumps(parts, sort_keys = True, default = lineage_part).encode()).hexdigest()
+
+    def file(self, key):
+        return os.path.join(self.path, key+".pkl")
+
+    def get(self, key):
+        """Returns (True, value) for a stored and not expired entry, otherwise (False, None)."""
+        try:
+            stat = os.stat(self.file(key))
+            if time.time() - stat.st_mtime > self.ttl:
+                self.remove(self.file(key))
+                return False, None
+            with open(self.file(key), "rb") as f:
+                value = pickle.load(f)
+            os.utime(self.file(key), (time.time(), stat.st_mtime))
+            return True, value
+        except FileNotFoundError:
+            return False, None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            # Unreadable entry (e.g. written by another version), computed again
+            self.remove(self.file(key))
+            return False, None
+
+    def put(self, key, value):
+        os.makedirs(self.path, exist_ok = True)
+        # Written to a temporary file and renamed, so readers never see a partial entry
+        temp = self.file(key)+"."+str(os.getpid())+"."+str(threading.get_ident())+".tmp"
+        with open(temp, "wb") as f:
+            pickle.dump(value, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, self.file(key))
+        self.evict()
+
+    def get_or_compute(self, key, compute):
+        found, value = self.get(key)
+        if not found:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def evict(self):
+        """Removes the expired entries, then the least recently used ones until the store is within its size limit."""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.path):
+                if not entry.name.endswith(".pkl"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if time.time() - stat.st_mtime > self.ttl:
+                    self.remove(entry.path)
+                else:
+                    entries.append((stat.st_atime, stat.st_size, entry.path))
+            size = sum(x[1] for x in entries)
+            for atime, nbytes, path in sorted(entries):
+                if size <= self.max_bytes:
+                    break
+                self.remove(path)
+                size -= nbytes
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def memo(self, stage, func):
+        """Wraps a pipeline function, its results are stored under the lineage of the stage and its arguments."""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.get_or_compute(self.lineage(stage, args, kwargs), lambda: func(*args, **kwargs))
+        return wrapper
+
+
+class NoStore(ArtifactStore):
+    """Store that keeps nothing (PMIS_QC_STORE=off)."""
+
+    def get(self, key):
+        return False, None
+
+    def put(self, key, value):
+        pass
+
+
+# Store of the process
+if os.environ.get("PMIS_QC_STORE", "") == "off":
+    store = NoStore()
+else:
+    store = ArtifactStore(os.environ.get("PMIS_QC_STORE", ".qc_store"),
+                          ttl = float(os.environ.get("PMIS_QC_STORE_TTL", 168))*3600,
+                          max_bytes = float(os.environ.get("PMIS_QC_STORE_SIZE", 5000))*2**20)
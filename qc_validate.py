@@ -0,0 +1,132 @@
+"""
+Validation of loaded PMIS data before merging: required columns, value ranges of the measures, duplicate sections and overlapping
+DFO intervals on a route. The rules are declared in validation_rules, every rule is checked on whole columns at once.
+
+The result is a compact issue report (one row per rule and column), with the number of rows concerned and a few examples.
+"""
+import pandas as pd
+import numpy as np
+
+from qc_catalog import perf_indx_list
+from qc_pipeline import lane_keys
+
+
+# Columns needed to match and summarize the data
+key_cols = ["FISCAL YEAR", "SIGNED HWY AND ROADBED ID", "BEGINNING DFO", "ENDING DFO", "RESPONSIBLE DISTRICT", "COUNTY"]
+
+# Section of a route (as matched, see MatchIndex). The lane keys (DIRECTION, LANE NUMBER) are added when the data has them,
+# so the lanes of a multi-lane route are not duplicates or overlaps of each other.
+section_cols = ["SIGNED HWY AND ROADBED ID", "COUNTY"]
+
+# Validation rules: rule, columns, parameters and severity ("error": the comparison is not possible, "warning": rows to review)
+validation_rules = [
+    {"rule": "required", "columns": key_cols, "severity": "error"},
+    {"rule": "required", "columns": "measures", "severity": "error"},
+    {"rule": "required", "columns": "lanes", "severity": "error"},
+    {"rule": "range", "columns": [x for x in perf_indx_list["IRI"] if "IRI" in x], "min": 0, "max": 1000, "severity": "warning"},
+    {"rule": "range", "columns": ["LEFT - WHEELPATH AVERAGE RUT DEPTH", "RIGHT - WHEELPATH AVERAGE RUT DEPTH", "MAP21 Rutting AVG"], "min": 0, "max": 5, "severity": "warning"},
+    {"rule": "range", "columns": [x for x in perf_indx_list["RUT"] if "PCT" in x], "min": 0, "max": 100, "severity": "warning"},
+    {"rule": "range", "columns": ["RIDE UTILITY VALUE"]+[x for x in perf_indx_list["RUT"] if "UTIL" in x], "min": 0, "max": 1, "severity": "warning"},
+    {"rule": "range", "columns": ["BEGINNING DFO", "ENDING DFO"], "min": 0, "max": None, "severity": "warning"},
+    {"rule": "range", "columns": ["SECTION LENGTH"], "min": 0.001, "max": 5, "severity": "warning"},
+    {"rule": "duplicate", "columns": section_cols+["BEGINNING DFO", "ENDING DFO"], "severity": "warning"},
+    {"rule": "overlap", "columns": section_cols, "severity": "warning"},
+]
+
+def overlap_mask(data = None, by = None):
+    """
+    Sections starting before the end of the previous section of their route (groups of the by columns), by a sweep of the sections
+    sorted by group and beginning DFO. Exact duplicates are left to the duplicate rule.
+
+    Returns:
+    - mask: numpy array of bool.
+    """
+    begin = data["BEGINNING DFO"].to_numpy(dtype = "float64", na_value = np.nan)
+    end = data["ENDING DFO"].to_numpy(dtype = "float64", na_value = np.nan)
+    lo, hi = np.fmin(begin, end), np.fmax(begin, end)
+    codes = data.groupby(by, sort = False, dropna = False).ngroup().to_numpy()
+    rows = np.flatnonzero(~np.isnan(lo) & ~np.isnan(hi))
+    mask = np.zeros(data.shape[0], dtype = bool)
+    if not rows.size:
+        return mask
+
+    # Group code*span + DFO: the running maximum of the section ends never carries over to the next group
+    bmin = lo[rows].min()
+    span = hi[rows].max() - bmin + 1
+    order = rows[np.lexsort((hi[rows], lo[rows], codes[rows]))]
+    start = codes[order]*span + (lo[order] - bmin)
+    stop = codes[order]*span + (hi[order] - bmin)
+    previous = np.maximum.accumulate(np.concatenate([[-np.inf], stop[:-1]]))
+    same = np.concatenate([[False], (start[1:] == start[:-1]) & (stop[1:] == stop[:-1])])
+    mask[order] = (start < previous - 1e-6) & ~same
+    return mask
+
+def rule_masks(data = None, rule = None, item_list = None, lanes = False):
+    """
+    Rows failing a rule. lanes: the sections are matched by direction and lane (the lane keys are required).
+
+    Returns:
+    - list of (column, mask, detail). mask is None for a missing column.
+    """
+    if rule["columns"] == "measures":
+        columns = [x for x in item_list if "UTIL" not in x]
+    elif rule["columns"] == "lanes":
+        columns = lane_keys if lanes else []
+    else:
+        columns = rule["columns"]
+    if rule["rule"] == "required":
+        # Missing columns are added empty when the files are read (see unify_columns)
+        return [(col, None, "missing or empty column") for col in columns if col not in data.columns or data[col].isna().all()]
+    if rule["rule"] == "range":
+        masks = []
+        for col in [x for x in columns if x in data.columns]:
+            values = pd.to_numeric(data[col], errors = "coerce").to_numpy(dtype = "float64", na_value = np.nan)
+            mask = np.zeros(values.size, dtype = bool)
+            if rule["min"] is not None:
+                mask |= values < rule["min"]
+            if rule["max"] is not None:
+                mask |= values > rule["max"]
+            masks.append((col, mask, "outside ["+str(rule["min"])+", "+(str(rule["max"]) if rule["max"] is not None else "")+"]"))
+        return masks
+    if any(col not in data.columns for col in columns):
+        return []
+    if rule["rule"] in ["duplicate", "overlap"]:
+        columns = columns[:len(section_cols)] + [x for x in lane_keys if x in data.columns and data[x].notna().any()] + columns[len(section_cols):]
+    if rule["rule"] == "duplicate":
+        return [(", ".join(columns), data.duplicated(subset = columns, keep = "first").to_numpy(), "duplicate section")]
+    if rule["rule"] == "overlap":
+        return [(", ".join(columns), overlap_mask(data, columns), "overlapping DFO interval")]
+    raise ValueError("Unknown validation rule: "+str(rule["rule"]))
+
+def validate(data = None, item_list = None, rules = None, examples = 3, lanes = False):
+    """
+    Checks the loaded data against the validation rules.
+
+    Parameters:
+    - data: Pandas DataFrame. Loaded data (see data_load).
+    - item_list: list. Selected measures, required in the data.
+    - rules: list, optional. Validation rules (validation_rules by default).
+    - examples: int. Number of example sections of each issue.
+    - lanes: bool. The sections are matched by direction and lane (see MatchIndex), the lane keys are required.
+
+    Returns:
+    - issues: Pandas DataFrame. "Rule", "Column", "Severity", "Issue", "Rows" and "Examples" (route and DFO of the first rows).
+    """
+    issues = []
+    for rule in (rules or validation_rules):
+        for col, mask, detail in rule_masks(data, rule, item_list or [], lanes):
+            if mask is None:
+                issues.append([rule["rule"], col, rule["severity"], detail, data.shape[0], ""])
+            elif mask.any():
+                rows = np.flatnonzero(mask)
+                sample = data.iloc[rows[:examples]]
+                where = (sample["SIGNED HWY AND ROADBED ID"].astype("str")+" "+sample["BEGINNING DFO"].astype("str")+"-"+sample["ENDING DFO"].astype("str")
+                         if {"SIGNED HWY AND ROADBED ID", "BEGINNING DFO", "ENDING DFO"} <= set(data.columns) else pd.Series(rows[:examples]).astype("str"))
+                issues.append([rule["rule"], col, rule["severity"], detail, rows.size, "; ".join(where)])
+    return pd.DataFrame(issues, columns = ["Rule", "Column", "Severity", "Issue", "Rows", "Examples"])
+
+def validation_report(data1 = None, data2 = None, item_list = None, names = ("QC data", "Data to compare"), lanes = False):
+    """Issues of both loaded datasets (see validate), with a "Data" column. Errors first."""
+    report = pd.concat([validate(data, item_list, lanes = lanes).assign(Data = name) for data, name in zip([data1, data2], names)], ignore_index = True)
+    report = report[["Data"]+[x for x in report.columns if x != "Data"]]
+    return report.sort_values(by = "Severity", key = lambda x: x != "error", kind = "stable").reset_index(drop = True)
@@ -0,0 +1,38 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+import pytest
+from qc_pipeline import PairedView
+from qc_expr import expression_filter
+
+
+@pytest.fixture
+def view():
+    data1 = pd.DataFrame({"AVERAGE SPEED": [20.0, 29.0, 35.0, np.nan], "VEHICLE ID": ["V1", "V2", "V1", "V3"]})
+    data2 = pd.DataFrame({"AVERAGE SPEED": [20.0, 30.0, 35.0, 40.0], "VEHICLE ID": ["V1", "V1", "V1", "V3"]})
+    idx = np.arange(4)
+    return PairedView(data1, data2, idx, idx, ["_Pathway", "_Audit"], key = "test")
+
+
+def test_constant_on_the_left(view):
+    assert expression_filter(view, "2 * AVERAGE SPEED < 60", cache = None).tolist() == [True, True, False, False]
+    assert expression_filter(view, "1 + AVERAGE SPEED < 31", cache = None).tolist() == [True, True, False, False]
+    assert expression_filter(view, "100 - AVERAGE SPEED_Audit > 75", cache = None).tolist() == [True, False, False, False]
+    assert expression_filter(view, "60 / AVERAGE SPEED > 2.5", cache = None).tolist() == [True, False, False, False]
+
+
+def test_functions_need_a_column(view):
+    for expression in ["abs(-5) < 3", "isna(1)", "notna('V1')"]:
+        with pytest.raises(ValueError):
+            expression_filter(view, expression, cache = None)
+    assert expression_filter(view, "abs(AVERAGE SPEED - AVERAGE SPEED_Audit) >= 1", cache = None).tolist() == [False, True, False, False]
+    assert expression_filter(view, "isna(AVERAGE SPEED) or VEHICLE ID differs", cache = None).tolist() == [False, True, False, True]
+
+
+def test_arithmetic_on_text(view):
+    with pytest.raises(ValueError):
+        expression_filter(view, "VEHICLE ID + 1 > 2", cache = None)
+    with pytest.raises(ValueError):
+        expression_filter(view, "AVERAGE SPEED + 'a' > 2", cache = None)
@@ -0,0 +1,39 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pandas as pd
+import qc_pipeline
+
+
+def sections(begin, end, values, lanes):
+    return pd.DataFrame({"SIGNED HWY AND ROADBED ID": "R1", "COUNTY": "C1", "DIRECTION": [x[0] for x in lanes],
+                         "LANE NUMBER": [x[1] for x in lanes], "BEGINNING DFO": begin, "ENDING DFO": end,
+                         "ROUGHNESS (IRI) - AVERAGE": values})
+
+
+def test_overlapping_lanes():
+    # Both lanes cover [0, 1]: each half-mile segment covers one mile of sections and averages both lanes
+    data = sections([0.0, 0.0], [1.0, 1.0], [100.0, 200.0], [("N", 1), ("S", 1)])
+    out = qc_pipeline.resegment(data, 0.5)
+    assert out["BEGINNING DFO"].tolist() == [0.0, 0.5]
+    assert np.allclose(out["SECTION LENGTH"], [1.0, 1.0])
+    assert np.allclose(out["ROUGHNESS (IRI) - AVERAGE"], [150.0, 150.0])
+
+
+def test_partly_overlapping_sections():
+    # One long section under two short ones of the other lane
+    data = sections([0.0, 0.0, 0.6], [1.0, 0.4, 1.0], [100.0, 200.0, 400.0], [("N", 1), ("S", 1), ("S", 1)])
+    out = qc_pipeline.resegment(data, 0.5)
+    assert np.allclose(out["SECTION LENGTH"], [0.9, 0.9])
+    assert np.allclose(out["ROUGHNESS (IRI) - AVERAGE"], [(50 + 80)/0.9, (50 + 160)/0.9])
+    assert np.isclose(out["SECTION LENGTH"].sum(), 1.8)
+
+
+def test_missing_values_and_gaps():
+    # A missing value doesn't weigh in the mean, and a segment without sections is dropped
+    data = sections([0.0, 0.0, 2.0], [1.0, 1.0, 2.5], [100.0, np.nan, 300.0], [("N", 1), ("S", 1), ("N", 1)])
+    out = qc_pipeline.resegment(data, 0.5)
+    assert out["BEGINNING DFO"].tolist() == [0.0, 0.5, 2.0]
+    assert np.allclose(out["SECTION LENGTH"], [1.0, 1.0, 0.5])
+    assert np.allclose(out["ROUGHNESS (IRI) - AVERAGE"], [100.0, 100.0, 300.0])